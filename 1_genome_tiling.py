@@ -0,0 +1,117 @@
+"""
+Description:
+    CLI for genome-wide sequence class annotation using the Sei deep
+    learning model. Predicts every 4096 bp window of each chromosome that
+    starts at a multiple of the stride, running the convolutional trunk
+    once over long segments shared by the overlapping windows.
+    Outputs the raw sequence class scores of each window.
+
+Usage:
+    1_genome_tiling.py <output-dir> [--genome=<hg>] [--stride=<bp>]
+                       [--chroms=<chroms>] [--cuda]
+                       [--segment-length=<bp>] [--projection=<path>]
+                       [--chromatin-profiles] [--fuse] [--precision=<p>]
+                       [--profile=<jsonl>]
+    1_genome_tiling.py -h | --help
+
+Options:
+    -h --help               Show this screen.
+    <output-dir>            Output directory. The scores are written to
+                            `sequence-class-hdf5`, one HDF5 file per
+                            chromosome.
+    --genome=<hg>           hg38 or hg19, or the path to a FASTA file or a
+                            genome packed by `compile_packed_genome.py`.
+                            [default: hg19]
+    --stride=<bp>           Distance between window starts. [default: 200]
+    --chroms=<chroms>       Comma-separated chromosomes to annotate, e.g.
+                            chr1,chr2. Defaults to every chromosome of the
+                            reference genome.
+    --cuda                  Run prediction on a CUDA-enabled GPU
+    --segment-length=<bp>   Length of the segments that the convolutional
+                            trunk runs on. Longer segments share more of the
+                            trunk and use more memory. [default: 65536]
+    --projection=<path>     The Sei model directory or a projection artifact
+                            compiled by `compile_projection.py`. Defaults to
+                            `./model`.
+    --chromatin-profiles    Write the 21,907 chromatin profile predictions
+                            of each window (to `chromatin-profiles-hdf5`)
+                            instead of the sequence class scores.
+    --fuse                  Merge the linear convolution pairs and remove the
+                            dropout layers of the loaded model before
+                            prediction (see `Sei.fuse_for_inference`).
+    --precision=<p>         fp32, bf16 or int8 (see
+                            `1_sequence_prediction.py`). [default: fp32]
+    --profile=<jsonl>       Append JSON-lines telemetry to <jsonl>: the
+                            sequences/s, the latency percentiles of the
+                            model, of each block of Sei, of the genome
+                            fetches and of the output writes, and the peak
+                            RSS and GPU memory (see `utils.Profiler`).
+
+"""
+import os
+
+from docopt import docopt
+
+from selene_sdk.utils import load_path
+
+from predict_utils import build_analyze_sequences, load_reference_sequence
+from predict_utils import use_sei_analyze_sequences
+
+
+def _finditem(obj, val):
+    for k, v in obj.items():
+        if hasattr(v, 'keywords'):
+            _finditem(v.keywords, val)
+        elif isinstance(v, dict):
+            _finditem(v, val)
+        elif isinstance(v, str) and '<PATH>' in v:
+            obj[k] = v.replace('<PATH>', val)
+
+
+if __name__ == "__main__":
+    arguments = docopt(
+        __doc__,
+        version='0.0.0')
+
+    # Assumes that the `models` directory is in the same directory as this
+    # script. Please update this line if not.
+    use_dir = os.path.dirname(os.path.abspath(__file__))
+
+    hg_version = arguments["--genome"]
+    genome = load_reference_sequence(hg_version)
+
+    projection = None
+    if arguments["--chromatin-profiles"]:
+        sei_out = os.path.join(
+            arguments["<output-dir>"], "chromatin-profiles-hdf5")
+    else:
+        sei_out = os.path.join(arguments["<output-dir>"], "sequence-class-hdf5")
+        projection = arguments["--projection"]
+        if projection is None:
+            projection = os.path.join(use_dir, "model")
+    os.makedirs(sei_out, exist_ok=True)
+
+    chroms = arguments["--chroms"]
+    if chroms is not None:
+        chroms = chroms.split(',')
+        missing = [chrom for chrom in chroms if chrom not in genome.get_chrs()]
+        if missing:
+            raise ValueError("{0} not in the {1} genome".format(
+                ', '.join(missing), hg_version))
+
+    configs = load_path("./model/sei_seq_prediction.yml", instantiate=False)
+    _finditem(configs, use_dir)
+    configs["analyze_sequences"].bind(
+        reference_sequence=genome,
+        use_cuda=arguments["--cuda"])
+    use_sei_analyze_sequences(configs,
+                              seqclass_projection=projection,
+                              fuse_for_inference=arguments["--fuse"],
+                              precision=arguments["--precision"],
+                              profile=arguments["--profile"])
+    analyze_seqs = build_analyze_sequences(configs)
+    analyze_seqs.tiled_annotation(
+        sei_out,
+        stride=int(arguments["--stride"]),
+        chroms=chroms,
+        segment_length=int(arguments["--segment-length"]))
@@ -0,0 +1,113 @@
+"""
+Description:
+    CLI for in silico saturation mutagenesis using the Sei deep learning
+    model, given an input BED file of regions (up to 4096 bp each).
+    Outputs the histone-normalized sequence class variant effect scores of
+    every single-base substitution in each region.
+
+Usage:
+    1_in_silico_mutagenesis.py <bed> <output-dir> [--genome=<hg>] [--cuda]
+                               [--projection=<path>] [--fuse]
+                               [--precision=<p>] [--incremental]
+                               [--batch-size=<n>] [--profile=<jsonl>]
+                               [--autotune]
+    1_in_silico_mutagenesis.py -h | --help
+
+Options:
+    -h --help               Show this screen.
+    <bed>                   Input BED file of regions to mutate. Each region
+                            is predicted in the 4096 bp window centered on
+                            it, as in `1_sequence_prediction.py`.
+    <output-dir>            Output directory. The scores are written to
+                            `sequence-class-hdf5` as a positions x 4 bases x
+                            40 sequence classes array, with one row label
+                            per position.
+    --genome=<hg>           hg38 or hg19, or the path to a FASTA file or a
+                            genome packed by `compile_packed_genome.py`.
+                            [default: hg19]
+    --cuda                  Run prediction on a CUDA-enabled GPU
+    --projection=<path>     The Sei model directory or a projection artifact
+                            compiled by `compile_projection.py`. Defaults to
+                            `./model`.
+    --fuse                  Merge the linear convolution pairs and remove the
+                            dropout layers of the loaded model before
+                            prediction (see `Sei.fuse_for_inference`).
+    --precision=<p>         fp32, bf16 or int8 (see
+                            `1_sequence_prediction.py`). [default: fp32]
+    --incremental           Compute each batch of mutants from the cached
+                            activations of the reference window (see
+                            `IncrementalSei`).
+    --batch-size=<n>        Number of mutants per forward pass. Defaults to
+                            the `batch_size` in `model/sei_seq_prediction.yml`
+                            (or the --autotune batch size).
+    --profile=<jsonl>       Append JSON-lines telemetry to <jsonl>: the
+                            sequences/s, the latency percentiles of the
+                            model, of each block of Sei, of the genome
+                            fetches and of the output writes, and the peak
+                            RSS and GPU memory (see `utils.Profiler`).
+    --autotune              Choose the batch size with the best throughput
+                            that fits in memory with short calibration
+                            forward passes, and size the write buffer
+                            (`write_mem_limit`) of each output handler to
+                            its share of the memory left by the batch,
+                            instead of the values in the model YAML config.
+                            The chosen values are printed.
+
+"""
+import os
+
+from docopt import docopt
+
+from selene_sdk.utils import load_path
+
+from predict_utils import build_analyze_sequences, load_reference_sequence
+from predict_utils import use_sei_analyze_sequences
+
+
+def _finditem(obj, val):
+    for k, v in obj.items():
+        if hasattr(v, 'keywords'):
+            _finditem(v.keywords, val)
+        elif isinstance(v, dict):
+            _finditem(v, val)
+        elif isinstance(v, str) and '<PATH>' in v:
+            obj[k] = v.replace('<PATH>', val)
+
+
+if __name__ == "__main__":
+    arguments = docopt(
+        __doc__,
+        version='0.0.0')
+
+    # Assumes that the `models` directory is in the same directory as this
+    # script. Please update this line if not.
+    use_dir = os.path.dirname(os.path.abspath(__file__))
+
+    genome = load_reference_sequence(arguments["--genome"])
+
+    sei_out = os.path.join(arguments["<output-dir>"], "sequence-class-hdf5")
+    os.makedirs(sei_out, exist_ok=True)
+
+    projection = arguments["--projection"]
+    if projection is None:
+        projection = os.path.join(use_dir, "model")
+
+    configs = load_path("./model/sei_seq_prediction.yml", instantiate=False)
+    _finditem(configs, use_dir)
+    configs["analyze_sequences"].bind(
+        reference_sequence=genome,
+        use_cuda=arguments["--cuda"])
+    use_sei_analyze_sequences(configs,
+                              seqclass_projection=projection,
+                              fuse_for_inference=arguments["--fuse"],
+                              precision=arguments["--precision"],
+                              incremental=arguments["--incremental"],
+                              autotune=arguments["--autotune"],
+                              profile=arguments["--profile"])
+    analyze_seqs = build_analyze_sequences(configs)
+
+    batch_size = arguments["--batch-size"]
+    if batch_size is not None:
+        batch_size = int(batch_size)
+    analyze_seqs.saturation_mutagenesis_from_bed(
+        arguments["<bed>"], sei_out, batch_size=batch_size)
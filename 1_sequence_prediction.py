@@ -6,6 +6,12 @@ Description:
 
 Usage:
     1_sequence_prediction.py <seq-input> <output-dir> [--genome=<hg>] [--cuda]
+                             [--seqclass-only] [--projection=<path>]
+                             [--fuse] [--precision=<p>]
+                             [--targets=<file>] [--batch-strands]
+                             [--workers=<n>] [--shard=<i/n>]
+                             [--output-dtype=<dtype>] [--profile=<jsonl>]
+                             [--autotune]
     1_sequence_prediction.py -h | --help
 
 Options:
@@ -13,19 +19,78 @@ Options:
     <seq-input>             Input FASTA or BED file.
     <output-dir>            Output directory
     --genome=<hg>           If <seq-input> is a BED file, specify the reference
-                            genome hg38 or hg19 [default: hg19]
+                            genome hg38 or hg19, or the path to a FASTA file
+                            or a genome packed by `compile_packed_genome.py`.
+                            [default: hg19]
     --cuda                  Run variant effect prediction on a CUDA-enabled
                             GPU
+    --seqclass-only         Project each batch of predictions onto the
+                            sequence classes during prediction and only
+                            output the raw sequence class scores (to
+                            `sequence-class-hdf5`) instead of the 21,907
+                            chromatin profile predictions.
+    --projection=<path>     With --seqclass-only, the Sei model directory or
+                            a projection artifact compiled by
+                            `compile_projection.py`. Defaults to `./model`.
+    --fuse                  Merge the linear convolution pairs and remove the
+                            dropout layers of the loaded model before
+                            prediction (see `Sei.fuse_for_inference`).
+    --precision=<p>         fp32, bf16 or int8. bf16 runs the whole model in
+                            bfloat16; int8 (CPU only) uses dynamically
+                            quantized int8 weights for the classifier head.
+                            Use `validate_precision.py` to check the effect
+                            on the predictions. [default: fp32]
+    --targets=<file>        Only predict the chromatin profiles listed in
+                            <file> (one name per line, as in
+                            `model/target.names`). The HDF5 columns follow
+                            the order in <file>, which is also copied to
+                            `<prefix>_target_names.txt`. Not used with
+                            the --seqclass-only option.
+    --batch-strands         Predict each batch and its reverse complement
+                            in a single forward pass of twice the batch
+                            size, instead of one pass per strand. Uses twice
+                            the activation memory.
+    --workers=<n>           Split the input into shards and predict them in
+                            this many CPU worker processes, which share one
+                            copy of the model weights, then merge the
+                            outputs in the input order. [default: 1]
+    --shard=<i/n>           Only predict shard i (0-based) of n shards of
+                            the input, writing to `<output-dir>/shards/`,
+                            e.g. for a SLURM array job. Merge the shards with
+                            `merge_shards.py <output-dir>` once all of them
+                            have finished. Not used with --workers.
+    --output-dtype=<dtype>  Write the HDF5 outputs as float16, or as uint8
+                            scaled to the range of the predictions (0 to 1)
+                            or diffs (-1 to 1), instead of float64. The
+                            compact files are chunked by row blocks and
+                            columns and compressed, and are read with
+                            `utils.DataReader` or the `2_*` scripts.
+                            uint8 cannot be used with --seqclass-only.
+    --profile=<jsonl>       Append JSON-lines telemetry to <jsonl>: the
+                            sequences/s, the latency percentiles of the
+                            model, of each block of Sei, of the genome
+                            fetches and of the output writes, and the peak
+                            RSS and GPU memory (see `utils.Profiler`).
+    --autotune              Choose the batch size with the best throughput
+                            that fits in memory with short calibration
+                            forward passes, and size the write buffer
+                            (`write_mem_limit`) of each output handler to
+                            its share of the memory left by the batch,
+                            instead of the values in the model YAML config.
+                            The chosen values are printed.
 
 """
 import os
 
 from docopt import docopt
 
-from selene_sdk.sequences import Genome
 from selene_sdk.utils import load_path
 from selene_sdk.utils import parse_configs_and_run
 
+from predict_utils import load_reference_sequence, merge_shards
+from predict_utils import parse_shard, prepare_shards
+from predict_utils import run_shards_in_workers, use_sei_analyze_sequences
+
 
 def _finditem(obj, val):
     for k, v in obj.items():
@@ -50,25 +115,69 @@ if __name__ == "__main__":
     # script. Please update this line if not.
     use_dir = os.path.dirname(os.path.abspath(__file__))
     use_cuda = arguments["--cuda"]
-
-    sei_out = os.path.join(arguments["<output-dir>"], "chromatin-profiles-hdf5")
-    os.makedirs(sei_out, exist_ok=True)
+    seqclass_only = arguments["--seqclass-only"]
+
+    if seqclass_only:
+        output_subdir = "sequence-class-hdf5"
+    else:
+        output_subdir = "chromatin-profiles-hdf5"
+    n_workers = int(arguments["--workers"])
+    if n_workers > 1 and arguments["--shard"] is not None:
+        raise ValueError("--workers and --shard cannot be combined")
+    if n_workers > 1 and use_cuda:
+        raise ValueError("--workers is for CPU prediction only")
+    shards = None
+    if arguments["--shard"] is not None:
+        shard, n_shards = parse_shard(arguments["--shard"])
+        [(seq_input, shard_dir)] = prepare_shards(
+            seq_input, arguments["<output-dir>"], n_shards, [shard])
+        sei_out = os.path.join(shard_dir, output_subdir)
+    elif n_workers > 1:
+        shards = prepare_shards(seq_input, arguments["<output-dir>"], n_workers)
+        sei_out = None
+    else:
+        sei_out = os.path.join(arguments["<output-dir>"], output_subdir)
+    if sei_out is not None:
+        os.makedirs(sei_out, exist_ok=True)
 
     configs = load_path("./model/sei_seq_prediction.yml", instantiate=False)
     _finditem(configs, use_dir)
+    projection = None
+    if seqclass_only:
+        projection = arguments["--projection"]
+        if projection is None:
+            projection = os.path.join(use_dir, "model")
+    use_sei_analyze_sequences(configs,
+                              seqclass_projection=projection,
+                              fuse_for_inference=arguments["--fuse"],
+                              precision=arguments["--precision"],
+                              targets=arguments["--targets"],
+                              output_dtype=arguments["--output-dtype"],
+                              batch_strands=arguments["--batch-strands"],
+                              autotune=arguments["--autotune"],
+                              profile=arguments["--profile"],
+                              n_processes=n_workers)
 
     configs["prediction"].update(input_path=seq_input, output_dir=sei_out)
     configs["analyze_sequences"].bind(use_cuda=use_cuda)
 
     # Assumes BED file coordinates input if file doesn't end with .fa or .fasta
     if not seq_input.endswith('.fa') and not seq_input.endswith('.fasta'):
-        hg_version = arguments["--genome"]
-        genome = None
-        if hg_version == 'hg38' or hg_version == 'hg19':
-            genome = Genome(
-                os.path.join('.', 'resources', '{0}_UCSC.fa'.format(hg_version)))
-            configs["analyze_sequences"].bind(reference_sequence=genome)
-        else:
-            raise ValueError("--genome=<hg> must be 'hg19' or 'hg38'")
-    parse_configs_and_run(configs)
+        genome = load_reference_sequence(arguments["--genome"])
+        configs["analyze_sequences"].bind(reference_sequence=genome)
+
+    if shards is None:
+        parse_configs_and_run(configs)
+    else:
+        predict_info = configs["prediction"]
+
+        def run_shard(analyze_seqs, shard):
+            shard_input, shard_dir = shards[shard]
+            sei_out = os.path.join(shard_dir, output_subdir)
+            os.makedirs(sei_out, exist_ok=True)
+            analyze_seqs.get_predictions(**dict(
+                predict_info, input_path=shard_input, output_dir=sei_out))
+
+        run_shards_in_workers(configs, n_workers, run_shard)
+        merge_shards(arguments["<output-dir>"])
 
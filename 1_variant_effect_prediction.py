@@ -3,28 +3,131 @@ Description:
     CLI for variant effect prediction using the Sei deep learning model,
     given an input VCF file.
     Outputs Sei chromatin profile predictions.
+    Several VCF files can be scored in one run, which loads the model
+    once and predicts each variant found in more than one of them once.
 
 Usage:
     1_variant_effect_prediction.py <vcf> <output-dir> [--genome=<hg>] [--cuda]
+                                   [--seqclass-only] [--projection=<path>]
+                                   [--fuse] [--precision=<p>]
+                                   [--targets=<file>] [--incremental]
+                                   [--batch-strands]
+                                   [--ref-cache=<dir>] [--ref-cache-size=<gb>]
+                                   [--workers=<n>] [--shard=<i/n>]
+                                   [--output-dtype=<dtype>] [--profile=<jsonl>]
+                                   [--autotune] [--pipeline]
+                                   [--fetch-workers=<n>]
     1_variant_effect_prediction.py -h | --help
 
 Options:
     -h --help               Show this screen.
-    <vcf>                   Input VCF file
+    <vcf>                   Input VCF file, comma-separated VCF files, or
+                            a manifest (a `.txt` file) listing one VCF file
+                            per line. The outputs of each VCF file are named
+                            after it, so their names must be distinct.
     <output-dir>            Output directory
-    --genome=<hg>           hg38 or hg19 [default: hg19]
+    --genome=<hg>           hg38 or hg19, or the path to a FASTA file or a
+                            genome packed by `compile_packed_genome.py`.
+                            [default: hg19]
     --cuda                  Run variant effect prediction on a CUDA-enabled
                             GPU
+    --seqclass-only         Compute the histone-normalized sequence class
+                            variant effect scores from each batch of ref/alt
+                            predictions during prediction and only output
+                            those scores (to `sequence-class-hdf5`) instead
+                            of the 21,907 chromatin profile predictions.
+                            `2_varianteffect_sc_score.py` does not need to
+                            be run afterwards.
+    --projection=<path>     With --seqclass-only, the Sei model directory or
+                            a projection artifact compiled by
+                            `compile_projection.py`. Defaults to `./model`.
+    --fuse                  Merge the linear convolution pairs and remove the
+                            dropout layers of the loaded model before
+                            prediction (see `Sei.fuse_for_inference`).
+    --precision=<p>         fp32, bf16 or int8. bf16 runs the whole model in
+                            bfloat16; int8 (CPU only) uses dynamically
+                            quantized int8 weights for the classifier head.
+                            Use `validate_precision.py` to check the effect
+                            on the predictions. [default: fp32]
+    --targets=<file>        Only predict the chromatin profiles listed in
+                            <file> (one name per line, as in
+                            `model/target.names`). The HDF5 columns follow
+                            the order in <file>, which is also copied to
+                            `<prefix>_target_names.txt`. Not used with
+                            the --seqclass-only option.
+    --incremental           Compute the alt predictions from the cached ref
+                            activations, recomputing only the positions
+                            within the receptive field of the variant in
+                            the early convolution stages, and print the
+                            measured saving (see `IncrementalSei`).
+    --ref-cache=<dir>       Cache the ref predictions in <dir>, keyed by
+                            genome build, chromosome, window start, strand
+                            and model, and only predict the ref windows not
+                            already cached by this or an earlier run.
+    --ref-cache-size=<gb>   Size cap of --ref-cache in GB (per model). The
+                            least recently used predictions are evicted
+                            first. [default: 10]
+    --batch-strands         Predict each batch and its reverse complement
+                            in a single forward pass of twice the batch
+                            size, instead of one pass per strand. Uses twice
+                            the activation memory.
+    --workers=<n>           Split the input into shards and predict them in
+                            this many CPU worker processes, which share one
+                            copy of the model weights, then merge the
+                            outputs in the input order. [default: 1]
+    --shard=<i/n>           Only predict shard i (0-based) of n shards of
+                            the input, writing to `<output-dir>/shards/`,
+                            e.g. for a SLURM array job. Merge the shards with
+                            `merge_shards.py <output-dir>` once all of them
+                            have finished. Not used with --workers or with
+                            several VCF files.
+    --output-dtype=<dtype>  Write the HDF5 outputs as float16, or as uint8
+                            scaled to the range of the predictions (0 to 1)
+                            or diffs (-1 to 1), instead of float64. The
+                            compact files are chunked by row blocks and
+                            columns and compressed, and are read with
+                            `utils.DataReader` or the `2_*` scripts.
+                            uint8 cannot be used with --seqclass-only.
+                            Small alt - ref differences are lost when the
+                            ref and alt predictions are rounded separately,
+                            so score variants with --seqclass-only (or from
+                            float64 predictions) where they matter.
+    --profile=<jsonl>       Append JSON-lines telemetry to <jsonl>: the
+                            sequences/s, the latency percentiles of the
+                            model, of each block of Sei, of the genome
+                            fetches and of the output writes, and the peak
+                            RSS and GPU memory (see `utils.Profiler`).
+    --autotune              Choose the batch size with the best throughput
+                            that fits in memory with short calibration
+                            forward passes, and size the write buffer
+                            (`write_mem_limit`) of each output handler to
+                            its share of the memory left by the batch,
+                            instead of the values in the model YAML config.
+                            The chosen values are printed.
+    --pipeline              Overlap reading and encoding the variant
+                            windows, running the model and writing the
+                            outputs, in threads connected by bounded
+                            queues, instead of running them one after the
+                            other for each batch. The outputs are the same.
+    --fetch-workers=<n>     With --pipeline, the number of threads that
+                            read and encode the windows. More than 1
+                            requires a packed --genome. Defaults to 1 for a
+                            FASTA file and up to 4 for a packed genome.
 
 """
 import os
+import shutil
 
 from docopt import docopt
 
-from selene_sdk.sequences import Genome
 from selene_sdk.utils import load_path
 from selene_sdk.utils import parse_configs_and_run
 
+from predict_utils import load_reference_sequence, merge_shards
+from predict_utils import parse_shard, prepare_shards, read_vcf_manifest
+from predict_utils import run_shards_in_workers, split_variant_union
+from predict_utils import use_sei_analyze_sequences, write_variant_union
+
 
 def _finditem(obj, val):
     for k, v in obj.items():
@@ -48,27 +151,130 @@ if __name__ == "__main__":
     use_dir = os.path.dirname(os.path.abspath(__file__))
 
     hg_version = arguments["--genome"]
-    genome = None
-    if hg_version == 'hg38' or hg_version == 'hg19':
-        genome = Genome(
-            os.path.join('.', 'resources', '{0}_UCSC.fa'.format(hg_version)))
-    else:
-        raise ValueError("--genome=<hg> must be 'hg19' or 'hg38'")
+    genome = load_reference_sequence(hg_version)
+    if hg_version != 'hg38' and hg_version != 'hg19':
+        hg_version = None
 
     use_cuda = arguments["--cuda"]
+    seqclass_only = arguments["--seqclass-only"]
+    fetch_workers = arguments["--fetch-workers"]
+    if fetch_workers is not None:
+        if not arguments["--pipeline"]:
+            raise ValueError("--fetch-workers=<n> requires --pipeline")
+        fetch_workers = int(fetch_workers)
+        if fetch_workers < 1:
+            raise ValueError("--fetch-workers=<n> must be a positive integer")
 
-    def run_config(config_yml, output_dir):
+    def load_configs(config_yml, vcf, output_dir, strand_index=None):
         configs = load_path(config_yml, instantiate=False)
         _finditem(configs, use_dir)
         configs["analyze_sequences"].bind(
             reference_sequence=genome,
             use_cuda=use_cuda)
         configs["variant_effect_prediction"].update(
-            vcf_files=[arguments["<vcf>"]],
+            vcf_files=[vcf],
             output_dir=output_dir)
-        parse_configs_and_run(configs)
+        if strand_index is not None:
+            configs["variant_effect_prediction"].update(
+                strand_index=strand_index,
+                require_strand=False)
+        projection = None
+        if seqclass_only:
+            projection = arguments["--projection"]
+            if projection is None:
+                projection = os.path.join(use_dir, "model")
+            configs["variant_effect_prediction"].update(
+                save_data=["predictions"])
+        use_sei_analyze_sequences(configs,
+                                  seqclass_projection=projection,
+                                  fuse_for_inference=arguments["--fuse"],
+                                  precision=arguments["--precision"],
+                                  targets=arguments["--targets"],
+                                  output_dtype=arguments["--output-dtype"],
+                                  batch_strands=arguments["--batch-strands"],
+                                  incremental=arguments["--incremental"],
+                                  ref_cache=arguments["--ref-cache"],
+                                  ref_cache_size=float(
+                                      arguments["--ref-cache-size"]),
+                                  genome_build=hg_version,
+                                  autotune=arguments["--autotune"],
+                                  profile=arguments["--profile"],
+                                  pipeline=arguments["--pipeline"],
+                                  fetch_workers=fetch_workers,
+                                  n_processes=n_workers)
+        return configs
+
+    if seqclass_only:
+        output_subdir = "sequence-class-hdf5"
+    else:
+        output_subdir = "chromatin-profiles-hdf5"
+    config_yml = "./model/sei_varianteffect_prediction.yml"
+    vcf_files = arguments["<vcf>"].split(',')
+    if len(vcf_files) == 1 and vcf_files[0].endswith('.txt'):
+        vcf_files = read_vcf_manifest(vcf_files[0])
+    n_workers = int(arguments["--workers"])
+    if n_workers > 1 and arguments["--shard"] is not None:
+        raise ValueError("--workers and --shard cannot be combined")
+    if len(vcf_files) > 1 and arguments["--shard"] is not None:
+        raise ValueError("--shard takes a single VCF file")
 
-    sei_out = os.path.join(arguments["<output-dir>"], "chromatin-profiles-hdf5")
-    os.makedirs(sei_out, exist_ok=True)
-    run_config("./model/sei_varianteffect_prediction.yml", sei_out)
+    def run(vcf, output_dir, strand_index=None):
+        if arguments["--shard"] is not None:
+            shard, n_shards = parse_shard(arguments["--shard"])
+            [(vcf, shard_dir)] = prepare_shards(
+                vcf, output_dir, n_shards, [shard])
+            sei_out = os.path.join(shard_dir, output_subdir)
+            os.makedirs(sei_out, exist_ok=True)
+            parse_configs_and_run(load_configs(config_yml, vcf, sei_out))
+        elif n_workers > 1:
+            if use_cuda:
+                raise ValueError("--workers is for CPU prediction only")
+            shards = prepare_shards(vcf, output_dir, n_workers)
+            configs = load_configs(config_yml, vcf, None,
+                                   strand_index=strand_index)
+            vareff_info = configs["variant_effect_prediction"]
+            vareff_info.pop("vcf_files")
 
+            def run_shard(analyze_seqs, shard):
+                shard_vcf, shard_dir = shards[shard]
+                sei_out = os.path.join(shard_dir, output_subdir)
+                os.makedirs(sei_out, exist_ok=True)
+                analyze_seqs.variant_effect_prediction(
+                    shard_vcf, **dict(vareff_info, output_dir=sei_out))
+
+            run_shards_in_workers(configs, n_workers, run_shard)
+            merge_shards(output_dir)
+        else:
+            sei_out = os.path.join(output_dir, output_subdir)
+            os.makedirs(sei_out, exist_ok=True)
+            parse_configs_and_run(load_configs(
+                config_yml, vcf, sei_out, strand_index=strand_index))
+
+    if len(vcf_files) == 1:
+        run(vcf_files[0], arguments["<output-dir>"])
+    else:
+        # predict the distinct variants of all of the files in one run,
+        # then write the outputs of each file from those of the union
+        sei_out = os.path.join(arguments["<output-dir>"], output_subdir)
+        union_dir = os.path.join(arguments["<output-dir>"], "union")
+        os.makedirs(sei_out, exist_ok=True)
+        os.makedirs(union_dir, exist_ok=True)
+        configs = load_path(config_yml, instantiate=False)
+        vareff_info = configs["variant_effect_prediction"]
+        files = write_variant_union(
+            vcf_files,
+            os.path.join(union_dir, "union.vcf"),
+            genome,
+            configs["analyze_sequences"].keywords["sequence_length"],
+            strand_index=vareff_info.get("strand_index"),
+            require_strand=vareff_info.get("require_strand", False),
+            na_dir=sei_out)
+        n_variants = sum(len(rows) for _, rows, _ in files)
+        n_unique = max([rows.max() + 1 for _, rows, _ in files if len(rows)],
+                       default=0)
+        print("Predicting {0} distinct variants for the {1} variants of {2} "
+              "VCF files".format(n_unique, n_variants, len(files)))
+        run(os.path.join(union_dir, "union.vcf"), union_dir, strand_index=5)
+        split_variant_union(
+            os.path.join(union_dir, output_subdir), files, sei_out)
+        shutil.rmtree(union_dir)
@@ -7,6 +7,9 @@ Description:
 Usage:
     2_raw_sc_score.py <input-fp> <output-dir>
                       [--out-name=<out-name>]
+                      [--block-size=<n>]
+                      [--projection=<artifact>]
+                      [--profile=<jsonl>]
     2_raw_sc_score.py -h | --help
 
 Options:
@@ -16,6 +19,18 @@ Options:
                            as an .NPY file.
     --out-name=<out-name>  Specify an output filename prefix. Otherwise, output
                            filenames will be based on <input-fp>.
+    --block-size=<n>       Read the predictions and compute the scores <n> rows
+                           at a time, appending each block to the output. Peak
+                           memory is then bounded by <n> rather than the number
+                           of sequences.
+    --projection=<artifact>
+                           Use a projection artifact compiled by
+                           `compile_projection.py` instead of the files in
+                           `./model`.
+    --profile=<jsonl>      Append JSON-lines telemetry to <jsonl>: the rows/s,
+                           the latency percentiles of reading the
+                           predictions, scoring and writing the outputs, and
+                           the peak RSS (see `utils.Profiler`).
 
 """
 import os
@@ -25,7 +40,10 @@ import h5py
 import numpy as np
 import pandas as pd
 
-from utils import get_filename_prefix, get_data, get_targets
+from utils import get_filename_prefix, get_data
+from utils import get_data_blocks, get_data_n_rows
+from utils import load_projection_artifact
+from utils import Profiler, profile_iter, profile_stage
 from utils import sc_projection
 
 
@@ -35,16 +53,30 @@ if __name__ == "__main__":
         version='1.0.0')
     output_dir = arguments['<output-dir>']
     os.makedirs(output_dir, exist_ok=True)
+    profiler = None
+    if arguments['--profile'] is not None:
+        profiler = Profiler(arguments['--profile'])
+
+    block_size = arguments['--block-size']
+    if block_size is not None:
+        block_size = int(block_size)
+        if block_size <= 0:
+            raise ValueError("--block-size=<n> must be a positive integer")
 
     input_pred_file = arguments['<input-fp>']
-    input_preds = get_data(input_pred_file)
+    if block_size is None:
+        with profile_stage(profiler, 'read'):
+            input_preds = get_data(input_pred_file)
+        n_rows = len(input_preds)
+    else:
+        n_rows = get_data_n_rows(input_pred_file)
     input_dir, input_fn = os.path.split(input_pred_file)
 
     input_prefix = get_filename_prefix(input_fn)
     rowlabels_file = os.path.join(input_dir, '{0}_row_labels.txt'.format(
         input_prefix))
     rowlabels = pd.read_csv(rowlabels_file, sep='\t')
-    if len(rowlabels) != len(input_preds):
+    if len(rowlabels) != n_rows:
         raise ValueError(("Rowlabels file '{0}' does not have the same number "
                           "of rows as '{1}'").format(rowlabels_file,
                                                      input_pred_file))
@@ -54,14 +86,42 @@ if __name__ == "__main__":
         output_prefix = input_fn.split('_predictions')[0]
     print("Output files will start with prefix '{0}'".format(output_prefix))
 
-    sei_dir = "./model"
-    chromatin_profiles = get_targets(os.path.join(sei_dir, "target.names"))
-    seqclass_names = get_targets(os.path.join(sei_dir, "seqclass.names"))
-
-    clustervfeat = np.load(os.path.join(sei_dir, 'projvec_targets.npy'))
-
-    projscores = sc_projection(input_preds, clustervfeat)
-    np.save(os.path.join(
-        output_dir, "{0}.raw_sequence_class_scores.npy".format(output_prefix)),
-        projscores)
+    if arguments['--projection'] is not None:
+        projection = load_projection_artifact(arguments['--projection'])
+        clustervfeat = projection['projvec']
+        normalized = True
+    else:
+        sei_dir = "./model"
+        clustervfeat = np.load(os.path.join(sei_dir, 'projvec_targets.npy'))
+        normalized = False
 
+    output_file = os.path.join(
+        output_dir, "{0}.raw_sequence_class_scores.npy".format(output_prefix))
+    if block_size is None:
+        with profile_stage(profiler, 'score'):
+            projscores = sc_projection(input_preds, clustervfeat,
+                                       normalized=normalized)
+        with profile_stage(profiler, 'write'):
+            np.save(output_file, projscores)
+        if profiler is not None:
+            profiler.count(n_rows)
+    else:
+        projscores = None
+        for start, block in profile_iter(
+                profiler, 'read', get_data_blocks(input_pred_file, block_size)):
+            with profile_stage(profiler, 'score'):
+                projscores_block = sc_projection(block, clustervfeat,
+                                                 normalized=normalized)
+            with profile_stage(profiler, 'write'):
+                if projscores is None:
+                    projscores = np.lib.format.open_memmap(
+                        output_file, mode='w+', dtype=projscores_block.dtype,
+                        shape=(n_rows, projscores_block.shape[1]))
+                projscores[start:start + len(projscores_block)] = \
+                    projscores_block
+            if profiler is not None:
+                profiler.count(len(block))
+        if projscores is None:
+            np.save(output_file, np.empty((0, len(clustervfeat))))
+        else:
+            projscores.flush()
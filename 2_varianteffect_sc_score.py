@@ -10,6 +10,10 @@ Usage:
     2_varianteffect_sc_score.py <ref-fp> <alt-fp> <output-dir>
                                 [--out-name=<out-name>]
                                 [--no-tsv]
+                                [--top-k=<k>] [--min-score=<t>]
+                                [--block-size=<n>]
+                                [--projection=<artifact>]
+                                [--profile=<jsonl>]
     2_varianteffect_sc_score.py -h | --help
 
 Options:
@@ -27,10 +31,28 @@ Options:
     --no-tsv               The TSVs outputted sort the variants based on maximum
                            absolute scores across sequence classes and are intended
                            for easier perusal of the predictions for those more
-                           familiar with this file type, but makes this script take
-                           much longer to complete as a result. If you are comfortable
+                           familiar with this file type. Writing them adds to the
+                           runtime of this script. If you are comfortable
                            working with HDF5 and NPY files, you can suppress the TSV
                            output and use the files in `chromatin-profiles-hdf5`.
+    --top-k=<k>            Only write the <k> variants with the largest maximum
+                           absolute sequence class score to the TSVs. The NPY
+                           output always contains all variants.
+    --min-score=<t>        Only write variants whose maximum absolute sequence
+                           class score is at least <t> to the TSVs.
+    --block-size=<n>       Read the ref/alt predictions and compute the scores
+                           <n> rows at a time, appending each block to the
+                           outputs. Peak memory is then bounded by <n> rather
+                           than the number of variants. Use this for large
+                           VCFs (e.g. --block-size=10000).
+    --projection=<artifact>
+                           Use a projection artifact compiled by
+                           `compile_projection.py` instead of the files in
+                           `./model`.
+    --profile=<jsonl>      Append JSON-lines telemetry to <jsonl>: the rows/s,
+                           the latency percentiles of reading the
+                           predictions, scoring and writing the outputs, and
+                           the peak RSS (see `utils.Profiler`).
 
 """
 import os
@@ -41,7 +63,10 @@ import numpy as np
 import pandas as pd
 
 from utils import get_filename_prefix, get_data, get_targets
-from utils import sc_hnorm_varianteffect
+from utils import get_data_blocks, get_data_n_rows, get_data_rows
+from utils import load_projection_artifact
+from utils import Profiler, profile_iter, profile_stage
+from utils import sc_hnorm_projection_matrix, sc_hnorm_varianteffect_fused
 from utils import write_to_tsv
 
 
@@ -52,14 +77,28 @@ if __name__ == "__main__":
     ref_pred_file = arguments['<ref-fp>']
     alt_pred_file = arguments['<alt-fp>']
 
+    block_size = arguments['--block-size']
+    if block_size is not None:
+        block_size = int(block_size)
+        if block_size <= 0:
+            raise ValueError("--block-size=<n> must be a positive integer")
+    profiler = None
+    if arguments['--profile'] is not None:
+        profiler = Profiler(arguments['--profile'])
+
     # load predictions
-    chromatin_profile_ref = get_data(ref_pred_file)
-    chromatin_profile_alt = get_data(alt_pred_file)
-    if len(chromatin_profile_ref) != len(chromatin_profile_alt):
+    if block_size is None:
+        with profile_stage(profiler, 'read'):
+            chromatin_profile_ref = get_data(ref_pred_file)
+            chromatin_profile_alt = get_data(alt_pred_file)
+        n_ref, n_alt = len(chromatin_profile_ref), len(chromatin_profile_alt)
+    else:
+        n_ref = get_data_n_rows(ref_pred_file)
+        n_alt = get_data_n_rows(alt_pred_file)
+    if n_ref != n_alt:
         raise ValueError(("{0} and {1} have different number of rows: {2} vs {3}, "
                           "respectively.").format(ref_pred_file, alt_pred_file,
-                                                  len(chromatin_profile_ref),
-                                                  len(chromatin_profile_alt)))
+                                                  n_ref, n_alt))
 
     alt_dir, alt_fn = os.path.split(alt_pred_file)
 
@@ -68,7 +107,7 @@ if __name__ == "__main__":
     alt_prefix = get_filename_prefix(alt_fn)
     rowlabels_file = os.path.join(alt_dir, '{0}_row_labels.txt'.format(alt_prefix))
     rowlabels = pd.read_csv(rowlabels_file, sep='\t')
-    if len(rowlabels) != len(chromatin_profile_alt):
+    if len(rowlabels) != n_alt:
         raise ValueError(("Rowlabels file '{0}' does not have the same number "
                           "of rows as '{1}'").format(rowlabels_file, alt_pred_file))
 
@@ -81,35 +120,94 @@ if __name__ == "__main__":
     print("Output files will start with prefix '{0}'".format(output_prefix))
 
     no_tsv = arguments['--no-tsv']
-
-    sei_dir = "./model"
-    chromatin_profiles = get_targets(os.path.join(sei_dir, "target.names"))
-    seqclass_names = get_targets(os.path.join(sei_dir, "seqclass.names"))
-
-    clustervfeat = np.load(os.path.join(sei_dir, 'projvec_targets.npy'))
-    histone_inds = np.load(os.path.join(sei_dir, 'histone_inds.npy'))
-
-    diffproj = sc_hnorm_varianteffect(
-        chromatin_profile_ref,
-        chromatin_profile_alt,
-        clustervfeat,
-        histone_inds)
-    max_abs_diff = np.abs(diffproj).max(axis=1)
-
-    np.save(os.path.join(
-        output_dir, "{0}.sequence_class_scores.npy".format(output_prefix)), diffproj)
+    top_k = arguments['--top-k']
+    if top_k is not None:
+        top_k = int(top_k)
+        if top_k < 1:
+            raise ValueError("--top-k=<k> must be a positive integer")
+    min_score = arguments['--min-score']
+    if min_score is not None:
+        min_score = float(min_score)
+
+    if arguments['--projection'] is not None:
+        projection = load_projection_artifact(arguments['--projection'])
+        chromatin_profiles = projection['chromatin_profiles']
+        seqclass_names = projection['seqclass_names']
+        hnorm_projvec = projection['hnorm_projvec']
+    else:
+        sei_dir = "./model"
+        chromatin_profiles = get_targets(os.path.join(sei_dir, "target.names"))
+        seqclass_names = get_targets(os.path.join(sei_dir, "seqclass.names"))
+
+        clustervfeat = np.load(os.path.join(sei_dir, 'projvec_targets.npy'))
+        histone_inds = np.load(os.path.join(sei_dir, 'histone_inds.npy'))
+        hnorm_projvec = sc_hnorm_projection_matrix(
+            clustervfeat, histone_inds, n_classes=len(seqclass_names))
+
+    output_scores_file = os.path.join(
+        output_dir, "{0}.sequence_class_scores.npy".format(output_prefix))
+    output_chromatin_profile_file = os.path.join(
+        output_dir, "sorted.{0}.chromatin_profile_diffs.tsv".format(output_prefix))
+    output_sequence_class_file = os.path.join(
+        output_dir, "sorted.{0}.sequence_class_scores.tsv".format(output_prefix))
+
+    if block_size is None:
+        with profile_stage(profiler, 'score'):
+            diffproj = sc_hnorm_varianteffect_fused(
+                chromatin_profile_ref,
+                chromatin_profile_alt,
+                hnorm_projvec)
+            max_abs_diff = np.abs(diffproj).max(axis=1)
+
+        with profile_stage(profiler, 'write'):
+            np.save(output_scores_file, diffproj)
+        if profiler is not None:
+            profiler.count(n_alt)
+
+        def get_chromatin_profile_diffs(row_ixs):
+            return chromatin_profile_alt[row_ixs] - chromatin_profile_ref[row_ixs]
+    else:
+        diffproj = None
+        for (start, ref_block), (_, alt_block) in profile_iter(
+                profiler, 'read', zip(
+                    get_data_blocks(ref_pred_file, block_size),
+                    get_data_blocks(alt_pred_file, block_size))):
+            with profile_stage(profiler, 'score'):
+                diffproj_block = sc_hnorm_varianteffect_fused(
+                    ref_block, alt_block, hnorm_projvec)
+            with profile_stage(profiler, 'write'):
+                if diffproj is None:
+                    diffproj = np.lib.format.open_memmap(
+                        output_scores_file, mode='w+',
+                        dtype=diffproj_block.dtype,
+                        shape=(n_alt, diffproj_block.shape[1]))
+                    max_abs_diff = np.empty(n_alt, dtype=diffproj_block.dtype)
+                end = start + len(diffproj_block)
+                diffproj[start:end] = diffproj_block
+                max_abs_diff[start:end] = np.abs(diffproj_block).max(axis=1)
+            if profiler is not None:
+                profiler.count(len(diffproj_block))
+        if diffproj is None:
+            diffproj = np.empty((0, len(seqclass_names)))
+            max_abs_diff = np.empty(0)
+            np.save(output_scores_file, diffproj)
+        else:
+            diffproj.flush()
+
+        def get_chromatin_profile_diffs(row_ixs):
+            return (get_data_rows(alt_pred_file, row_ixs) -
+                    get_data_rows(ref_pred_file, row_ixs))
 
     if not no_tsv:
-        write_to_tsv(max_abs_diff,  # max sequence class score
-                     chromatin_profile_alt - chromatin_profile_ref,  # chromatin profile diffs
-                     diffproj,  # sequence class diffs
-                     chromatin_profiles,  # chromatin profile targets
-                     seqclass_names,  # sequence class names
-                     rowlabels,
-                     os.path.join(output_dir,
-                                  "sorted.{0}.chromatin_profile_diffs.tsv".format(
-                                      output_prefix)),
-                     os.path.join(output_dir,
-                                  "sorted.{0}.sequence_class_scores.tsv".format(
-                                      output_prefix)))
-
+        with profile_stage(profiler, 'write_tsv'):
+            write_to_tsv(max_abs_diff,  # max sequence class score
+                         get_chromatin_profile_diffs,  # chromatin profile diffs
+                         diffproj,  # sequence class diffs
+                         chromatin_profiles,  # chromatin profile targets
+                         seqclass_names,  # sequence class names
+                         rowlabels,
+                         output_chromatin_profile_file,
+                         output_sequence_class_file,
+                         top_k=top_k,
+                         min_score=min_score,
+                         batch_size=block_size or 1000)
@@ -0,0 +1,120 @@
+"""
+Description:
+    Ingests the variant effect sequence class scores written by
+    `2_varianteffect_sc_score.py` into an indexed results store, and
+    queries the variants of every ingested run by name (e.g. rsID), by
+    locus, by score in a sequence class or by top-k score, without
+    rescanning the score files. Each ingest adds a segment of sorted
+    scores that score queries search; `compact` merges them into one.
+
+Usage:
+    3_results_store.py ingest <store-dir> <scores> <row-labels>
+                       [--run=<name>] [--projection=<artifact>]
+    3_results_store.py query <store-dir> [--id=<name>] [--region=<region>]
+                       [--class=<seqclass>] [--min-abs-score=<t>]
+                       [--top-k=<k>] [--output=<tsv>]
+    3_results_store.py compact <store-dir>
+    3_results_store.py -h | --help
+
+Options:
+    -h --help               Show this screen.
+    <store-dir>             The results store directory. It is created by the
+                            first ingest.
+    <scores>                A `*.sequence_class_scores.npy` file written by
+                            `2_varianteffect_sc_score.py`, or an HDF5 file
+                            of sequence class scores written with
+                            `--seqclass-only`.
+    <row-labels>            The `*_row_labels.txt` file of the variants in
+                            <scores>.
+    --run=<name>            A unique name for the ingested run. Defaults to
+                            the path of <scores>.
+    --projection=<artifact>
+                            Take the sequence class names from a projection
+                            artifact compiled by `compile_projection.py`
+                            instead of `./model/seqclass.names`.
+    --id=<name>             Only the variants with this name (VCF ID column).
+    --region=<region>       Only the variants in chrom, chrom:start-end or
+                            chrom:pos (VCF positions, end exclusive).
+    --class=<seqclass>      The sequence class of --min-abs-score and --top-k,
+                            as a label (e.g. PC1), a full name or an index.
+    --min-abs-score=<t>     Only the variants whose absolute score in --class
+                            is at least <t>.
+    --top-k=<k>             Only the <k> variants with the largest absolute
+                            score in --class.
+    --output=<tsv>          Write the matching variants to this TSV file
+                            instead of standard output.
+
+"""
+import os
+import sys
+
+from docopt import docopt
+
+from utils import ResultsStore, get_targets, load_projection_artifact
+
+
+def _parse_region(region):
+    if ':' not in region:
+        return region, None, None
+    chrom, interval = region.rsplit(':', 1)
+    interval = interval.replace(',', '')
+    if '-' in interval:
+        start, end = interval.split('-')
+        return chrom, int(start), int(end)
+    return chrom, int(interval), int(interval) + 1
+
+
+if __name__ == "__main__":
+    arguments = docopt(
+        __doc__,
+        version='1.0.0')
+
+    if arguments["ingest"]:
+        if arguments["--projection"] is not None:
+            seqclass_names = load_projection_artifact(
+                arguments["--projection"])['seqclass_names']
+        else:
+            seqclass_names = get_targets(
+                os.path.join("./model", "seqclass.names"))
+        store = ResultsStore(arguments["<store-dir>"],
+                             seqclass_names=seqclass_names)
+        n_variants = store.ingest(arguments["<scores>"],
+                                  arguments["<row-labels>"],
+                                  run=arguments["--run"])
+        print("Ingested {0} variants into '{1}'".format(
+            n_variants, arguments["<store-dir>"]))
+    elif arguments["compact"]:
+        store = ResultsStore(arguments["<store-dir>"])
+        n_segments = store.compact()
+        print("Merged {0} segments of '{1}'".format(
+            n_segments, arguments["<store-dir>"]))
+    else:
+        chrom, start, end = None, None, None
+        if arguments["--region"] is not None:
+            chrom, start, end = _parse_region(arguments["--region"])
+        seqclass = arguments["--class"]
+        if seqclass is not None and seqclass.isdigit():
+            seqclass = int(seqclass)
+        min_abs_score = arguments["--min-abs-score"]
+        if min_abs_score is not None:
+            min_abs_score = float(min_abs_score)
+            if min_abs_score < 0:
+                raise ValueError(
+                    "--min-abs-score=<t> must be non-negative")
+        top_k = arguments["--top-k"]
+        if top_k is not None:
+            top_k = int(top_k)
+            if top_k < 1:
+                raise ValueError("--top-k=<k> must be a positive integer")
+
+        store = ResultsStore(arguments["<store-dir>"])
+        results = store.query(name=arguments["--id"],
+                              chrom=chrom,
+                              start=start,
+                              end=end,
+                              seqclass=seqclass,
+                              min_abs_score=min_abs_score,
+                              top_k=top_k)
+        results.to_csv(arguments["--output"] or sys.stdout,
+                       sep='\t', index=False, float_format='%.6g')
+    store.close()
@@ -0,0 +1,322 @@
+"""
+Description:
+    Benchmarks the prediction and scoring code paths on synthetic data of
+    realistic shape, using a randomly initialized Sei model so that no
+    downloads are needed:
+
+    * forward: `Sei.forward` throughput for each batch size and thread count,
+      and with --fuse also of the model fused by `Sei.fuse_for_inference`
+    * spline: the `bs`/`spline_factory` basis used by the spline layer
+    * projection: `sc_projection` of chromatin profile predictions
+    * varianteffect: `sc_hnorm_varianteffect` of ref/alt predictions
+    * tsv: `write_to_tsv` of the variant effect TSVs
+
+    The timings are written to a JSON file. With --baseline, each benchmark
+    is compared to the same benchmark (same parameters) in a previous
+    results file, and the script exits with status 1 if any is slower than
+    the baseline by more than --tolerance.
+
+Usage:
+    benchmark.py [--output=<json>] [--baseline=<json>] [--update-baseline]
+                 [--tolerance=<f>] [--only=<names>] [--batch-sizes=<list>]
+                 [--threads=<list>] [--n-features=<n>] [--n-variants=<n>]
+                 [--repeats=<n>] [--cuda] [--fuse]
+    benchmark.py -h | --help
+
+Options:
+    -h --help               Show this screen.
+    --output=<json>         Results file. [default: benchmark_results.json]
+    --baseline=<json>       A results file of a previous run to compare to.
+    --update-baseline       Write the results to the --baseline file after
+                            comparing.
+    --tolerance=<f>         Flag a benchmark as a regression when its median
+                            time is more than (1 + <f>) times the baseline.
+                            [default: 0.2]
+    --only=<names>          Comma-separated benchmarks to run, from forward,
+                            spline, projection, varianteffect and tsv.
+                            Defaults to all of them.
+    --batch-sizes=<list>    Comma-separated batch sizes for the forward
+                            benchmark. [default: 1,8,32]
+    --threads=<list>        Comma-separated PyTorch thread counts for the
+                            forward benchmark. Defaults to 1 and the number
+                            of CPUs.
+    --n-features=<n>        Number of chromatin profiles, i.e. the outputs of
+                            the model. The full model needs about 4 GB of
+                            memory. [default: 21907]
+    --n-variants=<n>        Number of synthetic variants (rows) for the
+                            projection, variant effect and TSV benchmarks.
+                            [default: 2000]
+    --repeats=<n>           Number of timed repeats of each benchmark, after
+                            one warm-up run. Fast benchmarks are called
+                            several times per repeat. [default: 5]
+    --cuda                  Run the forward benchmark on a CUDA-enabled GPU.
+    --fuse                  Also run the forward benchmark on a copy of the
+                            model fused by `Sei.fuse_for_inference`, to
+                            compare their throughput.
+
+"""
+import copy
+import json
+import os
+import platform
+import tempfile
+import time
+
+from docopt import docopt
+import numpy as np
+import pandas as pd
+import torch
+
+from model.sei import Sei, bs, spline_factory
+from utils import sc_hnorm_varianteffect, sc_projection, write_to_tsv
+
+
+BENCHMARKS = ['forward', 'spline', 'projection', 'varianteffect', 'tsv']
+N_SEQCLASSES = 40
+SEQUENCE_LENGTH = 4096
+
+
+def _time(fn, repeats, min_sample_s=0.05):
+    """
+    Time `fn` after one warm-up call. Each of the `repeats` samples calls
+    `fn` enough times to take at least `min_sample_s`, so that fast
+    functions are not dominated by timer noise, and reports the time per
+    call.
+    """
+    start = time.perf_counter()
+    fn()
+    n_calls = max(1, int(min_sample_s / max(time.perf_counter() - start,
+                                             1e-9)))
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(n_calls):
+            fn()
+        times.append((time.perf_counter() - start) / n_calls)
+    return {'median_s': float(np.median(times)),
+            'min_s': float(np.min(times)),
+            'repeats': repeats,
+            'calls_per_repeat': n_calls}
+
+
+def forward_benchmarks(batch_sizes, threads, n_features, use_cuda, fuse):
+    model = Sei(sequence_length=SEQUENCE_LENGTH,
+                n_genomic_features=n_features).eval()
+    device = torch.device('cuda' if use_cuda else 'cpu')
+    model.to(device)
+    models = [(model, {})]
+    if fuse:
+        models.append((copy.deepcopy(model).fuse_for_inference(),
+                       {'fused': True}))
+    rng = np.random.default_rng(0)
+    for n_threads in threads:
+        for batch_size in batch_sizes:
+            bases = rng.integers(0, 4, size=(batch_size, SEQUENCE_LENGTH))
+            x = torch.from_numpy(
+                np.eye(4, dtype=np.float32)[bases].transpose(0, 2, 1).copy())
+            x = x.to(device)
+            for forward_model, fused_params in models:
+
+                def run(forward_model=forward_model):
+                    torch.set_num_threads(n_threads)
+                    with torch.no_grad():
+                        forward_model(x)
+                    if use_cuda:
+                        torch.cuda.synchronize()
+                # `fused` is only set for the fused model, so that the keys
+                # of the original model match earlier results files
+                yield ('forward', dict({'batch_size': batch_size,
+                                        'threads': n_threads,
+                                        'n_features': n_features,
+                                        'cuda': use_cuda}, **fused_params),
+                       run, batch_size)
+    del model, models
+
+
+def spline_benchmarks():
+    spatial_dim = SEQUENCE_LENGTH // 16
+    df = 16
+    for log in [False, True]:
+        yield ('spline_factory', {'n': spatial_dim, 'df': df, 'log': log},
+               lambda log=log: spline_factory(spatial_dim, df, log=log),
+               spatial_dim)
+    x = np.arange(SEQUENCE_LENGTH, dtype=float)
+    yield ('bs', {'n': SEQUENCE_LENGTH, 'df': df},
+           lambda: bs(x, df=df, intercept=True), SEQUENCE_LENGTH)
+
+
+def _synthetic_predictions(n_variants, n_features, seed):
+    rng = np.random.default_rng(seed)
+    return rng.random((n_variants, n_features), dtype=np.float32)
+
+
+def _synthetic_projection(n_features):
+    rng = np.random.default_rng(2)
+    clustervfeat = rng.standard_normal(
+        (N_SEQCLASSES, n_features)).astype(np.float32)
+    histone_inds = np.sort(rng.choice(
+        n_features, size=n_features // 20, replace=False))
+    return clustervfeat, histone_inds
+
+
+def projection_benchmarks(n_variants, n_features):
+    preds = _synthetic_predictions(n_variants, n_features, 0)
+    clustervfeat, _ = _synthetic_projection(n_features)
+    yield ('sc_projection', {'n_variants': n_variants,
+                             'n_features': n_features},
+           lambda: sc_projection(preds, clustervfeat), n_variants)
+
+
+def varianteffect_benchmarks(n_variants, n_features):
+    ref = _synthetic_predictions(n_variants, n_features, 0)
+    alt = _synthetic_predictions(n_variants, n_features, 1)
+    clustervfeat, histone_inds = _synthetic_projection(n_features)
+    yield ('sc_hnorm_varianteffect', {'n_variants': n_variants,
+                                      'n_features': n_features},
+           lambda: sc_hnorm_varianteffect(
+               ref, alt, clustervfeat, histone_inds), n_variants)
+
+
+def tsv_benchmarks(n_variants, n_features):
+    ref = _synthetic_predictions(n_variants, n_features, 0)
+    alt = _synthetic_predictions(n_variants, n_features, 1)
+    clustervfeat, histone_inds = _synthetic_projection(n_features)
+    scores = sc_hnorm_varianteffect(ref, alt, clustervfeat, histone_inds)
+    max_abs_diff = np.abs(scores).max(axis=1)
+    rowlabels = pd.DataFrame({
+        'chrom': 'chr1',
+        'pos': np.arange(n_variants) * 100 + 10000,
+        'name': ['rs{0}'.format(i) for i in range(n_variants)],
+        'ref': 'A',
+        'alt': 'G',
+        'strand': '+',
+        'ref_match': True,
+        'contains_unk': False})
+    chromatin_profiles = ['profile{0}'.format(i) for i in range(n_features)]
+    seqclass_names = ['SC{0}'.format(i) for i in range(N_SEQCLASSES)]
+
+    def run():
+        with tempfile.TemporaryDirectory() as output_dir:
+            write_to_tsv(max_abs_diff,
+                         lambda row_ixs: alt[row_ixs] - ref[row_ixs],
+                         scores,
+                         chromatin_profiles,
+                         seqclass_names,
+                         rowlabels,
+                         os.path.join(output_dir, 'chromatin_profile_diffs.tsv'),
+                         os.path.join(output_dir, 'sequence_class_scores.tsv'))
+    yield ('write_to_tsv', {'n_variants': n_variants,
+                            'n_features': n_features}, run, n_variants)
+
+
+def _key(name, params):
+    return '{0}[{1}]'.format(name, ','.join(
+        '{0}={1}'.format(k, params[k]) for k in sorted(params)))
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare the benchmarks in `results` to the benchmarks with the same
+    name and parameters in `baseline`. Returns the keys of the benchmarks
+    whose median time is more than (1 + `tolerance`) times the baseline.
+    """
+    regressions = []
+    for key, result in results['benchmarks'].items():
+        if key not in baseline['benchmarks']:
+            print("{0}\tnot in the baseline".format(key))
+            continue
+        ratio = result['median_s'] / baseline['benchmarks'][key]['median_s']
+        result['baseline_median_s'] = baseline['benchmarks'][key]['median_s']
+        result['ratio'] = ratio
+        status = 'ok'
+        if ratio > 1 + tolerance:
+            status = 'REGRESSION'
+            regressions.append(key)
+        elif ratio < 1 / (1 + tolerance):
+            status = 'improved'
+        print("{0}\t{1:.2f}x baseline\t{2}".format(key, ratio, status))
+    return regressions
+
+
+if __name__ == "__main__":
+    arguments = docopt(
+        __doc__,
+        version='1.0.0')
+
+    only = BENCHMARKS
+    if arguments["--only"] is not None:
+        only = arguments["--only"].split(',')
+        unknown = [name for name in only if name not in BENCHMARKS]
+        if unknown:
+            raise ValueError("Unknown benchmarks: {0}".format(
+                ', '.join(unknown)))
+    batch_sizes = [int(b) for b in arguments["--batch-sizes"].split(',')]
+    if arguments["--threads"] is not None:
+        threads = [int(t) for t in arguments["--threads"].split(',')]
+    else:
+        threads = sorted({1, os.cpu_count() or 1})
+    n_features = int(arguments["--n-features"])
+    n_variants = int(arguments["--n-variants"])
+    repeats = int(arguments["--repeats"])
+    use_cuda = arguments["--cuda"]
+
+    benchmarks = []
+    if 'forward' in only:
+        benchmarks.append(forward_benchmarks(
+            batch_sizes, threads, n_features, use_cuda, arguments["--fuse"]))
+    if 'spline' in only:
+        benchmarks.append(spline_benchmarks())
+    if 'projection' in only:
+        benchmarks.append(projection_benchmarks(n_variants, n_features))
+    if 'varianteffect' in only:
+        benchmarks.append(varianteffect_benchmarks(n_variants, n_features))
+    if 'tsv' in only:
+        benchmarks.append(tsv_benchmarks(n_variants, n_features))
+
+    default_threads = torch.get_num_threads()
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'torch': torch.__version__,
+            'cuda': torch.cuda.get_device_name() if use_cuda else None,
+        },
+        'benchmarks': {},
+    }
+    for group in benchmarks:
+        for name, params, run, n_items in group:
+            timing = _time(run, repeats)
+            torch.set_num_threads(default_threads)
+            timing['items_per_s'] = n_items / timing['median_s']
+            timing['name'] = name
+            timing['params'] = params
+            key = _key(name, params)
+            results['benchmarks'][key] = timing
+            print("{0}\t{1:.4f} s\t{2:.1f} items/s".format(
+                key, timing['median_s'], timing['items_per_s']))
+
+    regressions = []
+    baseline_file = arguments["--baseline"]
+    if baseline_file is not None and os.path.exists(baseline_file):
+        with open(baseline_file) as file_handle:
+            baseline = json.load(file_handle)
+        print("Comparing to '{0}'".format(baseline_file))
+        regressions = compare(results, baseline, float(arguments["--tolerance"]))
+        results['regressions'] = regressions
+
+    with open(arguments["--output"], 'w') as file_handle:
+        json.dump(results, file_handle, indent=2)
+    print("Wrote benchmark results to '{0}'".format(arguments["--output"]))
+    if baseline_file is not None and arguments["--update-baseline"]:
+        with open(baseline_file, 'w') as file_handle:
+            json.dump(results, file_handle, indent=2)
+        print("Updated baseline '{0}'".format(baseline_file))
+
+    if regressions:
+        print("{0} benchmark(s) slower than the baseline: {1}".format(
+            len(regressions), ', '.join(regressions)))
+        raise SystemExit(1)
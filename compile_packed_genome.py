@@ -0,0 +1,46 @@
+"""
+Description:
+    Packs a reference genome FASTA file into a memory-mapped file of 2-bit
+    bases and a 1-bit unknown base mask, which the `1_*` scripts read in
+    place of the FASTA file (see `PackedGenome`). A genome packed to
+    `resources/<hg>_UCSC.packed.bin` is used automatically by
+    `--genome=<hg>`.
+
+Usage:
+    compile_packed_genome.py [<fasta>] [--genome=<hg>] [--output=<file>]
+    compile_packed_genome.py -h | --help
+
+Options:
+    -h --help               Show this screen.
+    <fasta>                 The indexed FASTA file to pack. Defaults to
+                            `resources/<hg>_UCSC.fa`.
+    --genome=<hg>           hg38 or hg19 [default: hg19]
+    --output=<file>         Output path. Defaults to the FASTA file path
+                            with the `.fa` or `.fasta` extension replaced
+                            by `.packed.bin`.
+
+"""
+import os
+
+from docopt import docopt
+
+from utils import compile_packed_genome
+
+
+if __name__ == "__main__":
+    arguments = docopt(
+        __doc__,
+        version='1.0.0')
+    fasta_file = arguments['<fasta>']
+    if fasta_file is None:
+        hg_version = arguments['--genome']
+        if hg_version != 'hg38' and hg_version != 'hg19':
+            raise ValueError("--genome=<hg> must be 'hg19' or 'hg38'")
+        fasta_file = os.path.join(
+            '.', 'resources', '{0}_UCSC.fa'.format(hg_version))
+    output_file = arguments['--output']
+    if output_file is None:
+        output_file = '{0}.packed.bin'.format(os.path.splitext(fasta_file)[0])
+
+    compile_packed_genome(fasta_file, output_file)
+    print("Wrote packed genome to '{0}'".format(output_file))
@@ -0,0 +1,46 @@
+"""
+Description:
+    Compiles the files used to compute sequence class scores (the
+    chromatin profile and sequence class names, `projvec_targets.npy` and
+    `histone_inds.npy`) into a single memory-mappable artifact. Pass the
+    artifact to the `2_*` scripts with `--projection=<artifact>` so that
+    each run opens it directly instead of re-reading and normalizing the
+    source files.
+
+Usage:
+    compile_projection.py [--sei-dir=<dir>] [--output=<file>] [--force]
+    compile_projection.py -h | --help
+
+Options:
+    -h --help               Show this screen.
+    --sei-dir=<dir>         Directory containing the Sei model files
+                            [default: ./model]
+    --output=<file>         Output artifact path
+                            [default: ./model/sei_projection.bin]
+    --force                 Recompile even if the existing artifact matches
+                            the checksums of the source files.
+
+"""
+import os
+
+from docopt import docopt
+
+from utils import compile_projection_artifact, load_projection_artifact
+from utils import projection_artifact_is_current
+
+
+if __name__ == "__main__":
+    arguments = docopt(
+        __doc__,
+        version='1.0.0')
+    sei_dir = arguments['--sei-dir']
+    output_file = arguments['--output']
+
+    if os.path.exists(output_file) and not arguments['--force']:
+        if projection_artifact_is_current(
+                load_projection_artifact(output_file), sei_dir):
+            print("'{0}' is up to date with '{1}'".format(output_file, sei_dir))
+            raise SystemExit(0)
+
+    compile_projection_artifact(sei_dir, output_file)
+    print("Wrote projection artifact to '{0}'".format(output_file))
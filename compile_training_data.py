@@ -0,0 +1,100 @@
+"""
+Description:
+    Materializes the training, validation and test samples of a Sei
+    training config into memory-mapped shards of 2-bit sequences and
+    bit-packed targets (see `train_utils.compile_training_data`), which
+    `train_utils.MaterializedSampler` reads in place of
+    `RandomPositionsSampler` (see `train/train_materialized.yml`). The
+    target file, features, reference genome, blacklist, holdout
+    chromosomes, sequence length and center bin are read from the
+    `validate_sampler` of the config, with its paths relative to the
+    config file.
+
+Usage:
+    compile_training_data.py <config> <output-dir> [--genome=<path>]
+                             [--train-samples=<n>] [--validate-samples=<n>]
+                             [--test-samples=<n>] [--shard-size=<n>]
+                             [--seed=<seed>]
+    compile_training_data.py -h | --help
+
+Options:
+    -h --help                   Show this screen.
+    <config>                    The training config, e.g. `train/train.yml`.
+    <output-dir>                Output directory.
+    --genome=<path>             A FASTA file or a genome packed by
+                                `compile_packed_genome.py` to read in place
+                                of the reference genome of the config. A
+                                packed genome is much faster to sample from.
+    --train-samples=<n>         Number of training samples. [default: 3200000]
+    --validate-samples=<n>      Number of validation samples. Defaults to the
+                                `n_validation_samples` of the config.
+    --test-samples=<n>          Number of test samples. [default: 0]
+    --shard-size=<n>            Number of samples per shard. [default: 65536]
+    --seed=<seed>               Random seed of the sampled positions and
+                                strands. [default: 436]
+
+"""
+import os
+
+from docopt import docopt
+
+from selene_sdk.sequences import Genome
+from selene_sdk.utils import load_features_list, load_path
+
+from predict_utils import PackedGenome, is_packed_genome
+from train_utils import compile_training_data
+
+
+def _config_path(config_dir, path):
+    return os.path.normpath(os.path.join(config_dir, path))
+
+
+if __name__ == "__main__":
+    arguments = docopt(
+        __doc__,
+        version='1.0.0')
+
+    config_dir = os.path.dirname(os.path.abspath(arguments["<config>"]))
+    configs = load_path(arguments["<config>"], instantiate=False)
+    sampler = configs["sampler"].keywords["validate_sampler"].keywords
+    genome = sampler["reference_sequence"].keywords
+
+    genome_path = arguments["--genome"]
+    if genome_path is None:
+        genome_path = _config_path(config_dir, genome["input_path"])
+    blacklist_regions = genome.get("blacklist_regions")
+    if blacklist_regions not in (None, "hg19", "hg38"):
+        blacklist_regions = _config_path(config_dir, blacklist_regions)
+    if is_packed_genome(genome_path):
+        reference_sequence = PackedGenome(
+            genome_path, blacklist_regions=blacklist_regions)
+    else:
+        reference_sequence = Genome(
+            genome_path, blacklist_regions=blacklist_regions)
+    features = load_features_list(
+        _config_path(config_dir, sampler["features"].keywords["input_path"]))
+
+    n_validate = arguments["--validate-samples"]
+    if n_validate is None:
+        n_validate = configs["train_model"].keywords["n_validation_samples"]
+    n_samples = {'train': int(arguments["--train-samples"]),
+                 'validate': int(n_validate),
+                 'test': int(arguments["--test-samples"])}
+
+    compile_training_data(
+        reference_sequence,
+        _config_path(config_dir, sampler["target_path"]),
+        features,
+        arguments["<output-dir>"],
+        n_samples,
+        sequence_length=sampler.get("sequence_length", 1000),
+        center_bin_to_predict=sampler.get("center_bin_to_predict", 200),
+        validation_holdout=sampler.get("validation_holdout", ['chr6', 'chr7']),
+        test_holdout=sampler.get("test_holdout", ['chr8', 'chr9']),
+        exclude_chrs=sampler.get("exclude_chrs", ['_']),
+        shard_size=int(arguments["--shard-size"]),
+        seed=int(arguments["--seed"]))
+    print("Wrote {0} to '{1}'".format(
+        ', '.join('{0} {1} samples'.format(n, mode)
+                  for mode, n in n_samples.items() if n),
+        arguments["<output-dir>"]))
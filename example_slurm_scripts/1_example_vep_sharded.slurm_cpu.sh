@@ -0,0 +1,23 @@
+#!/bin/bash
+#SBATCH --time=1-00:00:00
+#SBATCH --partition=ccb
+#SBATCH --array=0-9
+#SBATCH -n 1
+#SBATCH --cpus-per-task=8
+#SBATCH --mem 32G
+
+# Example SLURM array script for running Sei variant effect prediction
+# on CPU nodes, with each array task predicting one shard of the input
+# VCF file. Submit it and then merge the shards into
+# <outdir>/chromatin-profiles-hdf5 once every task has finished:
+#
+#   jobid=$(sbatch --parsable 1_example_vep_sharded.slurm_cpu.sh <vcf> <hg> <outdir>)
+#   sbatch --dependency=afterok:$jobid --wrap "python merge_shards.py <outdir>"
+
+vcf_filepath="${1:-}"  # path to vcf file
+hg_version="${2:-}"    # hg19 or hg38
+outdir="${3:-}"        # path to output dir
+
+python -u 1_variant_effect_prediction.py $vcf_filepath $outdir \
+    --genome=${hg_version} \
+    --shard=${SLURM_ARRAY_TASK_ID}/${SLURM_ARRAY_TASK_COUNT}
@@ -0,0 +1,31 @@
+"""
+Description:
+    Merges the outputs of `1_sequence_prediction.py` or
+    `1_variant_effect_prediction.py` run with `--shard=<i/n>` for every
+    shard into `<output-dir>`, in the order of the original input, as if
+    the input had been run in one process.
+
+Usage:
+    merge_shards.py <output-dir> [--keep-shards]
+    merge_shards.py -h | --help
+
+Options:
+    -h --help               Show this screen.
+    <output-dir>            The <output-dir> passed to the `1_*` script.
+                            The shards are read from `<output-dir>/shards/`.
+    --keep-shards           Do not delete `<output-dir>/shards/` after
+                            merging.
+
+"""
+from docopt import docopt
+
+from predict_utils import merge_shards
+
+
+if __name__ == "__main__":
+    arguments = docopt(
+        __doc__,
+        version='1.0.0')
+    merge_shards(arguments["<output-dir>"],
+                 keep_shards=arguments["--keep-shards"])
+    print("Merged the shards in '{0}'".format(arguments["<output-dir>"]))
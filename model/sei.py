@@ -8,7 +8,38 @@ import torch.nn as nn
 
 
 import numpy as np
-from scipy.interpolate import splev
+
+
+def _bspline_basis(x, knots, degree):
+    """
+    Evaluate every B-spline basis function defined by `knots` at `x` at
+    once with the Cox-de Boor recursion. Matches evaluating each basis
+    function separately with `scipy.interpolate.splev`, including at the
+    right boundary knot.
+    """
+    x = np.asarray(x, dtype=float)
+    knots = np.asarray(knots, dtype=float)
+
+    # degree 0: indicator of the knot interval [t_i, t_{i+1}) containing x,
+    # with the last boundary included in the last non-empty interval
+    interval = np.searchsorted(knots, x, side='right') - 1
+    last_interval = np.nonzero(knots[1:] > knots[:-1])[0][-1]
+    interval = np.clip(interval, 0, last_interval)
+    basis = np.zeros((x.shape[0], len(knots) - 1))
+    basis[np.arange(x.shape[0]), interval] = 1.
+
+    x = x[:, None]
+    for k in range(1, degree + 1):
+        left_den = knots[k:-1] - knots[:-k - 1]
+        right_den = knots[k + 1:] - knots[1:-k]
+        left = np.divide(x - knots[:-k - 1], left_den,
+                         out=np.zeros((x.shape[0], len(left_den))),
+                         where=left_den > 0)
+        right = np.divide(knots[k + 1:] - x, right_den,
+                          out=np.zeros((x.shape[0], len(right_den))),
+                          where=right_den > 0)
+        basis = left * basis[:, :-1] + right * basis[:, 1:]
+    return basis
 
 
 def bs(x, df=None, knots=None, degree=3, intercept=False):
@@ -52,13 +83,7 @@ def bs(x, df=None, knots=None, degree=3, intercept=False):
 
     all_knots.sort()
 
-    n_basis = len(all_knots) - (degree + 1)
-    basis = np.empty((x.shape[0], n_basis), dtype=float)
-
-    for i in range(n_basis):
-        coefs = np.zeros((n_basis,))
-        coefs[i] = 1
-        basis[:, i] = splev(x, (all_knots, coefs, degree))
+    basis = _bspline_basis(x, all_knots, degree)
 
     if not intercept:
         basis = basis[:, 1:]
@@ -82,23 +107,39 @@ def spline_factory(n, df, log=False):
 
 class BSplineTransformation(nn.Module):
 
-    def __init__(self, degrees_of_freedom, log=False, scaled=False):
+    def __init__(self, degrees_of_freedom, log=False, scaled=False, spatial_dim=None):
+        """
+        Parameters
+        ----------
+        degrees_of_freedom : int
+        log : bool
+        scaled : bool
+        spatial_dim : int or None
+            The length of the input's last dimension, if known. The spline
+            matrix is then built here rather than on the first `forward`.
+        """
         super(BSplineTransformation, self).__init__()
-        self._spline_tr = None
         self._log = log
         self._scaled = scaled
         self._df = degrees_of_freedom
+        # not persistent, so state dicts saved before this was a buffer
+        # still load; as a buffer it follows the module's device and dtype
+        spline_tr = None
+        if spatial_dim is not None:
+            spline_tr = self._spline_factory(spatial_dim)
+        self.register_buffer('_spline_tr', spline_tr, persistent=False)
+
+    def _spline_factory(self, spatial_dim):
+        spline_tr = spline_factory(spatial_dim, self._df, log=self._log)
+        if self._scaled:
+            spline_tr = spline_tr / spatial_dim
+        return spline_tr
 
     def forward(self, input):
-        if self._spline_tr is None:
-            spatial_dim = input.size()[-1]
-            self._spline_tr = spline_factory(spatial_dim, self._df, log=self._log)
-            if self._scaled:
-                self._spline_tr = self._spline_tr / spatial_dim
-            if input.is_cuda:
-                self._spline_tr = self._spline_tr.cuda()
-        
-        return  torch.matmul(input, self._spline_tr)
+        spatial_dim = input.size()[-1]
+        if self._spline_tr is None or self._spline_tr.size(0) != spatial_dim:
+            self._spline_tr = self._spline_factory(spatial_dim).to(input)
+        return torch.matmul(input, self._spline_tr)
 
 
 
@@ -128,6 +169,60 @@ class BSplineConv1D(nn.Module):
         return conv1d_out
 
 
+class FusedLinearConv1d(nn.Module):
+    """
+    Two `nn.Conv1d` layers applied back to back with no nonlinearity,
+    merged into one convolution with a wider kernel. Used by
+    `Sei.fuse_for_inference`.
+
+    The merged convolution zero-pads the input, whereas the second of
+    the original convolutions zero-pads the output of the first, so the
+    outputs within `padding` positions of either end are recomputed with
+    the original pair.
+    """
+
+    def __init__(self, conv_a, conv_b):
+        super(FusedLinearConv1d, self).__init__()
+        for conv in (conv_a, conv_b):
+            if conv.stride != (1,) or conv.dilation != (1,) or conv.groups != 1:
+                raise ValueError("Only stride 1, undilated, ungrouped "
+                                 "convolutions can be merged")
+        k_a, k_b = conv_a.kernel_size[0], conv_b.kernel_size[0]
+        w_a, w_b = conv_a.weight.data, conv_b.weight.data
+        weight = w_a.new_zeros(
+            (w_b.size(0), w_a.size(1), k_a + k_b - 1))
+        for i in range(k_a):
+            for j in range(k_b):
+                weight[:, :, i + j] += torch.matmul(w_b[:, :, j], w_a[:, :, i])
+        bias = w_a.new_zeros(w_b.size(0))
+        if conv_a.bias is not None:
+            bias += torch.matmul(w_b.sum(dim=2), conv_a.bias.data)
+        if conv_b.bias is not None:
+            bias += conv_b.bias.data
+
+        self.conv = nn.Conv1d(w_a.size(1), w_b.size(0), k_a + k_b - 1,
+                              padding=conv_a.padding[0] + conv_b.padding[0]).to(w_a)
+        self.conv.weight.data.copy_(weight)
+        self.conv.bias.data.copy_(bias)
+        self.edge = nn.Sequential(conv_a, conv_b)
+        self._edge_len = conv_b.padding[0]
+        # input length needed to reproduce the `_edge_len` outputs at one end
+        self._edge_input_len = 2 * conv_b.padding[0] + conv_a.padding[0]
+
+    def forward(self, input):
+        length = input.size(-1)
+        if self._edge_len == 0:
+            return self.conv(input)
+        if length <= 2 * self._edge_input_len:
+            return self.edge(input)
+        out = self.conv(input)
+        out[..., :self._edge_len] = self.edge(
+            input[..., :self._edge_input_len])[..., :self._edge_len]
+        out[..., -self._edge_len:] = self.edge(
+            input[..., -self._edge_input_len:])[..., -self._edge_len:]
+        return out
+
+
 class Sei(nn.Module):
     def __init__(self, sequence_length=4096, n_genomic_features=21907):
         """
@@ -198,7 +293,8 @@ class Sei(nn.Module):
         self._spline_df = int(128/8)        
         self.spline_tr = nn.Sequential(
             nn.Dropout(p=0.5),
-            BSplineTransformation(self._spline_df, scaled=False))
+            BSplineTransformation(self._spline_df, scaled=False,
+                                  spatial_dim=sequence_length // 16))
 
         self.classifier = nn.Sequential(
             nn.Linear(960 * self._spline_df, n_genomic_features),
@@ -208,18 +304,18 @@ class Sei(nn.Module):
 
 
 
-    def forward(self, x):
-        """Forward propagation of a batch.
+    def conv_stage(self, lconv, conv, x):
+        """Run one of the `lconv1`/`conv1`, `lconv2`/`conv2` or
+        `lconv3`/`conv3` blocks, returning `(out, lout)`.
         """
-        lout1 = self.lconv1(x)
-        out1 = self.conv1(lout1)
-
-        lout2 = self.lconv2(out1 + lout1)
-        out2 = self.conv2(lout2)
-
-        lout3 = self.lconv3(out2 + lout2)
-        out3 = self.conv3(lout3)
+        lout = lconv(x)
+        out = conv(lout)
+        return out, lout
 
+    def dconv_stage(self, out3, lout3):
+        """Run the dilated convolutions on the outputs of `conv3` and
+        `lconv3`. This is the last layer that is applied at every position.
+        """
         dconv_out1 = self.dconv1(out3 + lout3)
         cat_out1 = out3 + dconv_out1
         dconv_out2 = self.dconv2(cat_out1)
@@ -230,12 +326,70 @@ class Sei(nn.Module):
         cat_out4 = cat_out3 + dconv_out4
         dconv_out5 = self.dconv5(cat_out4)
         out = cat_out4 + dconv_out5
-        
+        return out
+
+    def classify(self, out):
+        """Run the spline and classifier on the output of `dconv_stage`.
+        """
         spline_out = self.spline_tr(out)
         reshape_out = spline_out.view(spline_out.size(0), 960 * self._spline_df)
         predict = self.classifier(reshape_out)
         return predict
 
+    def head(self, out3, lout3):
+        """Run the dilated convolutions, spline and classifier on the
+        outputs of `conv3` and `lconv3`.
+        """
+        return self.classify(self.dconv_stage(out3, lout3))
+
+    def forward(self, x):
+        """Forward propagation of a batch.
+        """
+        out1, lout1 = self.conv_stage(self.lconv1, self.conv1, x)
+        out2, lout2 = self.conv_stage(self.lconv2, self.conv2, out1 + lout1)
+        out3, lout3 = self.conv_stage(self.lconv3, self.conv3, out2 + lout2)
+        return self.head(out3, lout3)
+
+    def select_targets(self, target_ixs):
+        """
+        Keep only the outputs `target_ixs` of the final classifier layer, in
+        place. Every other layer is shared by all targets, so predictions
+        for the kept targets are unchanged.
+        """
+        last = self.classifier[2]
+        target_ixs = torch.as_tensor(
+            target_ixs, dtype=torch.long, device=last.weight.device)
+        selected = nn.Linear(last.in_features, len(target_ixs)).to(last.weight)
+        selected.weight.data.copy_(last.weight.data[target_ixs])
+        selected.bias.data.copy_(last.bias.data[target_ixs])
+        self.classifier[2] = selected
+        return self
+
+    def fuse_for_inference(self):
+        """
+        Rewrite the network for inference, in place: each pair of
+        convolutions in `lconv1`, `lconv2` and `lconv3` is merged into a
+        single convolution and dropout layers are removed. The outputs are
+        unchanged up to floating point rounding. Load the trained weights
+        before calling this; the fused model is not meant to be trained.
+
+        The spline transformation is not folded into the first classifier
+        layer: that would replace the 15,360-input layer with a
+        245,760-input one, which is slower and 16x larger.
+        """
+        self.eval()
+        for name in ['lconv1', 'lconv2', 'lconv3']:
+            block = getattr(self, name)
+            layers = [m for m in block if not isinstance(m, nn.Dropout)]
+            setattr(self, name, nn.Sequential(
+                *layers[:-2], FusedLinearConv1d(layers[-2], layers[-1])))
+        for name in ['conv2', 'conv3', 'dconv1', 'dconv2', 'dconv3',
+                     'dconv4', 'dconv5', 'spline_tr']:
+            block = getattr(self, name)
+            setattr(self, name, nn.Sequential(
+                *[m for m in block if not isinstance(m, nn.Dropout)]))
+        return self
+
 def criterion():
     """
     The criterion the model aims to minimize.
@@ -0,0 +1,2565 @@
+"""
+Selene extensions used by the `1_*` prediction scripts.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import hashlib
+import inspect
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import sqlite3
+import threading
+import time
+import warnings
+
+import h5py
+import numpy as np
+import pkg_resources
+import tabix
+import torch
+import torch.nn as nn
+from selene_sdk.predict import AnalyzeSequences
+from selene_sdk.predict._common import get_reverse_complement_encoding
+from selene_sdk.predict._common import predict
+from selene_sdk.predict._variant_effect_prediction import _handle_long_ref
+from selene_sdk.predict._variant_effect_prediction import _handle_standard_ref
+from selene_sdk.predict._variant_effect_prediction import _process_alt
+from selene_sdk.predict._variant_effect_prediction import read_vcf_file
+from selene_sdk.predict.model_predict import VARIANTEFFECT_COLS
+from selene_sdk.predict.predict_handlers import AbsDiffScoreHandler
+from selene_sdk.predict.predict_handlers import DiffScoreHandler
+from selene_sdk.predict.predict_handlers import PredictionsHandler
+from selene_sdk.predict.predict_handlers import WritePredictionsHandler
+from selene_sdk.sequences import Genome
+from selene_sdk.sequences.genome import _check_coords
+from selene_sdk.utils import NonStrandSpecific
+from selene_sdk.utils import initialize_model
+from selene_sdk.utils import instantiate
+
+from utils import COMPACT_DTYPES, create_compact_dataset, encode_compact
+from utils import get_projection, get_targets, is_packed_genome
+from utils import load_packed_genome, load_projection_artifact
+from utils import Profiler, profile_stage, sc_projection
+from utils import sc_hnorm_varianteffect_fused, sha256_file
+
+
+class SequenceClassHandler(PredictionsHandler):
+    """
+    Projects each batch of chromatin profile predictions onto the sequence
+    classes as it arrives, so only the N x 40 raw sequence class scores
+    (and the row labels) are written to file.
+
+    Parameters
+    ----------
+    projvec : numpy.ndarray
+        The unit-length sequence class vectors, one row per sequence class.
+    seqclass_names : list(str)
+        The sequence class names, in the same order as `projvec`.
+
+    See `selene_sdk.predict.predict_handlers.PredictionsHandler` for the
+    remaining parameters.
+    """
+
+    def __init__(self,
+                 projvec,
+                 seqclass_names,
+                 columns_for_ids,
+                 output_path_prefix,
+                 output_format,
+                 output_size=None,
+                 write_mem_limit=1500,
+                 write_labels=True):
+        super(SequenceClassHandler, self).__init__(
+            seqclass_names,
+            columns_for_ids,
+            output_path_prefix,
+            output_format,
+            output_size=output_size,
+            write_mem_limit=write_mem_limit,
+            write_labels=write_labels)
+        self._projvec = projvec
+        self._create_write_handler("raw_sequence_class_scores")
+
+    def handle_batch_predictions(self,
+                                 batch_predictions,
+                                 batch_ids):
+        # Selene writes predictions as float64, so project in float64 to
+        # match scoring the written predictions with `2_raw_sc_score.py`
+        self._results.append(sc_projection(
+            batch_predictions.astype(np.float64), self._projvec,
+            normalized=True))
+        self._samples.append(batch_ids)
+        if self._reached_mem_limit():
+            self.write_to_file()
+
+
+class SequenceClassVariantEffectHandler(PredictionsHandler):
+    """
+    Computes the histone-normalized alt - ref sequence class scores for
+    each batch of ref/alt chromatin profile predictions as it arrives, so
+    only the N x 40 variant effect scores (and the row labels) are written
+    to file.
+
+    Parameters
+    ----------
+    hnorm_projvec : numpy.ndarray
+        The output of `utils.sc_hnorm_projection_matrix`.
+    seqclass_names : list(str)
+        The sequence class names.
+
+    See `selene_sdk.predict.predict_handlers.PredictionsHandler` for the
+    remaining parameters.
+    """
+
+    def __init__(self,
+                 hnorm_projvec,
+                 seqclass_names,
+                 columns_for_ids,
+                 output_path_prefix,
+                 output_format,
+                 output_size=None,
+                 write_mem_limit=1500,
+                 write_labels=True):
+        super(SequenceClassVariantEffectHandler, self).__init__(
+            seqclass_names,
+            columns_for_ids,
+            output_path_prefix,
+            output_format,
+            output_size=output_size,
+            write_mem_limit=write_mem_limit,
+            write_labels=write_labels)
+        self.needs_base_pred = True
+        self._hnorm_projvec = hnorm_projvec
+        self._create_write_handler("sequence_class_scores")
+
+    def handle_batch_predictions(self,
+                                 batch_predictions,
+                                 batch_ids,
+                                 base_predictions):
+        # alt - ref cancels most of the projection, so compute it in
+        # float64 as `2_varianteffect_sc_score.py` does on the written
+        # (float64) predictions
+        self._results.append(sc_hnorm_varianteffect_fused(
+            base_predictions.astype(np.float64),
+            batch_predictions.astype(np.float64),
+            self._hnorm_projvec))
+        self._samples.append(batch_ids)
+        if self._reached_mem_limit():
+            self.write_to_file()
+
+
+def use_compact_hdf5(handler, dtype):
+    """
+    Make a Selene `PredictionsHandler` with HDF5 output store its "data"
+    dataset with `utils.create_compact_dataset` in `dtype`, encoding each
+    block of results with `utils.encode_compact` as it is written. The
+    'uint8' value range is [0, 1] for predictions and absolute diffs and
+    [-1, 1] for diffs. A `WriteRefAltHandler` is handled through its ref
+    and alt writers.
+    """
+    writers = [getattr(handler, name) for name in ['_ref_writer', '_alt_writer']
+               if hasattr(handler, name)]
+    if writers:
+        for writer in writers:
+            use_compact_hdf5(writer, dtype)
+        return
+    value_range = None
+    if isinstance(handler, (WritePredictionsHandler, AbsDiffScoreHandler)):
+        value_range = (0, 1)
+    elif isinstance(handler, DiffScoreHandler):
+        value_range = (-1, 1)
+    with h5py.File(handler._output_filepath, 'w') as file_handle:
+        data = create_compact_dataset(
+            file_handle, (handler._output_size, len(handler._features)),
+            dtype, value_range=value_range)
+        attrs = dict(data.attrs)
+    write_to_file = handler.write_to_file
+
+    def compact_write_to_file():
+        handler._results = [encode_compact(results, dtype, attrs)
+                            for results in handler._results]
+        write_to_file()
+
+    handler.write_to_file = compact_write_to_file
+
+
+def _output_writers(handler):
+    """
+    The handlers that buffer and write the results of a Selene
+    `PredictionsHandler`: the ref and alt writers of a
+    `WriteRefAltHandler`, otherwise the handler itself.
+    """
+    writers = [getattr(handler, name) for name in ['_ref_writer', '_alt_writer']
+               if hasattr(handler, name)]
+    return writers or [handler]
+
+
+class SeiAnalyzeSequences(AnalyzeSequences):
+    """
+    `AnalyzeSequences` with an optional sequence-class-only output mode.
+
+    Parameters
+    ----------
+    seqclass_projection : str or None, optional
+        Default is None. Either the Sei model directory (containing
+        `projvec_targets.npy`, `histone_inds.npy` and the names files) or a
+        projection artifact compiled by `compile_projection.py`. If
+        specified, the chromatin profile predictions are projected onto the
+        sequence classes batch by batch and only the sequence class scores
+        are written, in place of the chromatin profile predictions.
+    fuse_for_inference : bool, optional
+        Default is False. Whether to apply `Sei.fuse_for_inference` to the
+        model once the trained weights are loaded.
+    precision : {'fp32', 'bf16', 'int8'}, optional
+        Default is 'fp32'. See `set_precision`.
+    targets : str or None, optional
+        Default is None. A file listing a subset of `features`, one per
+        line. Only these targets are predicted (see `Sei.select_targets`)
+        and written, in the order given, and the list is written next to
+        the row labels as `<prefix>_target_names.txt`.
+    incremental : bool, optional
+        Default is False. Whether to run the `Sei` module in an
+        `IncrementalSei` engine, which computes the alt predictions of
+        variant effect prediction from the cached ref activations. The
+        measured saving is printed after `variant_effect_prediction`.
+    batch_strands : bool, optional
+        Default is False. Whether to replace the model's
+        `NonStrandSpecific` wrapper with `BatchedNonStrandSpecific`, which
+        predicts both strands in one forward pass.
+    ref_cache : str or None, optional
+        Default is None. A directory for a `RefPredictionCache` of the ref
+        predictions of variant effect prediction, shared across runs.
+        Only the ref sequences not already in the cache are predicted.
+    ref_cache_size : float, optional
+        Default is 10. The size cap of `ref_cache`, in GB.
+    genome_build : str or None, optional
+        Default is None. The genome build that `ref_cache` entries are
+        keyed on, e.g. 'hg19'. Defaults to the reference sequence file
+        name.
+    output_dtype : {'float16', 'uint8'} or None, optional
+        Default is None (Selene's float64). Write the HDF5 outputs in this
+        dtype with `use_compact_hdf5`. 'uint8' is only supported for
+        predictions and (absolute) diffs, whose range is known.
+    autotune : bool, optional
+        Default is False. Whether to replace `batch_size` with the result
+        of `autotune_batch_size` for this machine, and the
+        `write_mem_limit` of each output handler with the result of
+        `autotune_write_mem_limit` when the handlers are created, for the
+        memory left by the activation budget of the batch size, the number
+        of handlers and `n_processes`. The chosen values are printed, kept
+        in the `autotune_report` attribute and added to the `profile`
+        telemetry.
+    profile : str or None, optional
+        Default is None. A JSON-lines file to append `utils.Profiler`
+        telemetry to: the latency of the model, of each block of `Sei`
+        (`attach_profiler`), of the reference sequence fetches and of the
+        output handlers and writes, the sequences/s and the peak memory.
+        The profiler is the `profiler` attribute.
+    pipeline : bool, optional
+        Default is False. Whether `variant_effect_prediction` runs its
+        batches through `run_pipeline`: the ref and alt windows are
+        fetched and encoded in `fetch_workers` threads and the outputs
+        are handled and written in a background thread while the model
+        predicts, in input order. The outputs are the same as without it.
+        With `use_cuda`, the encodings are pinned and copied to the GPU
+        asynchronously (except with `ref_cache`).
+    fetch_workers : int or None, optional
+        Default is None. The number of `pipeline` fetch threads, at least
+        1 and only set with `pipeline`. Defaults to 1 for a FASTA
+        reference sequence, whose file handle is shared, and to up to 4
+        for a `PackedGenome`.
+    n_processes : int, optional
+        Default is 1. The number of processes predicting with this object
+        at the same time (e.g. `run_shards_in_workers` workers), which
+        share the memory that `autotune` sizes the output handlers from.
+
+    See `selene_sdk.predict.AnalyzeSequences` for the remaining parameters.
+    """
+
+    def __init__(self,
+                 *args,
+                 seqclass_projection=None,
+                 fuse_for_inference=False,
+                 precision='fp32',
+                 targets=None,
+                 incremental=False,
+                 batch_strands=False,
+                 ref_cache=None,
+                 ref_cache_size=10,
+                 genome_build=None,
+                 output_dtype=None,
+                 autotune=False,
+                 profile=None,
+                 pipeline=False,
+                 fetch_workers=None,
+                 n_processes=1,
+                 **kwargs):
+        super(SeiAnalyzeSequences, self).__init__(*args, **kwargs)
+        self._targets_subset = targets is not None
+        if targets is not None:
+            if seqclass_projection is not None:
+                raise ValueError("Sequence class scores require all of the "
+                                 "chromatin profile predictions, so `targets` "
+                                 "cannot be used with `seqclass_projection`")
+            target_ixs = get_target_indices(self.features, get_targets(targets))
+            get_sei(self.model).select_targets(target_ixs)
+            self.features = [self.features[i] for i in target_ixs]
+        if fuse_for_inference:
+            get_sei(self.model).fuse_for_inference()
+        if precision == 'int8' and self.use_cuda:
+            raise ValueError("int8 precision is only supported on CPU")
+        self.model = set_precision(self.model, precision)
+        if batch_strands:
+            for module in self.model.modules():
+                if isinstance(module, NonStrandSpecific):
+                    self.model = replace_module(
+                        self.model, module, BatchedNonStrandSpecific(
+                            module.model, mode=module.mode))
+                    break
+            else:
+                raise ValueError("`batch_strands` requires a model with "
+                                 "`non_strand_specific` set")
+        self.autotune_report = None
+        if autotune:
+            # before the incremental engine, whose cache the calibration
+            # batches would fill
+            self.autotune_report = autotune_batch_size(
+                self.model, self.sequence_length, use_cuda=self.use_cuda)
+            self.batch_size = self.autotune_report['batch_size']
+            print("Auto-tuned batch_size: {0}. Set it in the model YAML "
+                  "config to reproduce this run. Measured sequences/s by "
+                  "batch size: {1}".format(
+                      self.batch_size,
+                      ', '.join("{0}: {1:.3g}".format(batch_size, throughput)
+                                for batch_size, throughput in
+                                self.autotune_report['throughput'].items())))
+        self._n_processes = n_processes
+        self._incremental = None
+        if incremental:
+            if self.data_parallel:
+                raise ValueError("The incremental engine keeps its cache on "
+                                 "one device and cannot be used with "
+                                 "`data_parallel`")
+            sei = get_sei(self.model)
+            self._incremental = IncrementalSei(sei)
+            self.model = replace_module(self.model, sei, self._incremental)
+        self._ref_cache = None
+        if ref_cache is not None:
+            trained_model_path = inspect.signature(AnalyzeSequences).bind(
+                *args, **kwargs).arguments['trained_model_path']
+            if isinstance(trained_model_path, str):
+                trained_model_path = [trained_model_path]
+            model_checksum = hashlib.sha256(json.dumps({
+                'weights': [sha256_file(path) for path in trained_model_path],
+                'wrapper': [type(self.model).__name__,
+                            getattr(self.model, 'mode', None)],
+                'sequence_length': self.sequence_length,
+                'features': list(self.features),
+                'fuse_for_inference': fuse_for_inference,
+                'precision': precision,
+            }, sort_keys=True).encode()).hexdigest()
+            if genome_build is None:
+                genome_build = os.path.basename(
+                    getattr(self.reference_sequence, 'input_path', ''))
+            self._genome_build = genome_build
+            self._ref_cache = RefPredictionCache(
+                ref_cache, model_checksum, len(self.features),
+                max_size=int(ref_cache_size * 1e9))
+        self._seqclass_projection = None
+        if seqclass_projection is not None:
+            self._seqclass_projection = load_seqclass_projection(
+                seqclass_projection)
+        if output_dtype is not None and output_dtype not in COMPACT_DTYPES:
+            raise ValueError("`output_dtype` must be one of {0}".format(
+                COMPACT_DTYPES))
+        if output_dtype == 'uint8' and seqclass_projection is not None:
+            raise ValueError("Sequence class scores are unbounded and cannot "
+                             "be stored as uint8")
+        self._output_dtype = output_dtype
+        self._pipeline = pipeline
+        if fetch_workers is None:
+            fetch_workers = 1
+            if isinstance(self.reference_sequence, PackedGenome):
+                fetch_workers = min(4, os.cpu_count() or 1)
+        elif not pipeline:
+            raise ValueError("`fetch_workers` is only used with `pipeline`")
+        elif fetch_workers < 1:
+            raise ValueError("`fetch_workers` must be a positive integer")
+        elif fetch_workers > 1 and \
+                not isinstance(self.reference_sequence, PackedGenome):
+            raise ValueError("FASTA reference sequences are read through one "
+                             "file handle, so `fetch_workers` > 1 requires a "
+                             "`PackedGenome`")
+        self._fetch_workers = fetch_workers
+        self.profiler = None
+        if profile is not None:
+            self.profiler = Profiler(profile)
+            if self.autotune_report is not None:
+                self.profiler.emit('autotune', **self.autotune_report)
+            attach_profiler(self.model, self.profiler, use_cuda=self.use_cuda)
+            if self.reference_sequence is not None:
+                profile_reference_sequence(self.reference_sequence,
+                                           self.profiler)
+
+    def variant_effect_prediction(self, *args, **kwargs):
+        if self._pipeline or self._ref_cache is not None:
+            self._batched_variant_effect_prediction(
+                *args, pipeline=self._pipeline, **kwargs)
+        else:
+            super(SeiAnalyzeSequences, self).variant_effect_prediction(
+                *args, **kwargs)
+        self._report_incremental()
+
+    def _batched_variant_effect_prediction(self,
+                                           vcf_file,
+                                           save_data,
+                                           output_dir=None,
+                                           output_format="tsv",
+                                           strand_index=None,
+                                           require_strand=False,
+                                           pipeline=False):
+        """
+        `AnalyzeSequences.variant_effect_prediction` with the batch loop
+        of this object, which reads the ref predictions from `ref_cache`
+        if there is one, and with `pipeline` overlaps its fetch, predict
+        and write steps with `run_pipeline`. Writes the same files.
+        """
+        path, filename = os.path.split(vcf_file)
+        output_path_prefix = '.'.join(filename.split('.')[:-1])
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        else:
+            output_dir = path
+        output_path_prefix = os.path.join(output_dir, output_path_prefix)
+        variants = read_vcf_file(
+            vcf_file,
+            strand_index=strand_index,
+            require_strand=require_strand,
+            output_NAs_to_file="{0}.NA".format(output_path_prefix),
+            seq_context=(self._start_radius, self._end_radius),
+            reference_sequence=self.reference_sequence)
+        reporters = self._initialize_reporters(
+            save_data,
+            output_path_prefix,
+            output_format,
+            VARIANTEFFECT_COLS,
+            output_size=len(variants),
+            mode="varianteffect")
+        # the ref cache predicts a subset of the ref windows
+        pin_memory = pipeline and self.use_cuda and self._ref_cache is None
+
+        def fetch(batch):
+            batch_ref_seqs, batch_alt_seqs, batch_ids = [], [], []
+            for chrom, pos, name, ref, alt, strand in batch:
+                ref_encoding, alt_encoding, match, contains_unk, seq_at_ref = \
+                    _encode_variant(self.reference_sequence,
+                                    self.sequence_length,
+                                    chrom, pos, ref, alt, strand=strand)
+                variant = (chrom, pos, name, ref, alt, strand)
+                # Selene's warnings
+                if contains_unk:
+                    warnings.warn("For variant ({0}, {1}, {2}, {3}, {4}, {5}), "
+                                  "reference sequence contains unknown "
+                                  "base(s)--will be marked `True` in the "
+                                  "`contains_unk` column of the .tsv or the "
+                                  "row_labels .txt file.".format(*variant))
+                if not match:
+                    warnings.warn("For variant ({0}, {1}, {2}, {3}, {4}, {5}), "
+                                  "reference does not match the reference "
+                                  "genome. Reference genome contains {6} "
+                                  "instead. Predictions/scores associated "
+                                  "with this variant--where we use '{3}' in "
+                                  "the input sequence--will be marked `False` "
+                                  "in the `ref_match` column of the .tsv or "
+                                  "the row_labels .txt file".format(
+                                      *variant, seq_at_ref))
+                batch_ref_seqs.append(ref_encoding)
+                batch_alt_seqs.append(alt_encoding)
+                batch_ids.append(variant + (match, contains_unk))
+            batch_ref_seqs = np.array(batch_ref_seqs, dtype=np.float32)
+            batch_alt_seqs = np.array(batch_alt_seqs, dtype=np.float32)
+            if pin_memory:
+                batch_ref_seqs = torch.from_numpy(batch_ref_seqs).pin_memory()
+                batch_alt_seqs = torch.from_numpy(batch_alt_seqs).pin_memory()
+            return batch_ref_seqs, batch_alt_seqs, batch_ids
+
+        def compute(batch):
+            batch_ref_seqs, batch_alt_seqs, batch_ids = batch
+            if self._ref_cache is not None:
+                ref_outputs, alt_outputs = self._ref_alt_outputs(
+                    self.model, batch_ref_seqs, batch_alt_seqs, batch_ids,
+                    use_cuda=self.use_cuda)
+            else:
+                # ref before alt, as the incremental engine expects
+                ref_outputs, alt_outputs = [
+                    predict_pinned(self.model,
+                                   seqs if pin_memory
+                                   else torch.from_numpy(seqs),
+                                   use_cuda=self.use_cuda)
+                    for seqs in (batch_ref_seqs, batch_alt_seqs)]
+            return ref_outputs, alt_outputs, batch_ids
+
+        progress = {'variants': 0, 'time': time.time()}
+
+        def write(outputs):
+            ref_outputs, alt_outputs, batch_ids = outputs
+            _report_ref_alt(reporters, ref_outputs, alt_outputs, batch_ids)
+            n_variants = progress['variants'] + len(batch_ids)
+            if n_variants // 10000 > progress['variants'] // 10000:
+                print("[STEP {0}]: {1} s to process 10000 variants.".format(
+                    n_variants // 10000 * 10000,
+                    time.time() - progress['time']))
+                progress['time'] = time.time()
+            progress['variants'] = n_variants
+
+        batches = (variants[start:start + self.batch_size]
+                   for start in range(0, len(variants), self.batch_size))
+        if pipeline:
+            run_pipeline(batches, fetch, compute, write,
+                         fetch_workers=self._fetch_workers)
+        else:
+            for batch in batches:
+                write(compute(fetch(batch)))
+        for r in reporters:
+            r.write_to_file()
+
+    def _report_incremental(self):
+        if self._incremental is None:
+            return
+        report = self._incremental.report()
+        self._incremental.clear_cache()
+        print("Incremental engine: {0} full and {1} incremental sequence "
+              "predictions. Per sequence: {2:.3g} vs {3:.3g} GMACs, "
+              "{4:.3g} vs {5:.3g} s. Saving per variant (ref + alt): "
+              "{6:.1%} of MACs, {7:.1%} of time.".format(
+                  report['full_sequences'],
+                  report['incremental_sequences'],
+                  report['full_macs_per_sequence'] / 1e9,
+                  report['incremental_macs_per_sequence'] / 1e9,
+                  report['full_seconds_per_sequence'],
+                  report['incremental_seconds_per_sequence'],
+                  report['variant_mac_saving'],
+                  report['variant_time_saving']))
+
+    def saturation_mutagenesis_from_bed(self,
+                                        input_path,
+                                        output_dir,
+                                        batch_size=None):
+        """
+        Score every single-base substitution in each region of a BED file
+        with the histone-normalized sequence class variant effect scores
+        (`utils.sc_hnorm_varianteffect`). Requires `seqclass_projection`.
+
+        As in `get_predictions` for BED files, each region is predicted in
+        one `sequence_length` window centered on the region, so regions
+        can be up to `sequence_length` long. The window is fetched once
+        and each batch of mutants is built from it on the device.
+
+        Writes to `output_dir`, for an input `<prefix>.bed`:
+        `<prefix>_ism_sequence_class_scores.h5` with a float32 dataset
+        `data` of shape (positions, 4, sequence classes), zero for the
+        reference base (attributes `bases` and `seqclass_names`),
+        `<prefix>_ism_row_labels.txt` with the BED line index, chrom,
+        position (0-based) and reference base of each row, and
+        `<prefix>.NA` with the regions that could not be scored.
+        """
+        if self._seqclass_projection is None:
+            raise ValueError("Saturation mutagenesis scores require "
+                             "`seqclass_projection`")
+        if batch_size is None:
+            batch_size = self.batch_size
+        projection = self._seqclass_projection
+        n_classes = projection['n_classes']
+        bases = self.reference_sequence.BASES_ARR
+        output_prefix = os.path.join(output_dir, '.'.join(
+            os.path.basename(input_path).split('.')[:-1]))
+
+        with open(input_path, 'r') as read_handle, \
+                h5py.File("{0}_ism_sequence_class_scores.h5".format(
+                    output_prefix), 'w') as scores_handle, \
+                open("{0}_ism_row_labels.txt".format(output_prefix),
+                     'w') as labels_handle, \
+                open("{0}.NA".format(output_prefix), 'w') as na_handle:
+            scores = scores_handle.create_dataset(
+                'data', (0, len(bases), n_classes), dtype=np.float32,
+                maxshape=(None, len(bases), n_classes),
+                chunks=(1024, len(bases), n_classes))
+            scores.attrs['bases'] = ''.join(bases)
+            scores.attrs['seqclass_names'] = np.array(
+                projection['seqclass_names'], dtype=h5py.string_dtype())
+            labels_handle.write("index\tchrom\tpos\tref\n")
+            for i, line in enumerate(read_handle):
+                cols = line.strip().split('\t')
+                if len(cols) < 3 or not cols[1].isdigit() or \
+                        not cols[2].isdigit():
+                    na_handle.write(line)
+                    continue
+                chrom, start, end = cols[0], int(cols[1]), int(cols[2])
+                mid_pos = start + ((end - start) // 2)
+                seq_start = mid_pos - self._start_radius
+                seq_end = mid_pos + self._end_radius
+                if end <= start or end - start > self.sequence_length or \
+                        chrom not in self.reference_sequence.get_chrs() or \
+                        not self.reference_sequence.coords_in_bounds(
+                            chrom, seq_start, seq_end):
+                    na_handle.write(line)
+                    continue
+                encoding = self.reference_sequence.get_encoding_from_coords(
+                    chrom, seq_start, seq_end)
+                positions = np.arange(start - seq_start, end - seq_start)
+                region_scores = saturation_mutagenesis_scores(
+                    self.model, encoding, positions,
+                    projection['hnorm_projvec'], batch_size,
+                    use_cuda=self.use_cuda)
+
+                with profile_stage(self.profiler, 'write'):
+                    n_rows = scores.shape[0]
+                    scores.resize(n_rows + len(positions), axis=0)
+                    scores[n_rows:] = region_scores
+                    for position in positions:
+                        ref = 'N'
+                        if encoding[position].max() == 1:
+                            ref = bases[int(encoding[position].argmax())]
+                        labels_handle.write("{0}\t{1}\t{2}\t{3}\n".format(
+                            i, chrom, seq_start + position, ref))
+        self._report_incremental()
+
+    def tiled_annotation(self,
+                         output_dir,
+                         stride=200,
+                         chroms=None,
+                         segment_length=2**16):
+        """
+        Predict every `sequence_length` window of each chromosome that
+        starts at a multiple of `stride` with `tiled_predictions`, which
+        shares the convolutional trunk across overlapping windows.
+
+        Writes `<chrom>_tiled_sequence_class_scores.h5` to `output_dir`
+        for each chromosome, with a float32 dataset `data` of the raw
+        sequence class scores of each window (attribute
+        `seqclass_names`), or `<chrom>_tiled_predictions.h5` with the
+        chromatin profile predictions (attribute `features`) if there is
+        no `seqclass_projection`. Rows are written as each segment is
+        predicted. Row i is the window starting at `i * stride`
+        (attributes `chrom`, `stride` and `sequence_length`).
+
+        Parameters
+        ----------
+        output_dir : str
+            The output directory.
+        stride : int, optional
+            Default is 200. The distance between window starts.
+        chroms : list(str) or None, optional
+            Default is None. The chromosomes to annotate, or all of the
+            reference sequence chromosomes.
+        segment_length : int, optional
+            Default is 65536. The length of the segments that the trunk
+            runs on, which bounds memory use.
+        """
+        projection = self._seqclass_projection
+        if chroms is None:
+            chroms = self.reference_sequence.get_chrs()
+        for chrom in chroms:
+            if projection is None:
+                output_path = os.path.join(
+                    output_dir, "{0}_tiled_predictions.h5".format(chrom))
+                n_columns = len(self.features)
+            else:
+                output_path = os.path.join(
+                    output_dir,
+                    "{0}_tiled_sequence_class_scores.h5".format(chrom))
+                n_columns = projection['n_classes']
+            with h5py.File(output_path, 'w') as file_handle:
+                data = file_handle.create_dataset(
+                    'data', (0, n_columns), dtype=np.float32,
+                    maxshape=(None, n_columns),
+                    chunks=(min(1024, max(1, int(1e6) // n_columns)),
+                            n_columns))
+                data.attrs['chrom'] = chrom
+                data.attrs['stride'] = stride
+                data.attrs['sequence_length'] = self.sequence_length
+                if projection is None:
+                    data.attrs['features'] = np.array(
+                        self.features, dtype=h5py.string_dtype())
+                else:
+                    data.attrs['seqclass_names'] = np.array(
+                        projection['seqclass_names'],
+                        dtype=h5py.string_dtype())
+                for starts, predictions in tiled_predictions(
+                        self.model, self.reference_sequence, chrom, stride,
+                        sequence_length=self.sequence_length,
+                        segment_length=segment_length,
+                        batch_size=self.batch_size,
+                        use_cuda=self.use_cuda):
+                    if projection is not None:
+                        # as in `SequenceClassHandler`, project in float64
+                        predictions = sc_projection(
+                            predictions.astype(np.float64),
+                            projection['projvec'][:n_columns],
+                            normalized=True)
+                    with profile_stage(self.profiler, 'write'):
+                        n_rows = data.shape[0]
+                        data.resize(n_rows + len(starts), axis=0)
+                        data[n_rows:] = predictions
+                    if self.profiler is not None:
+                        # the windows are not predicted with `model.forward`
+                        self.profiler.count(len(starts))
+                n_windows = data.shape[0]
+            print("Annotated {0}: {1} windows".format(chrom, n_windows))
+
+    def _ref_alt_outputs(self,
+                         model,
+                         batch_ref_seqs,
+                         batch_alt_seqs,
+                         batch_ids,
+                         use_cuda=False):
+        """
+        The ref and alt predictions of a batch with `ref_cache`: the ref
+        predictions are read from the cache, and each ref window that is
+        not cached is predicted once and added to the cache. Ref sequences
+        that do not match the reference genome are predicted and not
+        cached.
+        """
+        keys = []
+        for chrom, pos, _, ref, _, strand, match, _ in batch_ids:
+            if not match:
+                keys.append(None)
+                continue
+            # the window `variant_effect_prediction` centers on the variant
+            start = pos + len(ref) // 2 - self._start_radius
+            keys.append("{0}\t{1}\t{2}\t{3}".format(
+                self._genome_build, chrom, start, strand))
+        ref_outputs, cached = self._ref_cache.get(keys)
+
+        # predict each uncached window once
+        windows = {}
+        for i in np.flatnonzero(~cached):
+            windows.setdefault(keys[i] or i, []).append(i)
+        if windows:
+            first = [rows[0] for rows in windows.values()]
+            outputs = predict(model, np.array([batch_ref_seqs[i] for i in first]),
+                              use_cuda=use_cuda)
+            for rows, output in zip(windows.values(), outputs):
+                ref_outputs[rows] = output
+            self._ref_cache.put(
+                [keys[i] for i in first if keys[i] is not None],
+                outputs[[keys[i] is not None for i in first]])
+
+        alt_outputs = predict(model, np.array(batch_alt_seqs), use_cuda=use_cuda)
+        return ref_outputs, alt_outputs
+
+    def _initialize_reporters(self,
+                              save_data,
+                              output_path_prefix,
+                              output_format,
+                              colnames_for_ids,
+                              output_size=None,
+                              mode="ism"):
+        if self._targets_subset:
+            with open("{0}_target_names.txt".format(output_path_prefix),
+                      'w') as file_handle:
+                for target in self.features:
+                    file_handle.write("{0}\n".format(target))
+        projection = self._seqclass_projection
+        if projection is None:
+            reporters = super(SeiAnalyzeSequences, self)._initialize_reporters(
+                save_data,
+                output_path_prefix,
+                output_format,
+                colnames_for_ids,
+                output_size=output_size,
+                mode=mode)
+        elif mode == "varianteffect":
+            reporters = [SequenceClassVariantEffectHandler(
+                projection['hnorm_projvec'],
+                projection['seqclass_names'],
+                colnames_for_ids,
+                output_path_prefix,
+                output_format,
+                output_size=output_size,
+                write_mem_limit=self._write_mem_limit)]
+        else:
+            reporters = [SequenceClassHandler(
+                projection['projvec'][:projection['n_classes']],
+                projection['seqclass_names'],
+                colnames_for_ids,
+                output_path_prefix,
+                output_format,
+                output_size=output_size,
+                write_mem_limit=self._write_mem_limit)]
+        if self.autotune_report is not None:
+            self._autotune_write_mem_limit(reporters)
+        if self._output_dtype is not None and output_format == 'hdf5':
+            for reporter in reporters:
+                use_compact_hdf5(reporter, self._output_dtype)
+        if self.profiler is not None:
+            for reporter in reporters:
+                profile_handler(reporter, self.profiler)
+        return reporters
+
+    def _autotune_write_mem_limit(self, reporters):
+        """
+        Set the `write_mem_limit` of each handler that buffers the results
+        of `reporters` to the result of `autotune_write_mem_limit`, for the
+        memory left by the activation budget of the batch size.
+        """
+        writers = [writer for reporter in reporters
+                   for writer in _output_writers(reporter)]
+        reserved_mb = 0
+        if not self.use_cuda:
+            # the activations of the batch size are in the same memory
+            reserved_mb = self.autotune_report['memory_budget_mb'] or 0
+        write_mem_limit = autotune_write_mem_limit(
+            self.batch_size, len(self.features), n_handlers=len(writers),
+            n_processes=self._n_processes, reserved_mb=reserved_mb)
+        if write_mem_limit is None:
+            return
+        for writer in writers:
+            writer._write_mem_limit = write_mem_limit
+        report = {'write_mem_limit': write_mem_limit,
+                  'write_handlers': len(writers),
+                  'processes': self._n_processes}
+        if any(self.autotune_report.get(key) != value
+               for key, value in report.items()):
+            print("Auto-tuned write_mem_limit: {0} MB per output handler, "
+                  "for {1} handler(s) in each of {2} process(es)".format(
+                      write_mem_limit, len(writers), self._n_processes))
+            if self.profiler is not None:
+                self.profiler.emit('autotune', **report)
+        self.autotune_report.update(report)
+
+
+def _report_ref_alt(reporters, ref_outputs, alt_outputs, batch_ids):
+    # as Selene's `_handle_ref_alt_predictions` once it has the predictions
+    for r in reporters:
+        if r.needs_base_pred:
+            r.handle_batch_predictions(alt_outputs, batch_ids, ref_outputs)
+        else:
+            r.handle_batch_predictions(alt_outputs, batch_ids)
+
+
+def get_target_indices(features, targets):
+    """
+    Get the column index in `features` of each name in `targets`.
+    """
+    feature_ixs = {feature: i for i, feature in enumerate(features)}
+    missing = [target for target in targets if target not in feature_ixs]
+    if missing:
+        raise ValueError("{0} target(s) are not predicted by the model, "
+                         "e.g. '{1}'".format(len(missing), missing[0]))
+    return [feature_ixs[target] for target in targets]
+
+
+def get_sei(model):
+    """
+    Get the `Sei` module from a model that may be wrapped (e.g. in Selene's
+    `NonStrandSpecific` or `nn.DataParallel`).
+    """
+    for module in model.modules():
+        if hasattr(module, 'fuse_for_inference'):
+            return module
+    raise ValueError("No Sei module found in {0}".format(type(model)))
+
+
+SEI_BLOCKS = ['lconv1', 'conv1', 'lconv2', 'conv2', 'lconv3', 'conv3',
+              'dconv1', 'dconv2', 'dconv3', 'dconv4', 'dconv5',
+              'spline_tr', 'classifier']
+
+
+def attach_profiler(model, profiler, use_cuda=False):
+    """
+    Time `model` with a `utils.Profiler`: each forward pass of `model`
+    (stage 'model', counting the sequences of each batch) and of each
+    block of its `Sei` module in `SEI_BLOCKS` (stages 'model.lconv1' to
+    'model.classifier'). The blocks are timed with forward hooks. On CUDA
+    the device is synchronized around each block so that the latencies
+    are those of the block, which slows down the profiled run.
+    """
+    def synchronize():
+        if use_cuda:
+            torch.cuda.synchronize()
+
+    def add_hooks(name, block):
+        starts = []
+
+        def pre_hook(module, inputs):
+            synchronize()
+            starts.append(time.perf_counter())
+
+        def hook(module, inputs, output):
+            synchronize()
+            profiler.record(name, time.perf_counter() - starts.pop())
+        block.register_forward_pre_hook(pre_hook)
+        block.register_forward_hook(hook)
+
+    sei = get_sei(model)
+    for name in SEI_BLOCKS:
+        add_hooks("model.{0}".format(name), getattr(sei, name))
+
+    # Selene calls `model.forward` directly, which skips the module hooks
+    forward = model.forward
+
+    def profiled_forward(input, *args, **kwargs):
+        with profiler.stage('model'):
+            output = forward(input, *args, **kwargs)
+            synchronize()
+        profiler.count(len(input))
+        return output
+    model.forward = profiled_forward
+
+
+def profile_handler(handler, profiler):
+    """
+    Time the `handle_batch_predictions` (stage 'handle_batch', which
+    includes any writes it triggers) and `write_to_file` (stage 'write')
+    calls of a Selene `PredictionsHandler`. A `WriteRefAltHandler` is
+    handled through its ref and alt writers.
+    """
+    handler.handle_batch_predictions = profiler.wrap(
+        'handle_batch', handler.handle_batch_predictions)
+    for writer in _output_writers(handler):
+        writer.write_to_file = profiler.wrap('write', writer.write_to_file)
+
+
+def profile_reference_sequence(reference_sequence, profiler):
+    """
+    Time the sequence and encoding fetches of a reference sequence (stage
+    'fetch').
+    """
+    for method in ['get_sequence_from_coords', 'get_encoding_from_coords',
+                   'get_encoding_from_coords_check_unk',
+                   'get_encodings_from_coords']:
+        if hasattr(reference_sequence, method):
+            setattr(reference_sequence, method, profiler.wrap(
+                'fetch', getattr(reference_sequence, method)))
+
+
+def replace_module(model, module, replacement):
+    """
+    Replace `module` wherever it is a child module in `model`, where
+    `replacement` may itself wrap `module`.
+
+    Returns
+    -------
+    torch.nn.Module
+        `model`, or `replacement` if `model` is `module` itself.
+    """
+    if model is module:
+        return replacement
+    # collect the parents first, `replacement` may contain `module`
+    parents = [(parent, name) for parent in model.modules()
+               for name, child in parent.named_children() if child is module]
+    for parent, name in parents:
+        setattr(parent, name, replacement)
+    return model
+
+
+class BatchedNonStrandSpecific(NonStrandSpecific):
+    """
+    `NonStrandSpecific` that concatenates the batch and its reverse
+    complement (a flip of the one-hot encoding along both the base and
+    the position dimensions) and runs them through `model` as one batch
+    of twice the size, instead of two forward passes. The strands are
+    then combined (`mode`) on the device. Uses twice the activation
+    memory of `NonStrandSpecific` for the same `batch_size`.
+    """
+
+    def forward(self, input):
+        if self.from_lua:
+            return super(BatchedNonStrandSpecific, self).forward(input)
+        output = self.model.forward(
+            torch.cat([input, torch.flip(input, dims=(1, 2))]))
+        output, output_from_rev = output.chunk(2)
+        if self.mode == "mean":
+            return (output + output_from_rev) / 2
+        return torch.max(output, output_from_rev)
+
+
+class CastPrecision(nn.Module):
+    """
+    Runs `model` on inputs cast to `dtype` and returns float32 outputs.
+    """
+
+    def __init__(self, model, dtype):
+        super(CastPrecision, self).__init__()
+        self.model = model
+        self._dtype = dtype
+
+    def forward(self, input):
+        return self.model(input.to(self._dtype)).float()
+
+
+class RefPredictionCache(object):
+    """
+    A persistent on-disk cache of the ref predictions of variant effect
+    prediction, shared by every run (and process) that uses the same
+    `cache_dir` and model. Entries are keyed by a string such as
+    '<genome build>\t<chrom>\t<window start>\t<strand>' and evicted least
+    recently used first once the cache reaches `max_size` bytes.
+
+    Each model (`model_checksum`) gets its own subdirectory with a
+    memory-mapped float32 array of `n_features` predictions per slot and
+    an SQLite index from keys to slots.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The cache directory.
+    model_checksum : str
+        A hex digest identifying the model weights and configuration.
+    n_features : int
+        The number of predictions per entry.
+    max_size : int, optional
+        Default is 10 GB. The size cap of the predictions array in bytes
+        (per model). Changing it resizes the cache, dropping the entries
+        in slots past the new size.
+    """
+
+    def __init__(self, cache_dir, model_checksum, n_features, max_size=int(1e10)):
+        model_dir = os.path.join(cache_dir, model_checksum[:32])
+        os.makedirs(model_dir, exist_ok=True)
+        self.n_features = n_features
+        self.capacity = max(1, max_size // (4 * n_features))
+
+        self._index_path = os.path.join(model_dir, "index.sqlite")
+        self._connection = None
+        self._index.execute("CREATE TABLE IF NOT EXISTS entries ("
+                            "key TEXT PRIMARY KEY, "
+                            "slot INTEGER UNIQUE, "
+                            "last_used REAL)")
+        self._index.execute("BEGIN IMMEDIATE")
+        self._index.execute("DELETE FROM entries WHERE slot >= ?",
+                            (self.capacity,))
+        predictions_file = os.path.join(model_dir, "predictions.f32")
+        with open(predictions_file, 'ab') as file_handle:
+            file_handle.truncate(self.capacity * n_features * 4)
+        self._index.execute("COMMIT")
+        self._predictions = np.memmap(
+            predictions_file, dtype=np.float32, mode='r+',
+            shape=(self.capacity, n_features))
+
+    @property
+    def _index(self):
+        # SQLite connections cannot be used across a fork, so each process
+        # (e.g. a `run_shards_in_workers` worker) opens its own
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(
+                self._index_path, timeout=600, isolation_level=None)
+            self._pid = os.getpid()
+        return self._connection
+
+    def get(self, keys):
+        """
+        Look up `keys` (None is never cached).
+
+        Returns
+        -------
+        tuple(numpy.ndarray, numpy.ndarray)
+            The `len(keys)` x `n_features` cached predictions (zero where
+            not cached) and whether each key was cached.
+        """
+        slots = {}
+        lookup = [key for key in set(keys) if key is not None]
+        predictions = np.zeros((len(keys), self.n_features), dtype=np.float32)
+        # `put` overwrites slots under an exclusive lock, so read the
+        # predictions while holding the shared lock of this transaction
+        self._index.execute("BEGIN")
+        try:
+            for i in range(0, len(lookup), 500):
+                chunk = lookup[i:i + 500]
+                slots.update(self._index.execute(
+                    "SELECT key, slot FROM entries WHERE key IN ({0})".format(
+                        ','.join('?' * len(chunk))), chunk).fetchall())
+            cached = np.array([key in slots for key in keys], dtype=bool)
+            if cached.any():
+                predictions[cached] = self._predictions[
+                    [slots[key] for key, hit in zip(keys, cached) if hit]]
+        finally:
+            self._index.execute("COMMIT")
+        if slots:
+            self._index.executemany(
+                "UPDATE entries SET last_used = ? WHERE key = ?",
+                [(time.time(), key) for key in slots])
+        return predictions, cached
+
+    def put(self, keys, predictions):
+        """
+        Add the predictions (one row per key) for keys not already cached,
+        evicting the least recently used entries if the cache is full.
+        """
+        self._index.execute("BEGIN EXCLUSIVE")
+        try:
+            n_entries = self._index.execute(
+                "SELECT COUNT(*) FROM entries").fetchone()[0]
+            for key, prediction in zip(keys, predictions):
+                if self._index.execute("SELECT 1 FROM entries WHERE key = ?",
+                                       (key,)).fetchone():
+                    continue
+                if n_entries < self.capacity:
+                    slot = n_entries
+                    n_entries += 1
+                else:
+                    slot = self._index.execute(
+                        "SELECT slot FROM entries "
+                        "ORDER BY last_used LIMIT 1").fetchone()[0]
+                    self._index.execute("DELETE FROM entries WHERE slot = ?",
+                                        (slot,))
+                self._predictions[slot] = prediction
+                self._index.execute(
+                    "INSERT INTO entries VALUES (?, ?, ?)",
+                    (key, slot, time.time()))
+            # the predictions are on disk before the index refers to them
+            self._predictions.flush()
+            self._index.execute("COMMIT")
+        except BaseException:
+            self._index.execute("ROLLBACK")
+            raise
+
+
+def saturation_mutagenesis_scores(model,
+                                  encoding,
+                                  positions,
+                                  hnorm_projvec,
+                                  batch_size,
+                                  use_cuda=False):
+    """
+    The histone-normalized sequence class variant effect scores of every
+    single-base substitution at `positions` of a one-hot `encoding`
+    (sequence length x 4, as returned by `Genome`), predicted in batches
+    of `batch_size` mutants built on the device from the reference.
+
+    Returns
+    -------
+    numpy.ndarray
+        A float32 array of shape (len(positions), 4, sequence classes),
+        zero for the reference base. Positions with an unknown base are
+        scored for all 4 bases.
+    """
+    device = torch.device('cuda' if use_cuda else 'cpu')
+    n_classes = (hnorm_projvec.shape[1] - 1) // 2
+    ref = torch.as_tensor(encoding.T, dtype=torch.float32, device=device)
+    with torch.no_grad():
+        ref_pred = model(ref.unsqueeze(0)).cpu().numpy().astype(np.float64)
+
+    mutants = np.array([(i, base) for i, position in enumerate(positions)
+                        for base in range(encoding.shape[1])
+                        if encoding[position, base] != 1],
+                       dtype=np.int64).reshape(-1, 2)
+    scores = np.zeros((len(positions), encoding.shape[1], n_classes),
+                      dtype=np.float32)
+    for batch_start in range(0, len(mutants), batch_size):
+        batch = mutants[batch_start:batch_start + batch_size]
+        rows = torch.arange(len(batch), device=device)
+        mutant_positions = torch.as_tensor(
+            np.asarray(positions)[batch[:, 0]], device=device)
+        alt = ref.expand(len(batch), -1, -1).clone()
+        alt[rows, :, mutant_positions] = 0
+        alt[rows, torch.as_tensor(batch[:, 1], device=device),
+            mutant_positions] = 1
+        with torch.no_grad():
+            alt_pred = model(alt).cpu().numpy().astype(np.float64)
+        # as in `SequenceClassVariantEffectHandler`, score in float64
+        scores[batch[:, 0], batch[:, 1]] = sc_hnorm_varianteffect_fused(
+            ref_pred, alt_pred, hnorm_projvec)
+    return scores
+
+
+def _half_receptive_field(block):
+    """
+    The number of positions on either side of an output position of
+    `block` (in its pooled input coordinates) that the output depends on.
+    """
+    half_width = 0
+    for layer in block:
+        if hasattr(layer, 'edge'):  # `FusedLinearConv1d`
+            layer = layer.conv
+        if isinstance(layer, nn.Conv1d):
+            half_width += layer.dilation[0] * (layer.kernel_size[0] - 1) // 2
+    return half_width
+
+
+def _pool_size(block):
+    if isinstance(block[0], nn.MaxPool1d):
+        return block[0].kernel_size
+    return 1
+
+
+def _macs(block, length):
+    """
+    The number of multiply-accumulates to run the convolution and linear
+    layers of `block` on one sequence of `length` positions.
+    """
+    macs = 0
+    for layer in block:
+        if hasattr(layer, 'edge'):
+            layer = layer.conv
+        if isinstance(layer, nn.MaxPool1d):
+            length //= layer.kernel_size
+        elif isinstance(layer, nn.Conv1d):
+            macs += (layer.in_channels * layer.out_channels *
+                     layer.kernel_size[0] * length // layer.groups)
+        elif hasattr(layer, 'in_features'):  # also quantized `Linear`
+            macs += layer.in_features * layer.out_features
+    return macs
+
+
+def _trunk(sei, x):
+    """The output of `Sei.dconv_stage` on a batch `x` of any length."""
+    out, lout = sei.conv_stage(sei.lconv1, sei.conv1, x)
+    out, lout = sei.conv_stage(sei.lconv2, sei.conv2, out + lout)
+    out, lout = sei.conv_stage(sei.lconv3, sei.conv3, out + lout)
+    return sei.dconv_stage(out, lout)
+
+
+def tiled_predictions(model,
+                      reference_sequence,
+                      chrom,
+                      stride,
+                      sequence_length=4096,
+                      segment_length=2**16,
+                      batch_size=64,
+                      use_cuda=False):
+    """
+    Predict every `sequence_length` window of `chrom` that starts at a
+    multiple of `stride`, running the `Sei` trunk (everything up to
+    `dconv5`, which is fully convolutional) once over each segment of up
+    to `segment_length` bp of windows. `Sei.classify` then runs on each
+    window's slice of the trunk output, in batches of `batch_size`
+    windows.
+
+    The trunk pools by 16 positions, so the windows of a segment are
+    grouped by their start modulo 16 and the trunk runs once per group,
+    on a segment aligned to it (e.g. twice per segment for a stride of
+    200). Each segment extends up to `sequence_length` bp beyond its
+    windows on either side. The trunk output of a window is therefore
+    computed with the neighbouring genomic sequence as context where the
+    forward pass on the window alone sees zero padding, and the
+    predictions differ slightly from predicting each window separately.
+
+    If `model` has a `NonStrandSpecific` wrapper, the reverse complement
+    of each segment runs through the trunk as well and the strands are
+    combined as in its `mode`.
+
+    Yields
+    ------
+    tuple(numpy.ndarray, numpy.ndarray)
+        The window starts of the next segment, in coordinate order, and
+        their float32 chromatin profile predictions.
+    """
+    sei = get_sei(model)
+    mode = None
+    for module in model.modules():
+        if isinstance(module, NonStrandSpecific):
+            mode = module.mode
+            break
+    device = torch.device('cuda' if use_cuda else 'cpu')
+    dtype = next(sei.parameters()).dtype
+    pool = _pool_size(sei.lconv2) * _pool_size(sei.lconv3)
+    n_positions = sequence_length // pool
+
+    chrom_len = dict(reference_sequence.get_chr_lens())[chrom]
+    n_windows = max(0, (chrom_len - sequence_length) // stride + 1)
+    windows_per_segment = max(
+        1, (segment_length - sequence_length) // stride + 1)
+    for first in range(0, n_windows, windows_per_segment):
+        starts = stride * np.arange(
+            first, min(n_windows, first + windows_per_segment))
+        predictions = None
+        for phase in np.unique(starts % pool):
+            ixs = np.flatnonzero(starts % pool == phase)
+            window_starts = starts[ixs]
+            # the margins keep the segment aligned to the phase
+            seg_start = window_starts[0] - min(
+                sequence_length, window_starts[0] // pool * pool)
+            seg_end = window_starts[-1] + sequence_length + min(
+                sequence_length, (chrom_len - sequence_length -
+                                  window_starts[-1]) // pool * pool)
+            encoding = reference_sequence.get_encoding_from_coords(
+                chrom, seg_start, seg_end)
+            x = torch.as_tensor(encoding.T[None], dtype=dtype, device=device)
+            strands = [(x, (window_starts - seg_start) // pool)]
+            if mode is not None:
+                strands.append((torch.flip(x, (1, 2)), (
+                    seg_end - sequence_length - window_starts) // pool))
+            strand_predictions = []
+            for strand_x, offsets in strands:
+                with torch.no_grad():
+                    trunk_out = _trunk(sei, strand_x)[0]
+                    batches = []
+                    for batch_start in range(0, len(offsets), batch_size):
+                        batch = torch.stack([
+                            trunk_out[:, offset:offset + n_positions]
+                            for offset in offsets[
+                                batch_start:batch_start + batch_size]])
+                        batches.append(sei.classify(batch).float().cpu())
+                strand_predictions.append(torch.cat(batches))
+            if mode == 'max':
+                output = torch.max(*strand_predictions)
+            else:
+                output = sum(strand_predictions) / len(strand_predictions)
+            if predictions is None:
+                predictions = np.empty((len(starts), output.size(1)),
+                                       dtype=np.float32)
+            predictions[ixs] = output.numpy()
+        yield starts, predictions
+
+
+class IncrementalSei(nn.Module):
+    """
+    Runs a `Sei` module and caches the activations of the last
+    `cache_size` batches. A batch that differs from a cached batch of the
+    same shape only within `max_span` consecutive positions, such as the
+    alt sequences of a batch of SNVs after the ref sequences (Selene
+    centers every sequence on its variant), is computed from the cached
+    activations. A cached batch of one sequence is compared to every
+    sequence of a batch, e.g. a reference sequence and a batch of its
+    single-base mutants.
+
+    Each of the `lconv1`/`conv1`, `lconv2`/`conv2` and `lconv3`/`conv3`
+    stages is recomputed only over the positions whose receptive field
+    includes a changed input position, from a slice of the stage input
+    with enough context on either side, and the rest of the stage output
+    is copied from the cache. The dilated convolutions, whose receptive
+    field covers the whole sequence, the spline and the classifier then
+    run as in `Sei.forward`. The outputs are the same as `Sei.forward` up
+    to floating point rounding.
+
+    Parameters
+    ----------
+    sei : Sei
+        The `Sei` module, in eval mode.
+    cache_size : int, optional
+        Default is 2, for the ref sequences and their reverse complements.
+        The cache holds every stage output of a batch, i.e. about 12.5 MB per
+        sequence.
+    max_span : int, optional
+        Default is 512. The largest span of changed positions to compute
+        incrementally. Larger changes (e.g. most indels, which shift the
+        rest of the sequence) run the full forward pass.
+    """
+
+    def __init__(self, sei, cache_size=2, max_span=512):
+        super(IncrementalSei, self).__init__()
+        self.sei = sei
+        self._cache_size = cache_size
+        self._max_span = max_span
+        self._cache = []
+        self._stats = {'full': [0, 0., 0], 'incremental': [0, 0., 0]}
+
+    def _stages(self):
+        return [(self.sei.lconv1, self.sei.conv1),
+                (self.sei.lconv2, self.sei.conv2),
+                (self.sei.lconv3, self.sei.conv3)]
+
+    def _head_macs(self, length):
+        macs = 0
+        for block in [self.sei.dconv1, self.sei.dconv2, self.sei.dconv3,
+                      self.sei.dconv4, self.sei.dconv5, self.sei.classifier]:
+            macs += _macs(block, length)
+        return macs
+
+    def _full(self, x):
+        stage_input, outputs, macs = x, [], 0
+        for lconv, conv in self._stages():
+            macs += _macs(lconv, stage_input.size(-1))
+            out, lout = self.sei.conv_stage(lconv, conv, stage_input)
+            macs += _macs(conv, out.size(-1))
+            outputs.append((out, lout))
+            stage_input = out + lout
+        out3, lout3 = outputs[-1]
+        macs += self._head_macs(out3.size(-1))
+        predict = self.sei.head(out3, lout3)
+        # only the sums are inputs to the next stage
+        activations = [out + lout for out, lout in outputs[:-1]]
+        activations.append(outputs[-1])
+        self._cache.insert(0, {'input': x.clone(),
+                               'activations': activations,
+                               'predict': predict})
+        del self._cache[self._cache_size:]
+        return predict, macs
+
+    def _incremental(self, x, entry, start, end):
+        stage_input, macs = x, 0
+        for i, (lconv, conv) in enumerate(self._stages()):
+            pool = _pool_size(lconv)
+            half_width = (_half_receptive_field(lconv) +
+                          _half_receptive_field(conv))
+            length = stage_input.size(-1) // pool
+            # the outputs that change, and the outputs computed to get them
+            start = max(0, start // pool - half_width)
+            end = min(length, (end - 1) // pool + 1 + half_width)
+            context_start = max(0, start - half_width)
+            context_end = min(length, end + half_width)
+            window = stage_input[..., context_start * pool:context_end * pool]
+            macs += _macs(lconv, window.size(-1))
+            out, lout = self.sei.conv_stage(lconv, conv, window)
+            macs += _macs(conv, out.size(-1))
+            offset = slice(start - context_start, end - context_start)
+            if i < 2:
+                stage_input = entry['activations'][i].expand(
+                    x.size(0), -1, -1).clone()
+                stage_input[..., start:end] = (out + lout)[..., offset]
+            else:
+                out3, lout3 = [cached.expand(x.size(0), -1, -1).clone()
+                               for cached in entry['activations'][i]]
+                out3[..., start:end] = out[..., offset]
+                lout3[..., start:end] = lout[..., offset]
+        macs += self._head_macs(out3.size(-1))
+        return self.sei.head(out3, lout3), macs
+
+    def forward(self, x):
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        start_time = time.time()
+        mode = 'full'
+        for entry in self._cache:
+            if entry['input'].shape[1:] != x.shape[1:] or \
+                    entry['input'].size(0) not in (1, x.size(0)):
+                continue
+            changed = torch.nonzero(
+                (x != entry['input']).any(dim=1).any(dim=0)).flatten()
+            if len(changed) == 0:
+                return entry['predict'].expand(x.size(0), -1).clone()
+            start, end = int(changed[0]), int(changed[-1]) + 1
+            if end - start <= self._max_span:
+                mode = 'incremental'
+                predict, macs = self._incremental(x, entry, start, end)
+                break
+        if mode == 'full':
+            predict, macs = self._full(x)
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        stats = self._stats[mode]
+        stats[0] += x.size(0)
+        stats[1] += time.time() - start_time
+        stats[2] += macs * x.size(0)
+        return predict
+
+    def clear_cache(self):
+        self._cache = []
+
+    def report(self):
+        """
+        The number of full and incremental sequence predictions, the
+        MACs and seconds per sequence of each, and the saving for a
+        variant, i.e. one incremental alt prediction in place of one of the
+        two full ref and alt predictions.
+        """
+        report = {}
+        for mode, (n_sequences, seconds, macs) in self._stats.items():
+            report['{0}_sequences'.format(mode)] = n_sequences
+            report['{0}_seconds_per_sequence'.format(mode)] = (
+                seconds / max(n_sequences, 1))
+            report['{0}_macs_per_sequence'.format(mode)] = (
+                macs / max(n_sequences, 1))
+        for name in ['macs', 'seconds']:
+            full = report['full_{0}_per_sequence'.format(name)]
+            incremental = report['incremental_{0}_per_sequence'.format(name)]
+            saving = 0.
+            if report['full_sequences'] and report['incremental_sequences']:
+                saving = (full - incremental) / (2 * full)
+            report['variant_{0}_saving'.format(
+                'mac' if name == 'macs' else 'time')] = saving
+        return report
+
+
+def _available_memory():
+    """The bytes of memory available to new processes (Linux), or None."""
+    try:
+        with open('/proc/meminfo') as file_handle:
+            for line in file_handle:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _process_memory(field):
+    """`VmRSS` or `VmHWM` (peak) of this process in bytes (Linux), or None."""
+    try:
+        with open('/proc/self/status') as file_handle:
+            for line in file_handle:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_memory(use_cuda):
+    if use_cuda:
+        torch.cuda.reset_peak_memory_stats()
+        return
+    try:
+        # resets VmHWM to the current VmRSS
+        with open('/proc/self/clear_refs', 'w') as file_handle:
+            file_handle.write('5')
+    except OSError:
+        pass
+
+
+def autotune_batch_size(model,
+                        sequence_length,
+                        use_cuda=False,
+                        candidates=(4, 8, 16, 32, 64, 128, 256, 512, 1024),
+                        memory_fraction=0.5,
+                        time_budget=60.,
+                        min_gain=0.05):
+    """
+    Pick a batch size for `model` on this machine with calibration
+    forward passes on random sequences, in increasing order of
+    `candidates`. A batch size is not tried if its projected activation
+    memory (measured per sequence on the previous batch size, from the
+    peak GPU memory or the peak RSS) is more than `memory_fraction` of the
+    free GPU memory or the available memory, or if its projected time
+    would exceed `time_budget` seconds of calibration. The calibration
+    also stops when a batch size is less than `min_gain` faster than the
+    best so far, or runs out of GPU memory.
+
+    The chosen batch size is the smallest with a throughput within
+    `min_gain` of the best, since larger batches use more memory for no
+    measurable gain.
+
+    Returns
+    -------
+    dict
+        `batch_size`, the measured `throughput` (sequences/s) of each
+        batch size tried, the `memory_per_sequence_mb` of the activations,
+        `memory_budget_mb`, `device` and `threads`.
+    """
+    device = torch.device('cuda' if use_cuda else 'cpu')
+    if use_cuda:
+        budget = torch.cuda.mem_get_info()[0] * memory_fraction
+    else:
+        budget = _available_memory()
+        if budget is not None:
+            budget *= memory_fraction
+    rng = np.random.default_rng(0)
+
+    def forward(batch_size):
+        bases = rng.integers(0, 4, size=(batch_size, sequence_length))
+        x = torch.from_numpy(
+            np.eye(4, dtype=np.float32)[bases].transpose(0, 2, 1).copy())
+        with torch.no_grad():
+            model.forward(x.to(device))
+        if use_cuda:
+            torch.cuda.synchronize()
+
+    throughput = {}
+    memory_per_sequence = None
+    calibration_start = time.perf_counter()
+    # warm-up, e.g. cuDNN algorithm selection
+    forward(candidates[0])
+    for batch_size in candidates:
+        if memory_per_sequence is not None and budget is not None and \
+                memory_per_sequence * batch_size > budget:
+            break
+        if throughput:
+            last_throughput = list(throughput.values())[-1]
+            if time.perf_counter() - calibration_start + \
+                    batch_size / last_throughput > time_budget:
+                break
+        previous_best = max(throughput.values(), default=None)
+        before = (torch.cuda.memory_allocated() if use_cuda
+                  else _process_memory('VmRSS'))
+        _reset_peak_memory(use_cuda)
+        start = time.perf_counter()
+        try:
+            forward(batch_size)
+        except RuntimeError as error:
+            if not use_cuda or 'out of memory' not in str(error):
+                raise
+            torch.cuda.empty_cache()
+            break
+        throughput[batch_size] = batch_size / (time.perf_counter() - start)
+        peak = (torch.cuda.max_memory_allocated() if use_cuda
+                else _process_memory('VmHWM'))
+        if before is not None and peak is not None and peak > before:
+            memory_per_sequence = (peak - before) / batch_size
+        if previous_best is not None and \
+                throughput[batch_size] < previous_best * (1 + min_gain):
+            break
+
+    best = max(throughput.values())
+    chosen = min(batch_size for batch_size, value in throughput.items()
+                 if value >= best * (1 - min_gain))
+    return {'batch_size': chosen,
+            'throughput': throughput,
+            'memory_per_sequence_mb': (None if memory_per_sequence is None
+                                       else memory_per_sequence / 1e6),
+            'memory_budget_mb': None if budget is None else budget / 1e6,
+            'device': str(device),
+            'threads': torch.get_num_threads()}
+
+
+def autotune_write_mem_limit(batch_size,
+                             n_features,
+                             n_handlers=1,
+                             n_processes=1,
+                             reserved_mb=0,
+                             memory_fraction=0.25,
+                             max_write_mem_limit=8000):
+    """
+    A `write_mem_limit` (in MB, as in Selene) for each output handler, so
+    that the handlers write large blocks of rows at a time: a share of
+    `memory_fraction` of the available memory less `reserved_mb` (e.g.
+    the activation budget of `autotune_batch_size`), up to
+    `max_write_mem_limit`, split between the `n_handlers` handlers of each
+    of `n_processes` processes, and at least one batch of float64
+    predictions. Returns None if the available memory is not known.
+    """
+    available = _available_memory()
+    if available is None:
+        return None
+    budget_mb = min(max(available / 1e6 - reserved_mb, 0) * memory_fraction,
+                    max_write_mem_limit)
+    batch_mb = batch_size * n_features * 8 / 1e6
+    return int(max(budget_mb / (n_handlers * n_processes), batch_mb, 1))
+
+
+def set_precision(model, precision):
+    """
+    Run the `Sei` module in `model` at reduced precision.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        A model containing a `Sei` module, with its trained weights loaded.
+    precision : {'fp32', 'bf16', 'int8'}
+        'bf16' casts all of the weights to bfloat16 and wraps the `Sei`
+        module in `CastPrecision`. 'int8' applies dynamic int8 quantization
+        to the `Linear` layers, i.e. the classifier head that holds almost
+        all of the weights; the convolutions stay in float32. 'fp32' leaves
+        the model unchanged.
+
+    Returns
+    -------
+    torch.nn.Module
+        `model`, or the wrapped `Sei` module if `model` is the `Sei` module
+        itself.
+    """
+    sei = get_sei(model)
+    if precision == 'bf16':
+        return replace_module(
+            model, sei, CastPrecision(sei.to(torch.bfloat16), torch.bfloat16))
+    elif precision == 'int8':
+        torch.quantization.quantize_dynamic(
+            sei, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    elif precision != 'fp32':
+        raise ValueError("precision must be one of 'fp32', 'bf16' or 'int8', "
+                         "but was '{0}'".format(precision))
+    return model
+
+
+# the 4 bases of each packed byte, most significant bits first
+_UNPACK_BASES = np.array([[byte >> shift & 3 for shift in (6, 4, 2, 0)]
+                          for byte in range(256)], dtype=np.uint8)
+_CODE_TO_BASE = np.frombuffer(b'ACGTN', dtype=np.uint8)
+_COMPLEMENT_CODE = np.array([3, 2, 1, 0, 4], dtype=np.uint8)
+
+
+class PackedGenome(Genome):
+    """
+    A `Genome` read from a file written by `compile_packed_genome.py`
+    (`utils.compile_packed_genome`) in place of an indexed FASTA file.
+    Fetching a sequence slices the memory-mapped 2-bit bases and unknown
+    base mask and unpacks them with lookup tables, without decoding
+    FASTA text. The encodings are the same as `Genome` on the FASTA file
+    the genome was packed from. The sequences are upper case, and any
+    character other than A, C, G or T in the FASTA file reads as 'N' (so
+    a sequence is reported to contain unknown bases if it contains any of
+    them, where `Genome` only checks for 'N'; the UCSC hg19 and hg38
+    FASTA files have no other unknown bases).
+
+    Parameters
+    ----------
+    input_path : str
+        Path to the packed genome.
+
+    See `selene_sdk.sequences.Genome` for the remaining parameters.
+    """
+
+    def _unpicklable_init(self):
+        if not self._initialized:
+            self._packed = load_packed_genome(self.input_path)
+            self.chrs = sorted(chrom for chrom, _, _ in self._packed['chroms'])
+            self.len_chrs = self._get_len_chrs()
+            self._chrom_offsets = {chrom: offset for chrom, _, offset
+                                   in self._packed['chroms']}
+            encodings = np.zeros((5, len(self.BASES_ARR)), dtype=np.float32)
+            for code, base in enumerate('ACGT'):
+                encodings[code, self.BASE_TO_INDEX[base]] = 1
+            encodings[4] = np.float32(1) / len(self.BASES_ARR)
+            self._encodings = encodings
+            self._blacklist_tabix = None
+            if self.blacklist_regions == "hg19":
+                self._blacklist_tabix = tabix.open(
+                    pkg_resources.resource_filename(
+                        "selene_sdk",
+                        "sequences/data/hg19_blacklist_ENCFF001TDO.bed.gz"))
+            elif self.blacklist_regions == "hg38":
+                self._blacklist_tabix = tabix.open(
+                    pkg_resources.resource_filename(
+                        "selene_sdk",
+                        "sequences/data/hg38.blacklist.bed.gz"))
+            elif self.blacklist_regions is not None:
+                self._blacklist_tabix = tabix.open(self.blacklist_regions)
+            self._initialized = True
+
+    def _get_len_chrs(self):
+        return {chrom: length for chrom, length, _ in self._packed['chroms']}
+
+    def _codes(self, chroms, starts, length, strands=None):
+        """
+        The base codes (A, C, G, T, N = 0, 1, 2, 3, 4) of the `length` bp
+        intervals at `starts`, as an array of shape (len(starts), length).
+        Positions outside their chromosome are N.
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        chrom_lens = np.array([self.len_chrs[chrom] for chrom in chroms],
+                              dtype=np.int64)
+        positions = starts[:, None] + np.arange(length)
+        outside = (positions < 0) | (positions >= chrom_lens[:, None])
+        positions = np.clip(positions, 0, chrom_lens[:, None] - 1) + np.array(
+            [self._chrom_offsets[chrom] for chrom in chroms])[:, None]
+        # slice whole bytes, then unpack them with the lookup tables
+        first = positions[:, :1]
+        byte_ixs = first // 4 + np.arange((length + 3) // 4 + 1)
+        byte_ixs = np.minimum(byte_ixs, len(self._packed['bases']) - 1)
+        codes = _UNPACK_BASES[self._packed['bases'][byte_ixs]].reshape(
+            len(starts), -1)
+        codes = np.take_along_axis(codes, positions - first // 4 * 4, axis=1)
+        unknown = self._packed['unknown'][positions // 8] >> (
+            7 - positions % 8) & 1
+        codes[(unknown == 1) | outside] = 4
+        if strands is not None:
+            minus = np.array([strand == '-' for strand in strands])
+            codes[minus] = _COMPLEMENT_CODE[codes[minus, ::-1]]
+        return codes
+
+    def _interval_codes(self, chrom, start, end, strand='+'):
+        """
+        The base codes of one in-bounds interval, unpacked from slices of
+        the packed arrays.
+        """
+        position = self._chrom_offsets[chrom] + start
+        length = end - start
+        codes = _UNPACK_BASES[self._packed['bases'][
+            position // 4:(position + length + 3) // 4]].ravel()[
+                position % 4:position % 4 + length]
+        unknown = np.unpackbits(self._packed['unknown'][
+            position // 8:(position + length + 7) // 8])[
+                position % 8:position % 8 + length]
+        codes[unknown == 1] = 4
+        if strand == '-':
+            codes = _COMPLEMENT_CODE[codes[::-1]]
+        return codes
+
+    def _genome_sequence(self, chrom, start, end, strand='+'):
+        return _CODE_TO_BASE[self._interval_codes(
+            chrom, start, end, strand=strand)].tobytes().decode()
+
+    @Genome.init
+    def get_encoding_from_coords(self,
+                                 chrom,
+                                 start,
+                                 end,
+                                 strand='+',
+                                 pad=False):
+        """
+        Gets the one-hot encoding of the genomic sequence at the queried
+        coordinates, as in `Genome.get_encoding_from_coords`.
+        """
+        return self.get_encoding_from_coords_check_unk(
+            chrom, start, end, strand=strand, pad=pad)[0]
+
+    @Genome.init
+    def get_encoding_from_coords_check_unk(self,
+                                           chrom,
+                                           start,
+                                           end,
+                                           strand='+',
+                                           pad=False):
+        """
+        Gets the one-hot encoding of the genomic sequence at the queried
+        coordinates and whether it contains unknown bases, as in
+        `Genome.get_encoding_from_coords_check_unk`.
+        """
+        if strand not in ('+', '-', '.'):
+            raise ValueError(
+                "Strand must be one of '+', '-', or '.'. Input was {0}".format(
+                    strand))
+        if not _check_coords(self.len_chrs, chrom, start, end, pad=pad,
+                             blacklist_tabix=self._blacklist_tabix):
+            return np.zeros((0, len(self.BASES_ARR)), dtype=np.float32), False
+        # as in `Genome`, the padding is not reverse complemented
+        start_pad, end_pad = max(0, -start), max(0, end - self.len_chrs[chrom])
+        codes = self._interval_codes(
+            chrom, start + start_pad, end - end_pad, strand=strand)
+        if start_pad or end_pad:
+            codes = np.pad(codes, (start_pad, end_pad), constant_values=4)
+        return self._encodings[codes], bool((codes == 4).any())
+
+    @Genome.init
+    def get_encodings_from_coords(self, chroms, starts, length, strands=None):
+        """
+        Gets the one-hot encodings of many intervals of the same length in
+        one vectorized fetch.
+
+        Parameters
+        ----------
+        chroms : list(str)
+            The chromosome of each interval.
+        starts : list(int)
+            The 0-based start coordinate of each interval.
+        length : int
+            The length of the intervals.
+        strands : list(str) or None, optional
+            Default is None (all '+'). The strand of each interval.
+
+        Returns
+        -------
+        numpy.ndarray, dtype=numpy.float32
+            The len(starts) x `length` x 4 encodings. Positions outside
+            their chromosome are encoded as unknown bases, as with
+            `pad=True`; the blacklist is not checked.
+        """
+        return self._encodings[self._codes(chroms, starts, length,
+                                           strands=strands)]
+
+
+def encode_variant(reference_sequence,
+                   sequence_length,
+                   chrom,
+                   pos,
+                   ref,
+                   alt,
+                   strand='+'):
+    """
+    The ref and alt encodings of a variant (`pos` as in a VCF file), built
+    as `AnalyzeSequences.variant_effect_prediction` does: the
+    `sequence_length` window is centered on the ref allele, the ref
+    allele given replaces the reference genome bases if they differ, and
+    '-' strand windows are reverse complemented.
+
+    Returns
+    -------
+    tuple(numpy.ndarray, numpy.ndarray, bool, bool)
+        The ref and alt encodings, whether `ref` matches the reference
+        genome (`ref_match`) and whether the window contains unknown bases
+        (`contains_unk`).
+    """
+    return _encode_variant(reference_sequence, sequence_length, chrom, pos,
+                           ref, alt, strand=strand)[:4]
+
+
+def _encode_variant(reference_sequence,
+                    sequence_length,
+                    chrom,
+                    pos,
+                    ref,
+                    alt,
+                    strand='+'):
+    # `encode_variant`, also returning the reference genome bases at `ref`
+    # if they do not match it
+    start_radius = sequence_length // 2
+    end_radius = sequence_length - start_radius
+    center = pos + len(ref) // 2
+    start = center - start_radius
+    end = center + end_radius
+    if chrom not in reference_sequence.get_chrs() or \
+            not reference_sequence.coords_in_bounds(chrom, start, end):
+        raise ValueError("{0}:{1} is not in the reference sequence with "
+                         "enough context".format(chrom, pos))
+    ref_sequence_encoding, contains_unk = \
+        reference_sequence.get_encoding_from_coords_check_unk(
+            chrom, start, end)
+    ref_encoding = reference_sequence.sequence_to_encoding(ref)
+    alt_sequence_encoding = _process_alt(
+        chrom, pos, ref, alt, start, end, ref_sequence_encoding,
+        reference_sequence)
+    match = True
+    seq_at_ref = None
+    if len(ref) and len(ref) < sequence_length:
+        match, ref_sequence_encoding, seq_at_ref = _handle_standard_ref(
+            ref_encoding, ref_sequence_encoding, sequence_length,
+            reference_sequence)
+    elif len(ref) >= sequence_length:
+        match, ref_sequence_encoding, seq_at_ref = _handle_long_ref(
+            ref_encoding, ref_sequence_encoding, start_radius, end_radius,
+            reference_sequence)
+    if strand == '-':
+        ref_sequence_encoding = get_reverse_complement_encoding(
+            ref_sequence_encoding, reference_sequence.BASES_ARR,
+            reference_sequence.COMPLEMENTARY_BASE_DICT)
+        alt_sequence_encoding = get_reverse_complement_encoding(
+            alt_sequence_encoding, reference_sequence.BASES_ARR,
+            reference_sequence.COMPLEMENTARY_BASE_DICT)
+    return (ref_sequence_encoding, alt_sequence_encoding, match, contains_unk,
+            seq_at_ref)
+
+
+class MicroBatcher(object):
+    """
+    Runs a model on the encoded sequences submitted by many threads,
+    coalescing them into batches: a batch is run when it has `batch_size`
+    sequences or `max_wait` seconds after its first sequence arrived,
+    whichever comes first. Larger submissions are split into batches.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        The model, in eval mode (e.g. `AnalyzeSequences.model`).
+    batch_size : int
+        The largest number of sequences per forward pass.
+    max_wait : float, optional
+        Default is 0.01. The latency budget, in seconds, for waiting on
+        other submissions to fill a batch.
+    use_cuda : bool, optional
+        Default is False.
+    """
+
+    def __init__(self, model, batch_size, max_wait=0.01, use_cuda=False):
+        self.model = model
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.use_cuda = use_cuda
+        self.stats = {'batches': 0, 'sequences': 0, 'requests': 0}
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def predict(self, encodings):
+        """
+        The predictions for `encodings` (N x sequence length x 4), once
+        their batches have run.
+        """
+        request = {'encodings': np.asarray(encodings, dtype=np.float32),
+                   'done': threading.Event()}
+        self._queue.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['outputs']
+
+    def _collect(self):
+        requests = [self._queue.get()]
+        if requests[0] is None:
+            return None
+        n_sequences = len(requests[0]['encodings'])
+        deadline = time.perf_counter() + self.max_wait
+        while n_sequences < self.batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                self._queue.put(None)
+                break
+            requests.append(request)
+            n_sequences += len(request['encodings'])
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._collect()
+            if requests is None:
+                return
+            try:
+                encodings = np.concatenate(
+                    [request['encodings'] for request in requests])
+                outputs = []
+                for start in range(0, len(encodings), self.batch_size):
+                    outputs.append(predict(
+                        self.model, encodings[start:start + self.batch_size],
+                        use_cuda=self.use_cuda))
+                    self.stats['batches'] += 1
+                outputs = np.concatenate(outputs)
+                self.stats['sequences'] += len(encodings)
+                self.stats['requests'] += len(requests)
+                start = 0
+                for request in requests:
+                    end = start + len(request['encodings'])
+                    request['outputs'] = outputs[start:end]
+                    start = end
+            except Exception as error:
+                for request in requests:
+                    request['error'] = error
+            for request in requests:
+                request['done'].set()
+
+    def close(self):
+        """Stop once the submitted sequences have run."""
+        self._queue.put(None)
+        self._thread.join()
+
+
+def predict_pinned(model, encodings, use_cuda=False):
+    """
+    As Selene's `predict`, for a float32 tensor of encodings (N x sequence
+    length x 4). With `use_cuda`, pin the encodings in page-locked memory
+    beforehand (e.g. with `Tensor.pin_memory` in another thread) and they
+    are copied to the GPU asynchronously.
+    """
+    if use_cuda:
+        encodings = encodings.cuda(non_blocking=True)
+    with torch.no_grad():
+        outputs = model.forward(encodings.transpose(1, 2))
+    return outputs.data.cpu().numpy()
+
+
+def run_pipeline(batches, fetch, compute, write, fetch_workers=1, depth=2):
+    """
+    Run `write(compute(fetch(batch)))` for each of `batches`, in order,
+    with the three stages overlapped: `fetch` runs in a pool of
+    `fetch_workers` threads, `compute` in the calling thread (e.g. the
+    model, which keeps its CUDA stream and torch threads) and `write` in
+    one background thread, so the steady-state time per batch is that of
+    the slowest stage rather than the sum of the stages. At most about
+    `depth` batches wait between consecutive stages, so a slow stage
+    holds back the stages before it instead of buffering the input in
+    memory. An exception in any stage stops the pipeline and is raised
+    once the threads have finished.
+    """
+    fetched = queue.Queue(maxsize=max(depth, fetch_workers))
+    computed = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    errors = []
+
+    def put(items, item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(items):
+        while not stop.is_set():
+            try:
+                return items.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def fail(error):
+        errors.append(error)
+        stop.set()
+
+    def feed(executor):
+        try:
+            for batch in batches:
+                # the futures are queued in input order
+                if not put(fetched, executor.submit(fetch, batch)):
+                    return
+        except BaseException as error:
+            fail(error)
+        finally:
+            put(fetched, None)
+
+    def drain():
+        try:
+            while True:
+                outputs = get(computed)
+                if outputs is None:
+                    return
+                write(outputs)
+        except BaseException as error:
+            fail(error)
+
+    with ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+        feeder = threading.Thread(target=feed, args=(executor,), daemon=True)
+        writer = threading.Thread(target=drain, daemon=True)
+        feeder.start()
+        writer.start()
+        try:
+            while True:
+                future = get(fetched)
+                if future is None:
+                    break
+                if not put(computed, compute(future.result())):
+                    break
+        except BaseException as error:
+            fail(error)
+        finally:
+            put(computed, None)
+            writer.join()
+            stop.set()
+            feeder.join()
+    if errors:
+        raise errors[0]
+
+
+def load_reference_sequence(genome, resources_dir='resources'):
+    """
+    The reference sequence for the `--genome` option of the `1_*`
+    scripts: 'hg19' or 'hg38' for `<resources_dir>/<genome>_UCSC.fa`,
+    read from the genome packed by `compile_packed_genome.py` at
+    `<resources_dir>/<genome>_UCSC.packed.bin` if there is one, or the
+    path to a FASTA file or a packed genome.
+    """
+    if genome in ('hg19', 'hg38'):
+        genome = os.path.join(resources_dir, '{0}_UCSC.fa'.format(genome))
+        packed = '{0}.packed.bin'.format(genome[:-len('.fa')])
+        if os.path.exists(packed):
+            genome = packed
+    elif not os.path.exists(genome):
+        raise ValueError("--genome=<hg> must be 'hg19', 'hg38' or the path to "
+                         "a FASTA file or packed genome")
+    if is_packed_genome(genome):
+        return PackedGenome(genome)
+    return Genome(genome)
+
+
+def load_seqclass_projection(path):
+    """
+    Load the sequence class projection from a Sei model directory or a
+    compiled projection artifact.
+    """
+    if os.path.isdir(path):
+        return get_projection(path)
+    return load_projection_artifact(path)
+
+
+def use_sei_analyze_sequences(configs, **kwargs):
+    """
+    Make `configs["analyze_sequences"]` (loaded with `instantiate=False`)
+    construct a `SeiAnalyzeSequences` with the keyword arguments `kwargs`.
+    """
+    configs["analyze_sequences"] = configs["analyze_sequences"]._replace(
+        callable=SeiAnalyzeSequences)
+    configs["analyze_sequences"].bind(**kwargs)
+
+
+def _input_format(input_path):
+    # the input types `get_predictions` and `variant_effect_prediction` accept
+    if input_path.endswith('.vcf'):
+        return 'vcf'
+    if input_path.endswith('.fa') or input_path.endswith('.fasta'):
+        return 'fasta'
+    return 'bed'
+
+
+def _is_record(line, input_format):
+    if input_format == 'vcf':
+        return not line.startswith('#')
+    if input_format == 'fasta':
+        return line.startswith('>')
+    return True
+
+
+def write_input_shard(input_path, shard, n_shards, output_path):
+    """
+    Write shard `shard` (0-based) of `n_shards` contiguous shards of a
+    BED, FASTA or VCF file, with the same number of records (+/- 1) in
+    each. VCF header lines are copied to every shard.
+
+    Returns
+    -------
+    int
+        The index of the first record of the shard in `input_path`, i.e.
+        the offset of the `index` column of the shard's row labels.
+    """
+    input_format = _input_format(input_path)
+    with open(input_path, 'r') as file_handle:
+        n_records = sum(1 for line in file_handle
+                        if _is_record(line, input_format))
+    start = shard * n_records // n_shards
+    end = (shard + 1) * n_records // n_shards
+    record = -1
+    with open(input_path, 'r') as read_handle, \
+            open(output_path, 'w') as write_handle:
+        for line in read_handle:
+            if _is_record(line, input_format):
+                record += 1
+            elif input_format == 'vcf':
+                write_handle.write(line)
+                continue
+            if start <= record < end:
+                write_handle.write(line)
+    return start
+
+
+def parse_shard(shard):
+    """
+    Parse a shard specification '<i>/<n>' (0-based `i`) into `(i, n)`.
+    """
+    try:
+        shard, n_shards = [int(value) for value in shard.split('/')]
+    except ValueError:
+        raise ValueError("--shard must be '<i>/<n>', e.g. '0/4', "
+                         "but was '{0}'".format(shard))
+    if not 0 <= shard < n_shards:
+        raise ValueError("--shard '<i>/<n>' requires 0 <= i < n, "
+                         "but was '{0}/{1}'".format(shard, n_shards))
+    return shard, n_shards
+
+
+def prepare_shards(input_path, output_dir, n_shards, shards=None):
+    """
+    Write the input shards `shards` (default: all of them) to
+    `<output_dir>/shards/<i>-of-<n_shards>/`, along with a `shard.json`
+    used by `merge_shards`.
+
+    Returns
+    -------
+    list(tuple(str, str))
+        The shard input path and shard output directory for each shard.
+    """
+    if shards is None:
+        shards = range(n_shards)
+    prepared = []
+    for shard in shards:
+        if not 0 <= shard < n_shards:
+            raise ValueError("Shard {0} is not in 0..{1}".format(
+                shard, n_shards - 1))
+        shard_dir = os.path.join(
+            output_dir, "shards", "{0}-of-{1}".format(shard, n_shards))
+        os.makedirs(shard_dir, exist_ok=True)
+        shard_input = os.path.join(shard_dir, os.path.basename(input_path))
+        index_offset = write_input_shard(
+            input_path, shard, n_shards, shard_input)
+        with open(os.path.join(shard_dir, "shard.json"), 'w') as file_handle:
+            json.dump({'shard': shard, 'n_shards': n_shards,
+                       'index_offset': index_offset}, file_handle)
+        prepared.append((shard_input, shard_dir))
+    return prepared
+
+
+def build_analyze_sequences(configs):
+    """
+    Construct the `AnalyzeSequences` object from `configs` (loaded with
+    `instantiate=False`), as `parse_configs_and_run` does for `ops:
+    [analyze]`, without running any of the configured operations.
+    """
+    model, _ = initialize_model(configs["model"], train=False)
+    configs["analyze_sequences"].bind(model=model)
+    return instantiate(configs["analyze_sequences"])
+
+
+def run_shards_in_workers(configs, n_workers, run_shard):
+    """
+    Construct the `AnalyzeSequences` object from `configs` (loaded with
+    `instantiate=False`) once, then call `run_shard(analyze_seqs, shard)`
+    for shards 0 to `n_workers` - 1, each in a forked worker process with
+    its share of the torch threads. The model weights are moved to shared
+    memory before forking, so they are loaded once for all of the workers.
+    """
+    n_threads = torch.get_num_threads()
+    # OpenMP thread pools do not survive a fork, so only the workers start
+    # them
+    torch.set_num_threads(1)
+    analyze_seqs = build_analyze_sequences(configs)
+    analyze_seqs.model.share_memory()
+
+    def worker(shard):
+        torch.set_num_threads(max(1, n_threads // n_workers))
+        profiler = getattr(analyze_seqs, 'profiler', None)
+        if profiler is not None:
+            profiler.reset()
+            profiler.set_context(shard=shard)
+        run_shard(analyze_seqs, shard)
+        # forked workers exit without running the `atexit` handlers
+        if profiler is not None:
+            profiler.close()
+
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=worker, args=(shard,))
+                 for shard in range(n_workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    failed = [shard for shard, process in enumerate(processes)
+              if process.exitcode != 0]
+    if failed:
+        raise RuntimeError("Shard(s) {0} failed".format(failed))
+
+
+def _merge_text(paths, index_offsets, output_path, header):
+    with open(output_path, 'w') as write_handle:
+        for i, (path, index_offset) in enumerate(zip(paths, index_offsets)):
+            with open(path, 'r') as read_handle:
+                if header:
+                    first = read_handle.readline()
+                    if i == 0:
+                        write_handle.write(first)
+                    offset_index = first.split('\t')[0] == 'index'
+                else:
+                    offset_index = False
+                for line in read_handle:
+                    if offset_index:
+                        index, rest = line.split('\t', 1)
+                        line = "{0}\t{1}".format(int(index) + index_offset, rest)
+                    write_handle.write(line)
+
+
+def _create_dataset_like(write_handle, key, dataset, n_rows):
+    # an empty copy of `dataset` with `n_rows` rows
+    shape = (n_rows,) + dataset.shape[1:]
+    dtype = dataset.dtype
+    if key == "data" and dtype.name in COMPACT_DTYPES:
+        value_range = None
+        if 'scale' in dataset.attrs:
+            offset = dataset.attrs['offset']
+            value_range = (offset, offset + 254 * dataset.attrs['scale'])
+        return create_compact_dataset(
+            write_handle, shape, dtype.name, value_range=value_range)
+    return write_handle.create_dataset(key, shape, dtype=dtype)
+
+
+def _merge_hdf5(paths, output_path, chunk_rows=10000):
+    with h5py.File(paths[0], 'r') as first, \
+            h5py.File(output_path, 'w') as write_handle:
+        for key in first:
+            n_rows = 0
+            for path in paths:
+                with h5py.File(path, 'r') as read_handle:
+                    n_rows += read_handle[key].shape[0]
+            merged = _create_dataset_like(write_handle, key, first[key], n_rows)
+            row = 0
+            for path in paths:
+                with h5py.File(path, 'r') as read_handle:
+                    data = read_handle[key]
+                    for start in range(0, data.shape[0], chunk_rows):
+                        chunk = data[start:start + chunk_rows]
+                        merged[row:row + len(chunk)] = chunk
+                        row += len(chunk)
+
+
+def merge_shards(output_dir, keep_shards=False):
+    """
+    Merge the outputs of the shards in `<output_dir>/shards/` (see
+    `prepare_shards`) into `output_dir`, in the order of the original
+    input. HDF5 files are concatenated along the rows, as are the row
+    labels (with the `index` column of BED and FASTA inputs offset to the
+    original input) and the `.NA` files. Other files are copied from the
+    first shard.
+    """
+    shards = {}
+    for path in glob.glob(os.path.join(output_dir, "shards", "*", "shard.json")):
+        with open(path, 'r') as file_handle:
+            shard = json.load(file_handle)
+        shards[shard['shard']] = (os.path.dirname(path), shard)
+    if not shards:
+        raise ValueError("No shards found in '{0}'".format(
+            os.path.join(output_dir, "shards")))
+    n_shards = shards[min(shards)][1]['n_shards']
+    missing = [i for i in range(n_shards) if i not in shards]
+    if missing or len(shards) != n_shards:
+        raise ValueError("Missing shard(s) {0} of {1}".format(missing, n_shards))
+    shard_dirs = [shards[i][0] for i in range(n_shards)]
+    index_offsets = [shards[i][1]['index_offset'] for i in range(n_shards)]
+
+    for subdir in sorted(os.listdir(shard_dirs[0])):
+        if not os.path.isdir(os.path.join(shard_dirs[0], subdir)):
+            continue
+        os.makedirs(os.path.join(output_dir, subdir), exist_ok=True)
+        filenames = set()
+        for shard_dir in shard_dirs:
+            filenames.update(os.listdir(os.path.join(shard_dir, subdir)))
+        for filename in sorted(filenames):
+            found = [(os.path.join(shard_dir, subdir, filename), index_offset)
+                     for shard_dir, index_offset in zip(shard_dirs, index_offsets)
+                     if os.path.exists(os.path.join(shard_dir, subdir, filename))]
+            paths = [path for path, _ in found]
+            offsets = [index_offset for _, index_offset in found]
+            output_path = os.path.join(output_dir, subdir, filename)
+            if filename.endswith('.h5'):
+                _merge_hdf5(paths, output_path)
+            elif filename.endswith('_row_labels.txt') or filename.endswith('.tsv'):
+                _merge_text(paths, offsets, output_path, header=True)
+            elif filename.endswith('.NA'):
+                _merge_text(paths, offsets, output_path, header=False)
+            else:
+                shutil.copyfile(paths[0], output_path)
+    if not keep_shards:
+        shutil.rmtree(os.path.join(output_dir, "shards"))
+
+
+def read_vcf_manifest(path):
+    """
+    The VCF files listed in a manifest file, one path per line. Relative
+    paths are relative to the directory of the manifest. Blank lines and
+    lines starting with '#' are skipped.
+    """
+    vcf_files = []
+    with open(path, 'r') as file_handle:
+        for line in file_handle:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            vcf_files.append(os.path.join(os.path.dirname(path), line))
+    if not vcf_files:
+        raise ValueError("No VCF files listed in '{0}'".format(path))
+    return vcf_files
+
+
+def write_variant_union(vcf_files,
+                        output_path,
+                        reference_sequence,
+                        sequence_length,
+                        strand_index=None,
+                        require_strand=False,
+                        na_dir=None):
+    """
+    Read each of `vcf_files` as `variant_effect_prediction` does, and
+    write the distinct variants (chrom, pos, ref, alt and strand) of all
+    of them to the VCF file `output_path`, once each, in the order they
+    first occur, with their row (0-based) as their ID, which
+    `split_variant_union` checks the outputs against. Its strand column
+    is column 5. The variants of
+    `<prefix>.vcf` that cannot be predicted are written to
+    `<na_dir>/<prefix>.NA`.
+
+    Returns
+    -------
+    list(tuple(str, numpy.ndarray, list(str)))
+        For each of `vcf_files`, its output prefix, the row in
+        `output_path` of each of its variants and the names (IDs) of its
+        variants. See `split_variant_union`.
+    """
+    prefixes = ['.'.join(os.path.basename(vcf_file).split('.')[:-1])
+                for vcf_file in vcf_files]
+    duplicates = sorted({prefix for prefix in prefixes
+                         if prefixes.count(prefix) > 1})
+    if duplicates:
+        raise ValueError("The outputs are named after the VCF files, which "
+                         "must have distinct names: {0}".format(
+                             ', '.join(duplicates)))
+    start_radius = sequence_length // 2
+    union = {}
+    files = []
+    with open(output_path, 'w') as file_handle:
+        file_handle.write("#CHROM\tPOS\tID\tREF\tALT\tSTRAND\n")
+        for vcf_file, prefix in zip(vcf_files, prefixes):
+            na_file = None
+            if na_dir is not None:
+                na_file = os.path.join(na_dir, "{0}.NA".format(prefix))
+            variants = read_vcf_file(
+                vcf_file,
+                strand_index=strand_index,
+                require_strand=require_strand,
+                output_NAs_to_file=na_file,
+                seq_context=(start_radius, sequence_length - start_radius),
+                reference_sequence=reference_sequence)
+            rows = np.empty(len(variants), dtype=np.int64)
+            for i, (chrom, pos, _, ref, alt, strand) in enumerate(variants):
+                key = (chrom, pos, ref, alt, strand)
+                if key not in union:
+                    union[key] = len(union)
+                    file_handle.write("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n".format(
+                        chrom, pos, union[key], ref or '-', alt, strand))
+                rows[i] = union[key]
+            files.append((prefix, rows, [variant[2] for variant in variants]))
+    return files
+
+
+def _union_line_offsets(path, n_rows):
+    """
+    The byte offset of each row of a row labels or TSV file written for
+    the VCF file of `write_variant_union`, after checking that it has the
+    `n_rows` variants of the union in order, i.e. that the name column (as
+    in `VARIANTEFFECT_COLS`) of row i is i.
+    """
+    offsets = np.empty(n_rows, dtype=np.int64)
+    row = 0
+    with open(path, 'rb') as read_handle:
+        offset = len(read_handle.readline())
+        for line in read_handle:
+            cols = line.split(b'\t', 3)
+            if row == n_rows or len(cols) < 3 or \
+                    cols[2] != str(row).encode():
+                row = None
+                break
+            offsets[row] = offset
+            offset += len(line)
+            row += 1
+    if row != n_rows:
+        raise ValueError("'{0}' does not have one row for each of the {1} "
+                         "variants of the union, in order".format(
+                             path, n_rows))
+    return offsets
+
+
+def _gather_text(path, offsets, rows, names, output_path):
+    # the header and `rows` (at `offsets`) of a row labels or TSV file,
+    # with the name column replaced by `names`
+    with open(path, 'rb') as read_handle, \
+            open(output_path, 'wb') as write_handle:
+        write_handle.write(read_handle.readline())
+        for row, name in zip(rows, names):
+            read_handle.seek(offsets[row])
+            cols = read_handle.readline().split(b'\t', 3)
+            cols[2] = name.encode()
+            write_handle.write(b'\t'.join(cols))
+
+
+def _gather_hdf5(path, rows, output_path, chunk_rows=10000):
+    with h5py.File(path, 'r') as read_handle, \
+            h5py.File(output_path, 'w') as write_handle:
+        for key in read_handle:
+            data = read_handle[key]
+            gathered = _create_dataset_like(write_handle, key, data, len(rows))
+            for start in range(0, len(rows), chunk_rows):
+                chunk = rows[start:start + chunk_rows]
+                low, high = chunk.min(), chunk.max() + 1
+                if high - low <= 4 * len(chunk):
+                    # one read of the span of the rows
+                    values = data[low:high][chunk - low]
+                else:
+                    unique, inverse = np.unique(chunk, return_inverse=True)
+                    values = data[unique][inverse]
+                gathered[start:start + len(chunk)] = values
+
+
+def split_variant_union(union_dir, files, output_dir, union_prefix='union'):
+    """
+    Write the outputs of each VCF file of `write_variant_union` to
+    `output_dir`, from the outputs of `variant_effect_prediction` on the
+    union VCF file `<union_prefix>.vcf` in `union_dir`: the rows of the
+    HDF5 files, row labels and TSV files are gathered in the order of the
+    file's variants, with the file's variant names. Other files are
+    copied, except the union's `.NA` file.
+
+    Raises a ValueError, before writing any output, if an output of the
+    union does not have one row for each variant of the union in order.
+    """
+    n_rows = max([rows.max() + 1 for _, rows, _ in files if len(rows)],
+                 default=0)
+    filenames = [filename for filename in sorted(os.listdir(union_dir))
+                 if filename.startswith(union_prefix) and
+                 filename != union_prefix + '.NA']
+    offsets = {}
+    for filename in filenames:
+        path = os.path.join(union_dir, filename)
+        if filename.endswith('.h5'):
+            with h5py.File(path, 'r') as read_handle:
+                if any(read_handle[key].shape[0] != n_rows
+                       for key in read_handle):
+                    raise ValueError(
+                        "'{0}' does not have one row for each of the {1} "
+                        "variants of the union".format(path, n_rows))
+        elif filename.endswith('_row_labels.txt') or \
+                filename.endswith('.tsv'):
+            offsets[filename] = _union_line_offsets(path, n_rows)
+    for filename in filenames:
+        suffix = filename[len(union_prefix):]
+        path = os.path.join(union_dir, filename)
+        for prefix, rows, names in files:
+            output_path = os.path.join(output_dir, prefix + suffix)
+            if filename.endswith('.h5'):
+                _gather_hdf5(path, rows, output_path)
+            elif filename in offsets:
+                _gather_text(path, offsets[filename], rows, names,
+                             output_path)
+            else:
+                shutil.copyfile(path, output_path)
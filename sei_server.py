@@ -0,0 +1,316 @@
+"""
+Description:
+    Serves Sei predictions from a long-running process that keeps the
+    model and the reference genome loaded, so each query only pays for its
+    own prediction. Concurrent requests are coalesced into micro-batches
+    (see `predict_utils.MicroBatcher`). Listens for HTTP on a local port,
+    or on a Unix socket with --socket.
+
+    Endpoints (JSON):
+    GET  /health     Status and batching statistics.
+    GET  /columns    The chromatin profile and sequence class names.
+    POST /sequences  {"sequences": ["ACGT...", ...]} or
+                     {"regions": [["chr1", start, end], ...]}, scored as
+                     `1_sequence_prediction.py` scores FASTA or BED input.
+    POST /variants   {"variants": [{"chrom": "chr1", "pos": 1000, "ref": "A",
+                     "alt": "G", "strand": "+"}, ...]}, with `pos` as in a
+                     VCF file, scored as `1_variant_effect_prediction.py`
+                     does.
+    Each POST may set "output" to "sequence_classes" (default: the raw
+    sequence class scores of sequences, or the histone-normalized variant
+    effect scores of variants) or "chromatin_profiles" (the predictions,
+    or the ref and alt predictions of variants), and "targets" to a list
+    of chromatin profile names to return only those columns.
+
+Usage:
+    sei_server.py [--genome=<hg>] [--cuda] [--host=<host>] [--port=<port>]
+                  [--socket=<path>] [--batch-size=<n>] [--max-wait-ms=<ms>]
+                  [--projection=<path>] [--fuse] [--precision=<p>]
+                  [--autotune]
+    sei_server.py -h | --help
+
+Options:
+    -h --help               Show this screen.
+    --genome=<hg>           hg38 or hg19, or the path to a FASTA file or a
+                            genome packed by `compile_packed_genome.py`.
+                            [default: hg19]
+    --cuda                  Run prediction on a CUDA-enabled GPU
+    --host=<host>           The address to listen on. [default: 127.0.0.1]
+    --port=<port>           The HTTP port to listen on. [default: 8321]
+    --socket=<path>         Listen on this Unix socket instead of a port.
+    --batch-size=<n>        The largest micro-batch. Defaults to the
+                            `batch_size` in `model/sei_seq_prediction.yml`.
+    --max-wait-ms=<ms>      How long the first request of a micro-batch waits
+                            for other requests to join it. [default: 10]
+    --projection=<path>     The Sei model directory or a projection artifact
+                            compiled by `compile_projection.py`. Defaults to
+                            `./model`.
+    --fuse                  Merge the linear convolution pairs and remove the
+                            dropout layers of the loaded model before
+                            prediction (see `Sei.fuse_for_inference`).
+    --precision=<p>         fp32, bf16 or int8 (see
+                            `1_sequence_prediction.py`). [default: fp32]
+    --autotune              Choose the largest micro-batch with calibration
+                            forward passes (see `1_sequence_prediction.py`).
+
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import signal
+import socketserver
+import threading
+
+from docopt import docopt
+import numpy as np
+
+from selene_sdk.utils import load_path
+
+from predict_utils import MicroBatcher, build_analyze_sequences
+from predict_utils import encode_variant, get_target_indices
+from predict_utils import load_reference_sequence, load_seqclass_projection
+from predict_utils import use_sei_analyze_sequences
+from utils import sc_hnorm_varianteffect_fused, sc_projection
+
+
+OUTPUTS = ['sequence_classes', 'chromatin_profiles']
+
+
+def _finditem(obj, val):
+    for k, v in obj.items():
+        if hasattr(v, 'keywords'):
+            _finditem(v.keywords, val)
+        elif isinstance(v, dict):
+            _finditem(v, val)
+        elif isinstance(v, str) and '<PATH>' in v:
+            obj[k] = v.replace('<PATH>', val)
+
+
+class SeiService(object):
+    """
+    Scores the sequences, regions and variants of requests with a
+    resident `SeiAnalyzeSequences` through a shared `MicroBatcher`.
+    """
+
+    def __init__(self, analyze_seqs, projection, batcher):
+        self.analyze_seqs = analyze_seqs
+        self.projection = projection
+        self.batcher = batcher
+        self.genome = analyze_seqs.reference_sequence
+        # pyfaidx file handles are not thread-safe
+        self._genome_lock = threading.Lock()
+
+    def _check_output(self, request):
+        output = request.get('output', 'sequence_classes')
+        if output not in OUTPUTS:
+            raise ValueError("`output` must be one of {0}".format(OUTPUTS))
+        target_ixs = None
+        if request.get('targets') is not None:
+            if output != 'chromatin_profiles':
+                raise ValueError("`targets` requires `output` "
+                                 "'chromatin_profiles'")
+            target_ixs = get_target_indices(
+                self.analyze_seqs.features, request['targets'])
+        return output, target_ixs
+
+    def _chrom(self, chrom):
+        chrom = str(chrom)
+        if chrom not in self.genome.get_chrs() and \
+                'chr' + chrom in self.genome.get_chrs():
+            chrom = 'chr' + chrom
+        return chrom
+
+    def sequences(self, request):
+        output, target_ixs = self._check_output(request)
+        analyze_seqs = self.analyze_seqs
+        if 'sequences' in request:
+            encodings = [self.genome.sequence_to_encoding(
+                analyze_seqs._pad_or_truncate_sequence(str(sequence).upper()))
+                for sequence in request['sequences']]
+        elif 'regions' in request:
+            encodings = []
+            with self._genome_lock:
+                for chrom, start, end in request['regions']:
+                    # the window `get_predictions` centers on a BED region
+                    chrom = self._chrom(chrom)
+                    mid_pos = int(start) + ((int(end) - int(start)) // 2)
+                    seq_start = mid_pos - analyze_seqs._start_radius
+                    seq_end = mid_pos + analyze_seqs._end_radius
+                    if chrom not in self.genome.get_chrs() or \
+                            not self.genome.coords_in_bounds(
+                                chrom, seq_start, seq_end):
+                        raise ValueError("{0}:{1}-{2} is not in the reference "
+                                         "sequence with enough context".format(
+                                             chrom, start, end))
+                    encodings.append(self.genome.get_encoding_from_coords(
+                        chrom, seq_start, seq_end))
+        else:
+            raise ValueError("Specify `sequences` or `regions`")
+        if not encodings:
+            return {output: []}
+        predictions = self.batcher.predict(np.stack(encodings))
+        if output == 'chromatin_profiles':
+            if target_ixs is not None:
+                predictions = predictions[:, target_ixs]
+            return {output: predictions.tolist()}
+        # as `SequenceClassHandler`
+        scores = sc_projection(
+            predictions.astype(np.float64),
+            self.projection['projvec'][:self.projection['n_classes']],
+            normalized=True)
+        return {output: scores.tolist()}
+
+    def variants(self, request):
+        output, target_ixs = self._check_output(request)
+        refs, alts, labels = [], [], []
+        with self._genome_lock:
+            for variant in request['variants']:
+                chrom = self._chrom(variant['chrom'])
+                ref = variant.get('ref', '')
+                ref = '' if ref == '-' else ref
+                ref_encoding, alt_encoding, match, contains_unk = \
+                    encode_variant(
+                        self.genome, self.analyze_seqs.sequence_length,
+                        chrom, int(variant['pos']), ref, variant['alt'],
+                        strand=variant.get('strand', '+'))
+                refs.append(ref_encoding)
+                alts.append(alt_encoding)
+                labels.append({'ref_match': match,
+                               'contains_unk': contains_unk})
+        if not refs:
+            return {output: [], 'labels': []}
+        predictions = self.batcher.predict(np.stack(refs + alts))
+        ref_predictions = predictions[:len(refs)]
+        alt_predictions = predictions[len(refs):]
+        if output == 'chromatin_profiles':
+            if target_ixs is not None:
+                ref_predictions = ref_predictions[:, target_ixs]
+                alt_predictions = alt_predictions[:, target_ixs]
+            return {'ref': ref_predictions.tolist(),
+                    'alt': alt_predictions.tolist(),
+                    'labels': labels}
+        # as `SequenceClassVariantEffectHandler`
+        scores = sc_hnorm_varianteffect_fused(
+            ref_predictions.astype(np.float64),
+            alt_predictions.astype(np.float64),
+            self.projection['hnorm_projvec'])
+        return {output: scores.tolist(), 'labels': labels}
+
+    def health(self):
+        return dict(self.batcher.stats,
+                    status='ok',
+                    batch_size=self.batcher.batch_size,
+                    max_wait_ms=self.batcher.max_wait * 1000)
+
+    def columns(self):
+        return {'chromatin_profiles': list(self.analyze_seqs.features),
+                'sequence_classes': list(self.projection['seqclass_names'])}
+
+
+class SeiRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'SeiServer/1.0'
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == '/health':
+            self._reply(200, service.health())
+        elif self.path == '/columns':
+            self._reply(200, service.columns())
+        else:
+            self._reply(404, {'error': "Unknown path '{0}'".format(self.path)})
+
+    def do_POST(self):
+        service = self.server.service
+        routes = {'/sequences': service.sequences,
+                  '/variants': service.variants}
+        if self.path not in routes:
+            self._reply(404, {'error': "Unknown path '{0}'".format(self.path)})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+            response = routes[self.path](request)
+        except (ValueError, KeyError, TypeError) as error:
+            self._reply(400, {'error': str(error)})
+            return
+        self._reply(200, response)
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super(UnixHTTPServer, self).get_request()
+        # `BaseHTTPRequestHandler` logs the client host
+        return request, ('unix', 0)
+
+
+if __name__ == "__main__":
+    arguments = docopt(
+        __doc__,
+        version='1.0.0')
+
+    # Assumes that the `models` directory is in the same directory as this
+    # script. Please update this line if not.
+    use_dir = os.path.dirname(os.path.abspath(__file__))
+    use_cuda = arguments["--cuda"]
+
+    projection = arguments["--projection"]
+    if projection is None:
+        projection = os.path.join(use_dir, "model")
+
+    configs = load_path("./model/sei_seq_prediction.yml", instantiate=False)
+    _finditem(configs, use_dir)
+    configs["analyze_sequences"].bind(
+        reference_sequence=load_reference_sequence(arguments["--genome"]),
+        use_cuda=use_cuda)
+    if arguments["--batch-size"] is not None:
+        # `bind` does not replace the values in the YAML config
+        configs["analyze_sequences"].keywords["batch_size"] = int(
+            arguments["--batch-size"])
+    use_sei_analyze_sequences(configs,
+                              fuse_for_inference=arguments["--fuse"],
+                              precision=arguments["--precision"],
+                              autotune=arguments["--autotune"])
+    analyze_seqs = build_analyze_sequences(configs)
+    batcher = MicroBatcher(analyze_seqs.model,
+                           analyze_seqs.batch_size,
+                           max_wait=float(arguments["--max-wait-ms"]) / 1000,
+                           use_cuda=use_cuda)
+
+    if arguments["--socket"] is not None:
+        if os.path.exists(arguments["--socket"]):
+            os.remove(arguments["--socket"])
+        server = UnixHTTPServer(arguments["--socket"], SeiRequestHandler)
+        address = "unix:{0}".format(arguments["--socket"])
+    else:
+        server = ThreadingHTTPServer(
+            (arguments["--host"], int(arguments["--port"])), SeiRequestHandler)
+        address = "http://{0}:{1}".format(*server.server_address[:2])
+    server.service = SeiService(
+        analyze_seqs, load_seqclass_projection(projection), batcher)
+    print("Serving Sei predictions on {0}".format(address), flush=True)
+    # shut down cleanly (e.g. remove the socket) on `kill` as on Ctrl-C
+    signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        if arguments["--socket"] is not None:
+            os.remove(arguments["--socket"])
@@ -0,0 +1,518 @@
+"""
+Selene extensions used to train Sei from pre-materialized training data.
+"""
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+import pandas as pd
+from selene_sdk.samplers import Sampler
+from selene_sdk.sequences import Genome
+from selene_sdk.sequences.genome import _check_coords
+
+from predict_utils import _COMPLEMENT_CODE, _UNPACK_BASES, PackedGenome
+from utils import create_training_shard, load_training_shard
+
+
+MODES = ['train', 'validate', 'test']
+
+_FASTA_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate('ACGT'):
+    _FASTA_CODES[ord(_base)] = _FASTA_CODES[ord(_base.lower())] = _code
+
+
+def _radii(sequence_length, center_bin_to_predict):
+    # the window and target bin radii of `selene_sdk.samplers.OnlineSampler`
+    start_window_radius = sequence_length // 2
+    end_window_radius = sequence_length // 2 + sequence_length % 2
+    if isinstance(center_bin_to_predict, int):
+        start_radius = center_bin_to_predict // 2
+        end_radius = start_radius + center_bin_to_predict % 2
+    else:
+        bin_start, bin_end = center_bin_to_predict
+        start_radius = start_window_radius - bin_start
+        end_radius = end_window_radius - (sequence_length - bin_end)
+    return start_window_radius, end_window_radius, start_radius, end_radius
+
+
+def _mode_chroms(reference_sequence,
+                 sequence_length,
+                 validation_holdout,
+                 test_holdout,
+                 exclude_chrs):
+    """
+    The chromosomes of each mode and their sampling weights, as in
+    `RandomPositionsSampler._partition_genome_by_chromosome`.
+    """
+    chroms = {mode: ([], []) for mode in MODES}
+    for chrom, len_chrom in reference_sequence.get_chr_lens():
+        if any(excl in chrom for excl in exclude_chrs):
+            continue
+        if chrom in validation_holdout:
+            mode = 'validate'
+        elif test_holdout and chrom in test_holdout:
+            mode = 'test'
+        else:
+            mode = 'train'
+        chroms[mode][0].append(chrom)
+        chroms[mode][1].append(len_chrom - 2 * sequence_length)
+    return {mode: (names, np.array(weights, dtype=float) / sum(weights))
+            for mode, (names, weights) in chroms.items() if names}
+
+
+def _window_codes(reference_sequence, chroms, starts, length):
+    # the base codes (A, C, G, T, N = 0, 1, 2, 3, 4) of in-bounds windows
+    if isinstance(reference_sequence, PackedGenome):
+        return reference_sequence._codes(chroms, starts, length)
+    return np.stack([_FASTA_CODES[np.frombuffer(
+        reference_sequence.get_sequence_from_coords(
+            chrom, start, start + length).encode(), dtype=np.uint8)]
+        for chrom, start in zip(chroms, starts)])
+
+
+def _pack_codes(codes):
+    # the `bases` and `unknown` arrays of `create_training_shard`
+    padding = -codes.shape[1] % 8
+    codes = np.pad(codes, ((0, 0), (0, padding)), constant_values=4)
+    unknown = codes == 4
+    codes = np.where(unknown, 0, codes).reshape(len(codes), -1, 4)
+    bases = (codes[..., 0] << 6 | codes[..., 1] << 4 |
+             codes[..., 2] << 2 | codes[..., 3])
+    return bases, np.packbits(unknown, axis=1)
+
+
+def _sample_mode(reference_sequence,
+                 chroms,
+                 chrom_ids,
+                 weights,
+                 shards,
+                 sequence_length,
+                 start_window_radius,
+                 max_unknown,
+                 rng,
+                 draw_size=4096):
+    """
+    Fill `shards` with positions drawn as `RandomPositionsSampler` draws
+    them: a chromosome by weight, a position uniformly at least
+    `sequence_length` from either end and a random strand, redrawn if
+    the window overlaps the blacklist or has more than `max_unknown`
+    unknown bases.
+    """
+    blacklist_tabix = getattr(reference_sequence, '_blacklist_tabix', None)
+    chrom_lens = np.array([reference_sequence.len_chrs[chrom]
+                           for chrom in chroms], dtype=np.int64)
+    chrom_ids = np.asarray(chrom_ids)
+    for shard in shards:
+        n_filled = 0
+        while n_filled < len(shard['position']):
+            chrom_ixs = rng.choice(len(chroms), size=draw_size, p=weights)
+            positions = rng.integers(
+                sequence_length, chrom_lens[chrom_ixs] - sequence_length)
+            starts = positions - start_window_radius
+            keep = np.array([
+                _check_coords(reference_sequence.len_chrs, chroms[i],
+                              start, start + sequence_length,
+                              blacklist_tabix=blacklist_tabix)
+                for i, start in zip(chrom_ixs, starts)], dtype=bool)
+            chrom_ixs, positions, starts = \
+                chrom_ixs[keep], positions[keep], starts[keep]
+            codes = _window_codes(reference_sequence,
+                                  [chroms[i] for i in chrom_ixs],
+                                  starts, sequence_length)
+            keep = (codes == 4).mean(axis=1) <= max_unknown
+            n = min(int(keep.sum()), len(shard['position']) - n_filled)
+            rows = slice(n_filled, n_filled + n)
+            shard['bases'][rows], shard['unknown'][rows] = _pack_codes(
+                codes[keep][:n])
+            shard['chrom'][rows] = chrom_ids[chrom_ixs[keep][:n]]
+            shard['position'][rows] = positions[keep][:n]
+            shard['strand'][rows] = rng.integers(2, size=n)
+            n_filled += n
+
+
+def _fill_targets(target_path,
+                  features,
+                  shards,
+                  chroms,
+                  start_radius,
+                  end_radius,
+                  chunk_rows=10**6):
+    """
+    Set the target bits of the samples in `shards` from one pass over the
+    BED file `target_path`: a feature is positive for a sample if any of
+    its intervals overlaps the target bin, as
+    `GenomicFeatures.get_feature_data` computes it without
+    `feature_thresholds`.
+    """
+    feature_index = {feature: i for i, feature in enumerate(features)}
+    # the positions of each chromosome in sorted order, with their shard
+    # and row in the shard
+    samples = {}
+    for shard_ix, shard in enumerate(shards):
+        for chrom_ix in np.unique(shard['chrom']):
+            rows = np.flatnonzero(shard['chrom'] == chrom_ix)
+            samples.setdefault(chroms[chrom_ix], []).append(
+                (shard['position'][rows], np.full(len(rows), shard_ix), rows))
+    for chrom, parts in samples.items():
+        positions, shard_ixs, rows = [np.concatenate(part)
+                                      for part in zip(*parts)]
+        order = np.argsort(positions, kind='stable')
+        samples[chrom] = (positions[order], shard_ixs[order], rows[order])
+
+    # the feature name is the last column
+    n_cols = len(pd.read_csv(target_path, sep='\t', header=None,
+                             nrows=1).columns)
+    reader = pd.read_csv(target_path, sep='\t', header=None,
+                         usecols=[0, 1, 2, n_cols - 1],
+                         dtype={0: str, n_cols - 1: str},
+                         chunksize=chunk_rows)
+    for chunk in reader:
+        chunk.columns = ['chrom', 'start', 'end', 'feature']
+        chunk['feature'] = chunk['feature'].map(feature_index)
+        chunk = chunk[chunk['chrom'].isin(samples) &
+                      chunk['feature'].notna()]
+        for chrom, intervals in chunk.groupby('chrom', sort=False):
+            positions, shard_ixs, rows = samples[chrom]
+            # the bin [p - start_radius, p + end_radius) overlaps the
+            # interval [start, end) if start - end_radius < p < end +
+            # start_radius
+            low = np.searchsorted(
+                positions, intervals['start'].values - end_radius, 'right')
+            high = np.searchsorted(
+                positions, intervals['end'].values + start_radius, 'left')
+            counts = np.maximum(high - low, 0)
+            if not counts.sum():
+                continue
+            hits = np.repeat(low - np.cumsum(counts) + counts, counts) + \
+                np.arange(counts.sum())
+            feature_ixs = np.repeat(
+                intervals['feature'].values.astype(np.int64), counts)
+            bits = (128 >> (feature_ixs % 8)).astype(np.uint8)
+            for shard_ix in np.unique(shard_ixs[hits]):
+                in_shard = shard_ixs[hits] == shard_ix
+                np.bitwise_or.at(
+                    shards[shard_ix]['targets'],
+                    (rows[hits][in_shard], feature_ixs[in_shard] // 8),
+                    bits[in_shard])
+
+
+def compile_training_data(reference_sequence,
+                          target_path,
+                          features,
+                          output_dir,
+                          n_samples,
+                          sequence_length=1000,
+                          center_bin_to_predict=200,
+                          validation_holdout=['chr6', 'chr7'],
+                          test_holdout=['chr8', 'chr9'],
+                          exclude_chrs=['_'],
+                          max_unknown=0.3,
+                          shard_size=2**16,
+                          seed=436):
+    """
+    Materialize training, validation and test samples, drawn as
+    `selene_sdk.samplers.RandomPositionsSampler` draws them with the same
+    parameters, into memory-mapped shards of at most `shard_size` samples
+    (`create_training_shard`) in `output_dir`, for `MaterializedSampler`.
+    The chromosomes of each mode follow `validation_holdout` and
+    `test_holdout`, and windows overlapping the blacklist regions of
+    `reference_sequence` are not drawn. The positions are drawn once, so
+    training cycles through a fixed set of samples (each reverse
+    complemented at random by `MaterializedSampler`) instead of drawing
+    new ones at every step. Writes `manifest.json` with the shards of
+    each mode and the parameters.
+
+    Parameters
+    ----------
+    reference_sequence : selene_sdk.sequences.Genome
+        The reference genome, e.g. a `PackedGenome`, which is fetched from
+        in vectorized batches.
+    target_path : str
+        The sorted BED file of the target features (the `target_path` of
+        `RandomPositionsSampler`), read once from start to end.
+    features : list(str)
+        The target features, in the order of the model outputs.
+    output_dir : str
+        The output directory.
+    n_samples : dict
+        The number of samples of each mode, e.g. `{'train': 10**7,
+        'validate': 32000}`.
+    max_unknown : float, optional
+        Default is 0.3. The largest fraction of unknown bases of a window.
+    shard_size : int, optional
+        Default is 65536. The largest number of samples of a shard.
+    seed : int, optional
+        Default is 436. The seed of the random positions and strands.
+
+    See `RandomPositionsSampler` for the remaining parameters. Only
+    holdouts by chromosome and targets without `feature_thresholds` are
+    supported.
+    """
+    if not isinstance(validation_holdout, (list, tuple)) or \
+            (test_holdout and not isinstance(test_holdout, (list, tuple))):
+        raise ValueError("Only holdouts by chromosome (lists of "
+                         "chromosomes) are supported")
+    start_window_radius, _, start_radius, end_radius = _radii(
+        sequence_length, center_bin_to_predict)
+    mode_chroms = _mode_chroms(reference_sequence, sequence_length,
+                               validation_holdout, test_holdout or [],
+                               exclude_chrs)
+    chroms = sorted({chrom for names, _ in mode_chroms.values()
+                     for chrom in names})
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+
+    manifest = {
+        'sequence_length': sequence_length,
+        'center_bin_to_predict': center_bin_to_predict,
+        'validation_holdout': list(validation_holdout),
+        'test_holdout': list(test_holdout or []),
+        'exclude_chrs': list(exclude_chrs),
+        'max_unknown': max_unknown,
+        'reference_sequence': os.path.basename(reference_sequence.input_path),
+        'blacklist_regions': reference_sequence.blacklist_regions,
+        'target_path': os.path.basename(target_path),
+        'seed': seed,
+        'features': list(features),
+        'modes': {},
+    }
+    all_shards = []
+    for mode in MODES:
+        if not n_samples.get(mode):
+            continue
+        if mode not in mode_chroms:
+            raise ValueError("No chromosomes to draw {0} samples from".format(
+                mode))
+        names, weights = mode_chroms[mode]
+        filenames, shards = [], []
+        for i, start in enumerate(range(0, n_samples[mode], shard_size)):
+            filenames.append("{0}-{1:05d}.bin".format(mode, i))
+            shards.append(create_training_shard(
+                os.path.join(output_dir, filenames[-1]),
+                min(shard_size, n_samples[mode] - start),
+                sequence_length,
+                len(features),
+                mode=mode,
+                chroms=chroms))
+        _sample_mode(reference_sequence, names,
+                     [chroms.index(chrom) for chrom in names], weights,
+                     shards, sequence_length, start_window_radius,
+                     max_unknown, rng)
+        manifest['modes'][mode] = {'n_samples': n_samples[mode],
+                                   'shards': filenames}
+        all_shards.extend(shards)
+    _fill_targets(target_path, features, all_shards, chroms,
+                  start_radius, end_radius)
+    for shard in all_shards:
+        for array in shard.values():
+            array.flush()
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as file_handle:
+        json.dump(manifest, file_handle)
+    return manifest
+
+
+class MaterializedSampler(Sampler):
+    """
+    Draws the samples of one mode from the shards written by
+    `compile_training_data`, in place of `RandomPositionsSampler` (e.g.
+    as the `train_sampler` and `validate_sampler` of a `MultiSampler`).
+    Each batch is read from the memory-mapped shards and decoded with
+    vectorized lookups, in a background thread that keeps `prefetch`
+    batches ready, so no data loader workers are needed.
+
+    Parameters
+    ----------
+    data_dir : str
+        The `output_dir` of `compile_training_data`.
+    features : list(str)
+        The features of the model, which must be those compiled.
+    mode : {'train', 'validate', 'test'}, optional
+        Default is 'train'. The samples to draw.
+    random_strand : bool or None, optional
+        Default is None (True in 'train' mode). Whether `sample`
+        reverse complements each drawn sample with probability 1/2, as
+        `RandomPositionsSampler` draws a random strand for every sample,
+        instead of using the strand drawn by `compile_training_data`.
+    prefetch : int, optional
+        Default is 4. The number of batches of `sample` prepared ahead.
+        0 reads each batch when it is requested.
+    seed : int, optional
+        Default is 436. The seed of the sample order and strands.
+
+    See `selene_sdk.samplers.Sampler` for the remaining parameters.
+    """
+
+    def __init__(self,
+                 data_dir,
+                 features,
+                 mode='train',
+                 random_strand=None,
+                 prefetch=4,
+                 seed=436,
+                 save_datasets=[],
+                 output_dir=None):
+        super(MaterializedSampler, self).__init__(
+            features,
+            save_datasets=save_datasets,
+            output_dir=output_dir)
+        with open(os.path.join(data_dir, 'manifest.json'), 'r') as file_handle:
+            manifest = json.load(file_handle)
+        if list(features) != manifest['features']:
+            raise ValueError("`features` differ from the features compiled "
+                             "in '{0}'".format(data_dir))
+        if mode not in manifest['modes']:
+            raise ValueError("No {0} samples were compiled in '{1}'".format(
+                mode, data_dir))
+        if mode not in self.modes:
+            self.modes.append(mode)
+        self.mode = mode
+        self.sequence_length = manifest['sequence_length']
+        self.n_features = len(features)
+        self._shards = [load_training_shard(os.path.join(data_dir, filename))
+                        for filename in manifest['modes'][mode]['shards']]
+        self._offsets = np.cumsum(
+            [0] + [len(shard['position']) for shard in self._shards])
+        self.n_samples = int(self._offsets[-1])
+        if random_strand is None:
+            random_strand = mode == 'train'
+        self._random_strand = random_strand
+        self._prefetch = prefetch
+        self._rng = np.random.default_rng(seed)
+        self._order = self._rng.permutation(self.n_samples)
+        self._next = 0
+        encodings = np.zeros((5, 4), dtype=np.float32)
+        for code, base in enumerate('ACGT'):
+            encodings[code, Genome.BASE_TO_INDEX[base]] = 1
+        encodings[4] = np.float32(1) / 4
+        self._encodings = encodings
+        self._prefetcher = None
+
+    def get_feature_from_index(self, index):
+        return self._features[index]
+
+    def _read(self, indices, flip=None):
+        """
+        The sequences and targets of the samples at `indices` (sorted),
+        reverse complemented where `flip` is True or, if `flip` is None,
+        on their compiled strand.
+        """
+        shard_ixs = np.searchsorted(self._offsets, indices, 'right') - 1
+        parts = {name: [] for name in ('bases', 'unknown', 'targets',
+                                       'strand')}
+        for shard_ix in np.unique(shard_ixs):
+            rows = indices[shard_ixs == shard_ix] - self._offsets[shard_ix]
+            for name, values in parts.items():
+                values.append(self._shards[shard_ix][name][rows])
+        bases, unknown, targets, strands = [
+            np.concatenate(values) for values in parts.values()]
+        codes = _UNPACK_BASES[bases].reshape(len(indices), -1)
+        codes = codes[:, :self.sequence_length]
+        codes[np.unpackbits(unknown, axis=1,
+                            count=self.sequence_length) == 1] = 4
+        if flip is None:
+            flip = strands == 1
+        codes[flip] = _COMPLEMENT_CODE[codes[flip, ::-1]]
+        return (self._encodings[codes],
+                np.unpackbits(targets, axis=1,
+                              count=self.n_features).astype(np.float32))
+
+    def _draw(self, batch_size):
+        # the next `batch_size` samples of a random order of all of them,
+        # reshuffled once they have all been drawn
+        indices = []
+        while batch_size:
+            if self._next == self.n_samples:
+                self._order = self._rng.permutation(self.n_samples)
+                self._next = 0
+            n = min(batch_size, self.n_samples - self._next)
+            indices.append(self._order[self._next:self._next + n])
+            self._next += n
+            batch_size -= n
+        indices = np.sort(np.concatenate(indices))
+        flip = None
+        if self._random_strand:
+            flip = self._rng.integers(2, size=len(indices)) == 1
+        return self._read(indices, flip=flip)
+
+    def sample(self, batch_size=1, mode=None):
+        """
+        Draws a batch of samples in a random order that cycles through
+        all of them. Returns the B x L x 4 sequences and the B x F
+        targets.
+        """
+        if not self._prefetch:
+            return self._draw(batch_size)
+        if self._prefetcher is None or \
+                self._prefetcher.batch_size != batch_size:
+            if self._prefetcher is not None:
+                self._prefetcher.close()
+            self._prefetcher = _Prefetcher(
+                lambda: self._draw(batch_size), batch_size, self._prefetch)
+        return self._prefetcher.get()
+
+    def get_data_and_targets(self, batch_size, n_samples=None, mode=None):
+        """
+        The first `n_samples` samples (default: all of them), in their
+        compiled order and on their compiled strand, divided into batches
+        of `batch_size`, and the targets of all of them.
+        """
+        if n_samples is None or n_samples > self.n_samples:
+            n_samples = self.n_samples
+        data_and_targets = []
+        for start in range(0, n_samples, batch_size):
+            data_and_targets.append(self._read(
+                np.arange(start, min(start + batch_size, n_samples))))
+        targets_mat = np.vstack([targets for _, targets in data_and_targets])
+        return data_and_targets, targets_mat
+
+    def get_validation_set(self, batch_size, n_samples=None):
+        return self.get_data_and_targets(batch_size, n_samples)
+
+    def get_test_set(self, batch_size, n_samples=None):
+        return self.get_data_and_targets(batch_size, n_samples)
+
+    def save_dataset_to_file(self, mode, close_filehandle=False):
+        # the samples are already on disk, in `data_dir`
+        return None
+
+
+class _Prefetcher(object):
+    """
+    Calls `read` repeatedly in a daemon thread, keeping up to `depth`
+    results ready for `get`.
+    """
+
+    def __init__(self, read, batch_size, depth):
+        self.batch_size = batch_size
+        self._read = read
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                item = (self._read(), None)
+            except Exception as error:
+                item = (None, error)
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if item[1] is not None:
+                return
+
+    def get(self):
+        batch, error = self._queue.get()
+        if error is not None:
+            raise error
+        return batch
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
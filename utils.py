@@ -1,8 +1,23 @@
+import atexit
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import functools
+import gzip
+import hashlib
+import json
 import os
+import re
+import resource
+import sqlite3
+import sys
+import threading
+import time
 
 import h5py
 import numpy as np
 import pandas as pd
+import pyfaidx
 
 
 def get_targets(filename):
@@ -18,38 +33,527 @@ def get_targets(filename):
 
 def get_data(filename):
     """
-    Load HDF5 file of predictions into memory
+    Load HDF5 file of predictions into memory (compact datasets are
+    decoded to float32)
     """
     fh = h5py.File(filename, 'r')
-    data = fh["data"][()]
+    data = _decode(fh["data"][()], fh["data"])
     fh.close()
     return data
 
 
-def sc_projection(chromatin_profile_preds, clustervfeat):
+def get_data_n_rows(filename):
+    """
+    Get the number of rows in an HDF5 file of predictions without
+    loading the predictions
+    """
+    with h5py.File(filename, 'r') as fh:
+        n_rows = fh["data"].shape[0]
+    return n_rows
+
+
+def get_data_blocks(filename, block_size):
+    """
+    Iterate over an HDF5 file of predictions in blocks of `block_size`
+    rows. Yields `(start, block)` tuples so that peak memory is bounded
+    by the block size rather than the number of rows in the file.
+    """
+    with h5py.File(filename, 'r') as fh:
+        data = fh["data"]
+        for start in range(0, data.shape[0], block_size):
+            yield start, _decode(data[start:start + block_size], data)
+
+
+def get_data_rows(filename, row_ixs):
+    """
+    Load the rows `row_ixs` (in the order given) from an HDF5 file of
+    predictions. h5py only supports increasing indices, so the rows are
+    read in sorted order and then rearranged.
+    """
+    order = np.argsort(row_ixs, kind='stable')
+    sorted_ixs = np.asarray(row_ixs)[order]
+    unique_ixs, inverse = np.unique(sorted_ixs, return_inverse=True)
+    with h5py.File(filename, 'r') as fh:
+        if len(unique_ixs) == 0:
+            return np.empty((0, fh["data"].shape[1]),
+                            dtype=_decoded_dtype(fh["data"]))
+        rows = _decode(fh["data"][unique_ixs.tolist()], fh["data"])
+    data = np.empty((len(order), rows.shape[1]), dtype=rows.dtype)
+    data[order] = rows[inverse]
+    return data
+
+
+COMPACT_DTYPES = ['float16', 'uint8']
+
+
+def create_compact_dataset(hdf5_handle,
+                           shape,
+                           dtype,
+                           value_range=None,
+                           chunk_shape=(1024, 128)):
+    """
+    Create the "data" dataset of a predictions file in a compact dtype
+    (one of `COMPACT_DTYPES`), chunked in blocks of `chunk_shape` rows x
+    columns so that both row blocks and single columns can be read
+    without reading the whole file, and gzip compressed. 'uint8' stores
+    `round((x - offset) / scale)` for values in `value_range`, with
+    `scale` and `offset` as attributes of the dataset.
+    """
+    if dtype not in COMPACT_DTYPES:
+        raise ValueError("dtype must be one of {0}".format(COMPACT_DTYPES))
+    chunks = tuple(max(1, min(n, chunk))
+                   for n, chunk in zip(shape, chunk_shape))
+    data = hdf5_handle.create_dataset(
+        "data", shape, dtype=dtype, chunks=chunks,
+        compression='gzip', compression_opts=4, shuffle=True)
+    if dtype == 'uint8':
+        if value_range is None:
+            raise ValueError("uint8 storage requires a bounded value range")
+        low, high = value_range
+        # 254 steps, so that 0 is exact when the range is symmetric
+        data.attrs['scale'] = (high - low) / 254.
+        data.attrs['offset'] = float(low)
+    return data
+
+
+def encode_compact(values, dtype, attrs):
+    """
+    Convert `values` to the storage `dtype` of a dataset created by
+    `create_compact_dataset`, with the dataset `attrs`.
+    """
+    if 'scale' in attrs:
+        return np.clip(np.round((values - attrs['offset']) / attrs['scale']),
+                       0, 255).astype(np.uint8)
+    return values.astype(dtype)
+
+
+def _decode(values, data):
+    if 'scale' in data.attrs:
+        return (values.astype(np.float32) * np.float32(data.attrs['scale']) +
+                np.float32(data.attrs['offset']))
+    if values.dtype == np.float16:
+        return values.astype(np.float32)
+    return values
+
+
+def _decoded_dtype(data):
+    if 'scale' in data.attrs or data.dtype == np.float16:
+        return np.dtype(np.float32)
+    return data.dtype
+
+
+def _h5_index(index):
+    """
+    Split an index into one h5py accepts (a slice, an int or increasing
+    unique indices) and the selection to apply to its result.
+    """
+    if isinstance(index, (slice, int, np.integer)):
+        return index, slice(None)
+    index = np.asarray(index)
+    if index.dtype == bool:
+        index = np.flatnonzero(index)
+    unique_ixs, inverse = np.unique(index, return_inverse=True)
+    return unique_ixs.tolist(), inverse
+
+
+class DataReader(object):
+    """
+    Lazy access to the "data" dataset of an HDF5 file of predictions,
+    written by Selene or as a compact dataset by `create_compact_dataset`.
+    Indexing with `reader[rows, columns]`, where each index is a slice,
+    an int or a list or array of indices in any order, reads only the
+    chunks that hold the selection and returns it decoded to float32
+    (float64 files are returned as float64).
+
+    Use as a context manager, or call `close`.
+    """
+
+    def __init__(self, filename):
+        self._file = h5py.File(filename, 'r')
+        self._data = self._file["data"]
+        self.shape = self._data.shape
+        self.dtype = _decoded_dtype(self._data)
+        self.attrs = dict(self._data.attrs)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        (rows, row_selection), (cols, col_selection) = [
+            _h5_index(index) for index in key]
+        if isinstance(rows, list) and isinstance(cols, list):
+            # h5py takes one list index per read, so read the column range
+            # and select the columns from it
+            if cols:
+                values = self._data[rows, cols[0]:cols[-1] + 1]
+            else:
+                values = self._data[rows, 0:0]
+            values = values[:, np.asarray(cols, dtype=np.int64) - (
+                cols[0] if cols else 0)]
+        else:
+            values = self._data[rows, cols]
+        values = _decode(values, self._data)
+        if values.ndim == 2:
+            return values[row_selection][:, col_selection]
+        if values.ndim == 1:
+            if isinstance(key[0], (int, np.integer)):
+                return values[col_selection]
+            return values[row_selection]
+        return values
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def sc_projection(chromatin_profile_preds, clustervfeat, normalized=False):
+    """
+    Project chromatin profile predictions onto the sequence class vectors.
+    Pass `normalized=True` if the rows of `clustervfeat` are already unit
+    length (e.g. the `projvec` of a compiled projection artifact).
+    """
+    if normalized:
+        return np.dot(chromatin_profile_preds, clustervfeat.T)
     return (np.dot(chromatin_profile_preds, clustervfeat.T) /
             np.linalg.norm(clustervfeat, axis=1))
 
 
+def sc_hnorm_projection_matrix(clustervfeat, histone_inds, n_classes=40):
+    """
+    Precompute the matrix used by `sc_hnorm_varianteffect_fused`.
+
+    Projection is linear, so the projection of the histone-adjusted
+    chromatin profiles is the projection of the non-histone columns plus
+    a per-row scale times the projection of the histone columns. The
+    returned float32 array has shape (n_features, 2 * n_classes + 1) and
+    columns [non-histone projection | histone projection | histone sum]
+    for the first `n_classes` unit-length sequence class vectors, so a
+    single matrix product gives every term needed.
+    """
+    projvec = clustervfeat[:n_classes] / np.linalg.norm(
+        clustervfeat[:n_classes], axis=1)[:, None]
+    n_features = clustervfeat.shape[1]
+    histone_mask = np.zeros(n_features, dtype=bool)
+    histone_mask[histone_inds] = True
+
+    hnorm_projvec = np.zeros((n_features, 2 * n_classes + 1), dtype=np.float32)
+    hnorm_projvec[~histone_mask, :n_classes] = projvec[:, ~histone_mask].T
+    hnorm_projvec[histone_mask, n_classes:2 * n_classes] = \
+        projvec[:, histone_mask].T
+    # counts repeated indices the same way summing over
+    # `chromatin_profile[:, histone_inds]` would
+    np.add.at(hnorm_projvec[:, 2 * n_classes], histone_inds, 1)
+    return hnorm_projvec
+
+
+def sc_hnorm_varianteffect_fused(chromatin_profile_ref, chromatin_profile_alt, hnorm_projvec):
+    """
+    Histone-normalized alt - ref sequence class scores computed from the
+    output of `sc_hnorm_projection_matrix`, without copying the
+    chromatin profile matrices.
+    """
+    n_classes = (hnorm_projvec.shape[1] - 1) // 2
+    hnorm_projvec = hnorm_projvec.astype(chromatin_profile_ref.dtype, copy=False)
+    refproj = np.dot(chromatin_profile_ref, hnorm_projvec)
+    altproj = np.dot(chromatin_profile_alt, hnorm_projvec)
+
+    ref_histone_sum = refproj[:, 2 * n_classes]
+    alt_histone_sum = altproj[:, 2 * n_classes]
+    mean_histone_sum = ref_histone_sum*0.5 + alt_histone_sum*0.5
+
+    refproj_adjust = refproj[:, :n_classes] + \
+        (mean_histone_sum / ref_histone_sum)[:, None] * \
+        refproj[:, n_classes:2 * n_classes]
+    altproj_adjust = altproj[:, :n_classes] + \
+        (mean_histone_sum / alt_histone_sum)[:, None] * \
+        altproj[:, n_classes:2 * n_classes]
+    return altproj_adjust - refproj_adjust
+
+
 def sc_hnorm_varianteffect(chromatin_profile_ref, chromatin_profile_alt, clustervfeat, histone_inds):
-    chromatin_profile_ref_adjust = chromatin_profile_ref.copy()
-    chromatin_profile_ref_adjust[:, histone_inds] = \
-        chromatin_profile_ref_adjust[:, histone_inds] * (
-        (np.sum(chromatin_profile_ref[:, histone_inds], axis=1)*0.5 +
-         np.sum(chromatin_profile_alt[:, histone_inds], axis=1)*0.5) /
-        np.sum(chromatin_profile_ref[:, histone_inds], axis=1))[:, None]
-
-    chromatin_profile_alt_adjust = chromatin_profile_alt.copy()
-    chromatin_profile_alt_adjust[:, histone_inds] = \
-        chromatin_profile_alt_adjust[:, histone_inds] * (
-        (np.sum(chromatin_profile_ref[:, histone_inds], axis=1)*0.5 +
-         np.sum(chromatin_profile_alt[:, histone_inds], axis=1)*0.5) /
-        np.sum(chromatin_profile_alt[:, histone_inds], axis=1))[:, None]
-
-    refproj = sc_projection(chromatin_profile_ref_adjust, clustervfeat)
-    altproj = sc_projection(chromatin_profile_alt_adjust, clustervfeat)
-    diffproj = altproj[:,:40] - refproj[:,:40]
-    return diffproj
+    hnorm_projvec = sc_hnorm_projection_matrix(clustervfeat, histone_inds)
+    return sc_hnorm_varianteffect_fused(
+        chromatin_profile_ref, chromatin_profile_alt, hnorm_projvec)
+
+
+PROJECTION_SOURCES = ['target.names', 'seqclass.names',
+                      'projvec_targets.npy', 'histone_inds.npy']
+_PROJECTION_MAGIC = b'SEIPROJ1'
+_PROJECTION_ALIGN = 64
+
+
+def _align(n, alignment=_PROJECTION_ALIGN):
+    return (n + alignment - 1) // alignment * alignment
+
+
+def _write_memmap_artifact(filename, magic, header, arrays):
+    """
+    Create the file layout shared by the compiled artifacts of this module:
+    `magic`, the length of the JSON `header` as a uint64, the header and
+    then each of `arrays` (a dict of name: (shape, dtype)) at an aligned
+    offset recorded in `header['arrays']`. Returns the arrays, filled with
+    zeros, as writable views into a single memory map for the caller to
+    fill in place.
+    """
+    header = dict(header, arrays={})
+    offset = end = 0
+    for name, (shape, dtype) in arrays.items():
+        dtype = np.dtype(dtype)
+        header['arrays'][name] = {'dtype': dtype.str, 'shape': list(shape),
+                                  'offset': offset}
+        end = offset + int(np.prod(shape)) * dtype.itemsize
+        offset = _align(end)
+    header_bytes = json.dumps(header).encode()
+    data_start = _align(len(magic) + 8 + len(header_bytes))
+
+    with open(filename, 'wb') as file_handle:
+        file_handle.write(magic)
+        file_handle.write(np.uint64(len(header_bytes)).tobytes())
+        file_handle.write(header_bytes)
+        file_handle.truncate(data_start + end)
+    buffer = np.memmap(filename, dtype=np.uint8, mode='r+')
+    return _memmap_views(buffer, data_start, header['arrays'])
+
+
+def _open_memmap_artifact(filename, magic, kind, mode='r'):
+    """
+    Open a file written with `_write_memmap_artifact`. Returns the header
+    with the arrays as views into a single memory map opened with `mode`.
+    Raises a ValueError naming `kind` if the file does not start with
+    `magic`.
+    """
+    with open(filename, 'rb') as file_handle:
+        if file_handle.read(len(magic)) != magic:
+            raise ValueError("'{0}' is not a {1}".format(filename, kind))
+        header_len = int(np.frombuffer(file_handle.read(8), dtype=np.uint64)[0])
+        header = json.loads(file_handle.read(header_len).decode())
+    data_start = _align(len(magic) + 8 + header_len)
+
+    buffer = np.memmap(filename, dtype=np.uint8, mode=mode)
+    artifact = {k: v for k, v in header.items() if k != 'arrays'}
+    artifact.update(_memmap_views(buffer, data_start, header['arrays']))
+    return artifact
+
+
+def _memmap_views(buffer, data_start, specs):
+    views = {}
+    for name, spec in specs.items():
+        dtype = np.dtype(spec['dtype'])
+        start = data_start + spec['offset']
+        n_bytes = int(np.prod(spec['shape'])) * dtype.itemsize
+        views[name] = buffer[start:start + n_bytes].view(dtype).reshape(
+            spec['shape'])
+    return views
+
+
+def sha256_file(filename):
+    """
+    The SHA-256 hex digest of a file, read in 1 MB chunks.
+    """
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as file_handle:
+        for chunk in iter(lambda: file_handle.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_projection(sei_dir, n_classes=40):
+    """
+    Load the sequence class projection inputs in `sei_dir`. Returns a dict
+    with the same keys as `load_projection_artifact`: the unit-length
+    projection vectors (float32, C-contiguous, the first `n_classes` rows
+    are the named sequence classes), the histone/non-histone split from
+    `sc_hnorm_projection_matrix`, the histone indices and the chromatin
+    profile and sequence class names.
+    """
+    clustervfeat = np.load(os.path.join(sei_dir, 'projvec_targets.npy'))
+    histone_inds = np.load(os.path.join(sei_dir, 'histone_inds.npy'))
+    return {
+        'n_classes': n_classes,
+        'chromatin_profiles': get_targets(
+            os.path.join(sei_dir, "target.names")),
+        'seqclass_names': get_targets(
+            os.path.join(sei_dir, "seqclass.names")),
+        'projvec': np.ascontiguousarray(
+            clustervfeat / np.linalg.norm(clustervfeat, axis=1)[:, None],
+            dtype=np.float32),
+        'hnorm_projvec': sc_hnorm_projection_matrix(
+            clustervfeat, histone_inds, n_classes=n_classes),
+        'histone_inds': np.ascontiguousarray(histone_inds, dtype=np.int64),
+    }
+
+
+def compile_projection_artifact(sei_dir, output_file, n_classes=40):
+    """
+    Compile the output of `get_projection` for `sei_dir` into a single
+    memory-mappable file that `load_projection_artifact` opens without
+    parsing or recomputing anything. The SHA-256 of each source file is
+    stored alongside so the artifact can be checked for staleness.
+    """
+    projection = get_projection(sei_dir, n_classes=n_classes)
+    arrays = {name: projection[name]
+              for name in ['projvec', 'hnorm_projvec', 'histone_inds']}
+    header = {
+        'n_classes': n_classes,
+        'chromatin_profiles': projection['chromatin_profiles'],
+        'seqclass_names': projection['seqclass_names'],
+        'sources': {fn: sha256_file(os.path.join(sei_dir, fn))
+                    for fn in PROJECTION_SOURCES},
+    }
+    views = _write_memmap_artifact(
+        output_file, _PROJECTION_MAGIC, header,
+        {name: (array.shape, array.dtype) for name, array in arrays.items()})
+    for name, array in arrays.items():
+        views[name][...] = array
+        views[name].flush()
+    return output_file
+
+
+def load_projection_artifact(filename):
+    """
+    Open a file written by `compile_projection_artifact`. The arrays in
+    the returned dict are read-only views into a single memory map, so
+    opening the artifact does not copy or recompute them.
+    """
+    return _open_memmap_artifact(filename, _PROJECTION_MAGIC,
+                                 'compiled projection artifact')
+
+
+def projection_artifact_is_current(artifact, sei_dir):
+    """
+    Check the source checksums recorded in a loaded projection artifact
+    against the files currently in `sei_dir`.
+    """
+    for fn, checksum in artifact['sources'].items():
+        source = os.path.join(sei_dir, fn)
+        if not os.path.exists(source) or sha256_file(source) != checksum:
+            return False
+    return True
+
+
+_GENOME_MAGIC = b'SEI2BIT1'
+_GENOME_CHUNK = 1 << 24
+
+
+def is_packed_genome(filename):
+    """Check whether `filename` was written by `compile_packed_genome`."""
+    with open(filename, 'rb') as file_handle:
+        return file_handle.read(len(_GENOME_MAGIC)) == _GENOME_MAGIC
+
+
+def compile_packed_genome(fasta_file, output_file):
+    """
+    Pack an indexed FASTA file into a single memory-mappable file that
+    `load_packed_genome` opens without parsing anything. Each base is
+    stored in 2 bits (A, C, G, T = 0, 1, 2, 3, upper or lower case) and
+    each unknown base (N or any other character) is set in a separate
+    1-bit mask, so hg38 takes about 1 GB. The chromosomes are stored one
+    after the other, each starting at a multiple of 8 bases, and are read
+    `_GENOME_CHUNK` bases at a time. The SHA-256 of the FASTA file is
+    stored alongside.
+    """
+    fasta = pyfaidx.Fasta(fasta_file, as_raw=True)
+    codes = np.full(256, 4, dtype=np.uint8)
+    for code, base in enumerate('ACGT'):
+        codes[ord(base)] = codes[ord(base.lower())] = code
+
+    chroms, offset = [], 0
+    for chrom in fasta.keys():
+        chroms.append([chrom, len(fasta[chrom]), offset])
+        offset = _align(offset + len(fasta[chrom]), alignment=8)
+    header = {
+        'source': os.path.basename(fasta_file),
+        'sha256': sha256_file(fasta_file),
+        'chroms': chroms,
+    }
+    arrays = _write_memmap_artifact(
+        output_file, _GENOME_MAGIC, header,
+        {'bases': ((offset // 4,), '|u1'), 'unknown': ((offset // 8,), '|u1')})
+
+    for chrom, length, chrom_offset in chroms:
+        for start in range(0, length, _GENOME_CHUNK):
+            chunk = codes[np.frombuffer(
+                fasta[chrom][start:start + _GENOME_CHUNK].encode(),
+                dtype=np.uint8)]
+            # pad the last chunk to whole bytes of the unknown mask
+            chunk = np.concatenate([chunk, np.zeros(
+                _align(len(chunk), alignment=8) - len(chunk),
+                dtype=np.uint8)])
+            unknown = chunk == 4
+            chunk[unknown] = 0
+            chunk = chunk.reshape(-1, 4)
+            position = chrom_offset + start
+            arrays['bases'][position // 4:position // 4 + len(chunk)] = (
+                chunk[:, 0] << 6 | chunk[:, 1] << 4 |
+                chunk[:, 2] << 2 | chunk[:, 3])
+            packed = np.packbits(unknown)
+            arrays['unknown'][position // 8:position // 8 + len(packed)] = \
+                packed
+    for array in arrays.values():
+        array.flush()
+    return output_file
+
+
+def load_packed_genome(filename):
+    """
+    Open a file written by `compile_packed_genome`. Returns the header
+    (`source`, `sha256` and `chroms`, a list of the name, length and
+    first base of each chromosome) with the packed `bases` and `unknown`
+    arrays as read-only views into a single memory map.
+    """
+    return _open_memmap_artifact(filename, _GENOME_MAGIC, 'packed genome')
+
+
+_TRAINING_SHARD_MAGIC = b'SEITRN01'
+
+
+def create_training_shard(filename,
+                          n_samples,
+                          sequence_length,
+                          n_features,
+                          **header):
+    """
+    Create a training data shard of `n_samples` samples that
+    `load_training_shard` opens as memory maps, filled with zeros, and
+    return its arrays as writable memory maps:
+
+    * `bases`: each sequence in 2 bits per base (A, C, G, T = 0, 1, 2, 3,
+      4 bases per byte, first base in the high bits), as in
+      `compile_packed_genome`.
+    * `unknown`: the 1-bit mask of the unknown bases of each sequence.
+    * `targets`: the bit-packed (`numpy.packbits`) target vector of each
+      sample.
+    * `chrom`, `position` and `strand`: the index in `header['chroms']`
+      of the chromosome, the center position and the strand (0 for '+',
+      1 for '-') of each sample.
+
+    The keyword arguments `header` (e.g. `chroms` and `mode`) are stored
+    in the JSON header.
+    """
+    header = dict(header,
+                  n_samples=n_samples,
+                  sequence_length=sequence_length,
+                  n_features=n_features)
+    return _write_memmap_artifact(filename, _TRAINING_SHARD_MAGIC, header, {
+        'bases': ((n_samples, _align(sequence_length, 8) // 4), '|u1'),
+        'unknown': ((n_samples, _align(sequence_length, 8) // 8), '|u1'),
+        'targets': ((n_samples, _align(n_features, 8) // 8), '|u1'),
+        'chrom': ((n_samples,), '<u2'),
+        'position': ((n_samples,), '<i8'),
+        'strand': ((n_samples,), '|u1')})
+
+
+def load_training_shard(filename):
+    """
+    Open a shard written with `create_training_shard`. Returns the header
+    with the arrays as read-only views into a single memory map.
+    """
+    return _open_memmap_artifact(filename, _TRAINING_SHARD_MAGIC,
+                                 'training data shard')
 
 
 def get_filename_prefix(filename):
@@ -66,45 +570,673 @@ def get_filename_prefix(filename):
 
 
 def write_to_tsv(max_abs_diff,
-                 chromatin_profile_diffs,
+                 get_chromatin_profile_diffs,
                  sequence_class_projscores,
                  chromatin_profiles,
                  seqclass_names,
                  rowlabels,
                  output_chromatin_profile_file,
-                 output_sequence_class_file):
-    sorted_sc_abs_diff = np.sort(max_abs_diff)[::-1]
-    sorted_maxsc_df = pd.DataFrame(sorted_sc_abs_diff,  # dataframe
-                                   columns=['seqclass_max_absdiff'])
+                 output_sequence_class_file,
+                 top_k=None,
+                 min_score=None,
+                 batch_size=1000,
+                 n_threads=None):
+    """
+    Write the chromatin profile diffs and sequence class scores TSVs,
+    sorted by `max_abs_diff`, in a single pass over the sorted rows.
 
+    Rows are formatted `batch_size` at a time and
+    `get_chromatin_profile_diffs(row_ixs)` is only asked for the chromatin
+    profile diffs of the rows in the current batch, so the full
+    N x 21,907 matrix is never built. When the chromatin profile TSV is
+    compressed, each batch is gzipped as a separate member on a thread
+    pool (the concatenated members are a valid gzip file).
+
+    Parameters
+    ----------
+    top_k : int or None
+        Only write the `top_k` variants with the largest `max_abs_diff`.
+    min_score : float or None
+        Only write variants with `max_abs_diff` >= `min_score`.
+    """
     sorted_ixs = np.argsort(max_abs_diff)[::-1]
-    assert len(sorted_ixs) == chromatin_profile_diffs.shape[0]
-    sorted_rowlabels = rowlabels.iloc[sorted_ixs]  # dataframe
-    sorted_rowlabels.reset_index(inplace=True)
-    rowlabel_columns = sorted_rowlabels.columns.tolist()
-
-    # sorted now
-    chromatin_profile_diffs = chromatin_profile_diffs[sorted_ixs, :]
-    sequence_class_projscores = sequence_class_projscores[sorted_ixs,:]
-
-    # dataframes
-    sorted_profiles_df = pd.DataFrame(chromatin_profile_diffs, columns=chromatin_profiles)
-    sorted_sc_df = pd.DataFrame(sequence_class_projscores, columns=seqclass_names)
-    del chromatin_profile_diffs
-
-    sei_df = pd.concat([sorted_maxsc_df, sorted_rowlabels, sorted_profiles_df],
-                       axis=1)
-    sc_df = pd.concat([sorted_maxsc_df, sorted_rowlabels, sorted_sc_df],
-                      axis=1)
-    sc_df[['seqclass_max_absdiff'] + rowlabel_columns + seqclass_names].to_csv(
-        output_sequence_class_file, sep='\t', index=False)
-
-    if len(sei_df) > 10000:
-        sei_df[['seqclass_max_absdiff'] + rowlabel_columns + chromatin_profiles].to_csv(
-            output_chromatin_profile_file, sep='\t', index=False, compression='gzip')
-    else:
-        sei_df[['seqclass_max_absdiff'] + rowlabel_columns + chromatin_profiles].to_csv(
-            output_chromatin_profile_file, sep='\t', index=False)
+    assert len(sorted_ixs) == sequence_class_projscores.shape[0]
+    if min_score is not None:
+        sorted_ixs = sorted_ixs[max_abs_diff[sorted_ixs] >= min_score]
+    if top_k is not None:
+        sorted_ixs = sorted_ixs[:top_k]
+    compress = len(sorted_ixs) > 10000
+    if n_threads is None:
+        n_threads = min(4, os.cpu_count() or 1)
+
+    def _format_batch(start):
+        batch_ixs = sorted_ixs[start:start + batch_size]
+        batch_rowlabels = rowlabels.iloc[batch_ixs].reset_index()
+        batch_rowlabels.insert(
+            0, 'seqclass_max_absdiff', max_abs_diff[batch_ixs])
+        sc_df = pd.concat(
+            [batch_rowlabels,
+             pd.DataFrame(sequence_class_projscores[batch_ixs],
+                          columns=seqclass_names)],
+            axis=1)
+        cp_df = pd.DataFrame(get_chromatin_profile_diffs(batch_ixs),
+                             columns=chromatin_profiles)
+        for i, column in enumerate(batch_rowlabels.columns):
+            cp_df.insert(i, column, batch_rowlabels[column].values)
+        header = start == 0
+        sc_text = sc_df.to_csv(sep='\t', index=False, header=header)
+        cp_bytes = cp_df.to_csv(sep='\t', index=False, header=header).encode()
+        if compress:
+            cp_bytes = gzip.compress(cp_bytes, compresslevel=6)
+        return sc_text, cp_bytes
+
+    with ThreadPoolExecutor(n_threads) as pool, \
+            open(output_chromatin_profile_file, 'wb') as cp_fh, \
+            open(output_sequence_class_file, 'w') as sc_fh:
+        pending = deque()
+        for start in range(0, max(len(sorted_ixs), 1), batch_size):
+            pending.append(pool.submit(_format_batch, start))
+            # bound the number of formatted batches held in memory
+            if len(pending) > n_threads:
+                sc_text, cp_bytes = pending.popleft().result()
+                sc_fh.write(sc_text)
+                cp_fh.write(cp_bytes)
+        while pending:
+            sc_text, cp_bytes = pending.popleft().result()
+            sc_fh.write(sc_text)
+            cp_fh.write(cp_bytes)
+
+
+_STORE_LABELS = ['chrom', 'pos', 'name', 'ref', 'alt', 'strand',
+                 'ref_match', 'contains_unk']
+# the sorted score files of a segment
+_STORE_SORTED_FILE = re.compile(
+    r'^segment_(\d+)\.(?:sorted\.f32|order\.i64)$')
+
+
+def _read_array(filename, dtype, n):
+    """The first `n` values of a raw array file, memory-mapped."""
+    if n == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', shape=(n,))
+
+
+def _merge_sorted_rows(ends):
+    """The rows of (sorted scores, rows) pairs in (score, row) order."""
+    if not ends:
+        return np.empty(0, dtype=np.int64)
+    scores = np.concatenate([scores for scores, _ in ends])
+    rows = np.concatenate([rows for _, rows in ends])
+    return rows[np.lexsort((rows, scores))]
+
+
+class ResultsStore(object):
+    """
+    An on-disk store of the variant effect sequence class scores of many
+    `2_varianteffect_sc_score.py` (or `--seqclass-only`) runs, indexed so
+    that locus, variant name, score range and top-k queries read only the
+    matching variants.
+
+    `store_dir` holds:
+
+    * `index.sqlite`, with a `runs` table of the ingested files and a
+      `variants` table of the row labels of every variant (rows are
+      numbered across runs in ingest order), indexed on (chrom, pos) and
+      on name.
+    * `class_<k>.f32`, the float32 scores of sequence class k of every
+      row, i.e. one column per file, appended to by each ingest.
+    * `segment_<segment>.sorted.f32` and `segment_<segment>.order.i64`,
+      the scores of each sequence class of the rows of a segment in
+      increasing order and their rows (one row per class), which are
+      searched by bisection for score ranges and read from either end for
+      top-k. Each ingest writes the scores of its run as a new segment, so
+      it only reads and writes the new rows, and `compact` merges all of
+      the segments into one.
+
+    The number of rows and the segments are committed together at the end
+    of an ingest or compaction, so queries during either see the store as
+    it was before it, and the files of an ingest that did not finish are
+    discarded by the next one.
+
+    Parameters
+    ----------
+    store_dir : str
+        The store directory. It is created if it does not exist.
+    seqclass_names : list(str) or None, optional
+        Default is None. The sequence class names (e.g. from
+        `model/seqclass.names`). Required for the first ingest; the names
+        of the scored classes are then kept in the store.
+    """
+
+    def __init__(self, store_dir, seqclass_names=None):
+        os.makedirs(store_dir, exist_ok=True)
+        self._dir = store_dir
+        self._db = sqlite3.connect(os.path.join(store_dir, 'index.sqlite'),
+                                   isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id INTEGER PRIMARY KEY, run TEXT UNIQUE, scores TEXT,
+                row_labels TEXT, first_row INTEGER, n_rows INTEGER);
+            CREATE TABLE IF NOT EXISTS variants (
+                row INTEGER PRIMARY KEY, run_id INTEGER, chrom TEXT,
+                pos INTEGER, name TEXT, ref TEXT, alt TEXT, strand TEXT,
+                ref_match INTEGER, contains_unk INTEGER);
+            CREATE INDEX IF NOT EXISTS variants_locus
+                ON variants (chrom, pos);
+            CREATE INDEX IF NOT EXISTS variants_name ON variants (name);
+        """)
+        self._seqclass_names = seqclass_names
+        stored = self._meta().get('seqclass_names')
+        if stored is not None:
+            self._seqclass_names = stored
 
+    def _meta(self):
+        # one statement, so the values are from the same commit
+        return {key: json.loads(value) for key, value in
+                self._db.execute("SELECT key, value FROM meta")}
 
+    def _set_meta(self, **values):
+        self._db.executemany(
+            "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+            [(key, json.dumps(value)) for key, value in values.items()])
 
+    @property
+    def seqclass_names(self):
+        return self._seqclass_names
+
+    def _path(self, k):
+        return os.path.join(self._dir, 'class_{0}.f32'.format(k))
+
+    def _segment_path(self, segment, kind):
+        return os.path.join(self._dir, 'segment_{0}.{1}'.format(segment, kind))
+
+    def _segments(self, meta):
+        """
+        The committed segments, as [segment, number of rows] pairs, and the
+        next segment number.
+        """
+        return meta.get('segments', []), meta.get('next_segment', 0)
+
+    def _sorted_scores(self, k, segment):
+        """The sorted scores of class k in `segment` and their rows."""
+        segment, n_rows = segment
+        n_classes = len(self._seqclass_names)
+        return tuple(_read_array(self._segment_path(segment, kind), dtype,
+                                 n_classes * n_rows).reshape(
+                                     n_classes, n_rows)[k]
+                     for kind, dtype in [('sorted.f32', np.float32),
+                                         ('order.i64', np.int64)])
+
+    def _remove_unused_segments(self, meta):
+        # keep the segments replaced by the last compaction for queries
+        # that are still reading them
+        keep = {segment[0] for segment in
+                meta['segments'] + meta.get('replaced_segments', [])}
+        for filename in os.listdir(self._dir):
+            match = _STORE_SORTED_FILE.match(filename)
+            if match and int(match.group(1)) not in keep:
+                os.remove(os.path.join(self._dir, filename))
+
+    def _class_index(self, seqclass):
+        """The index of a class given its index, name or label (e.g. 'PC1')."""
+        if isinstance(seqclass, (int, np.integer)):
+            return int(seqclass)
+        for k, name in enumerate(self._seqclass_names):
+            if seqclass == name or seqclass == name.split(' ')[0]:
+                return k
+        raise ValueError("Unknown sequence class '{0}'".format(seqclass))
+
+    def _write(self, path, array):
+        with open(path, 'wb') as file_handle:
+            file_handle.write(np.ascontiguousarray(array).tobytes())
+
+    def ingest(self, scores_file, row_labels_file, run=None):
+        """
+        Add the scores of one run: a `.npy` file written by
+        `2_varianteffect_sc_score.py` or an HDF5 file written with
+        `--seqclass-only`, and its row labels file.
+
+        Parameters
+        ----------
+        scores_file : str
+            The N x sequence classes scores.
+        row_labels_file : str
+            The `_row_labels.txt` file with the N variants.
+        run : str or None, optional
+            Default is None (the absolute path of `scores_file`). A unique
+            name for the run.
+
+        Returns
+        -------
+        int
+            The number of variants ingested.
+        """
+        if scores_file.endswith('.npy'):
+            scores = np.load(scores_file, mmap_mode='r')
+        else:
+            scores = get_data(scores_file)
+        labels = pd.read_csv(row_labels_file, sep='\t', dtype={
+            'chrom': str, 'name': str, 'ref': str, 'alt': str, 'strand': str})
+        if len(labels) != len(scores):
+            raise ValueError("'{0}' does not have the same number of rows "
+                             "as '{1}'".format(row_labels_file, scores_file))
+        if run is None:
+            run = os.path.abspath(scores_file)
+
+        self._db.execute("BEGIN EXCLUSIVE")
+        try:
+            if self._db.execute("SELECT 1 FROM runs WHERE run = ?",
+                                (run,)).fetchone():
+                raise ValueError("'{0}' was already ingested".format(run))
+            meta = self._meta()
+            if 'seqclass_names' not in meta:
+                if self._seqclass_names is None:
+                    raise ValueError("`seqclass_names` are required to create "
+                                     "a results store")
+                self._seqclass_names = list(
+                    self._seqclass_names[:scores.shape[1]])
+                self._set_meta(seqclass_names=self._seqclass_names)
+            if scores.shape[1] != len(self._seqclass_names):
+                raise ValueError("'{0}' has {1} sequence classes, the store "
+                                 "has {2}".format(scores_file, scores.shape[1],
+                                                  len(self._seqclass_names)))
+            first_row = meta.get('n_rows', 0)
+            segments, segment = self._segments(meta)
+            run_id = self._db.execute(
+                "INSERT INTO runs (run, scores, row_labels, first_row, n_rows) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (run, os.path.abspath(scores_file),
+                 os.path.abspath(row_labels_file), first_row,
+                 len(labels))).lastrowid
+            columns = [labels[column].astype(str).tolist()
+                       for column in ['chrom', 'name', 'ref', 'alt', 'strand']]
+            flags = [labels[column].astype(str).str.lower().eq('true').astype(
+                int).tolist() for column in ['ref_match', 'contains_unk']]
+            self._db.executemany(
+                "INSERT INTO variants VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                zip(range(first_row, first_row + len(labels)),
+                    [run_id] * len(labels), columns[0],
+                    labels['pos'].astype(int).tolist(), *columns[1:], *flags))
+
+            scores = np.asarray(scores, dtype=np.float32).T
+            for k, class_scores in enumerate(scores):
+                with open(self._path(k), 'ab') as file_handle:
+                    # drop the scores of an ingest that did not finish
+                    file_handle.truncate(4 * first_row)
+                    file_handle.write(class_scores.tobytes())
+            if len(labels):
+                order = np.argsort(scores, axis=1, kind='stable')
+                self._write(self._segment_path(segment, 'sorted.f32'),
+                            np.take_along_axis(scores, order, axis=1))
+                self._write(self._segment_path(segment, 'order.i64'),
+                            first_row + order)
+                segments = segments + [[segment, len(labels)]]
+            meta = dict(meta,
+                        n_rows=first_row + len(labels),
+                        segments=segments,
+                        next_segment=segment + 1)
+            self._set_meta(n_rows=meta['n_rows'],
+                           segments=meta['segments'],
+                           next_segment=meta['next_segment'])
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._remove_unused_segments(meta)
+        return len(labels)
+
+    def compact(self):
+        """
+        Merge the sorted scores of all of the segments written by each
+        ingest into one segment, so that score queries search one segment
+        instead of one per run. Queries return the same variants before and
+        after. Returns the number of segments merged.
+        """
+        self._db.execute("BEGIN EXCLUSIVE")
+        try:
+            meta = self._meta()
+            segments, segment = self._segments(meta)
+            if len(segments) <= 1:
+                self._db.execute("ROLLBACK")
+                return len(segments)
+            shape = (len(self._seqclass_names), meta['n_rows'])
+            merged_scores = np.memmap(self._segment_path(
+                segment, 'sorted.f32'), dtype=np.float32, mode='w+',
+                shape=shape)
+            merged_rows = np.memmap(self._segment_path(
+                segment, 'order.i64'), dtype=np.int64, mode='w+',
+                shape=shape)
+            # one class at a time, so only one class of every row is in
+            # memory
+            for k in range(shape[0]):
+                sorted_scores, rows = zip(*[self._sorted_scores(k, old)
+                                            for old in segments])
+                sorted_scores = np.concatenate(sorted_scores)
+                # the segments are sorted, so the stable sort merges them
+                merged = np.argsort(sorted_scores, kind='stable')
+                merged_scores[k] = sorted_scores[merged]
+                merged_rows[k] = np.concatenate(rows)[merged]
+            merged_scores.flush()
+            merged_rows.flush()
+            del merged_scores, merged_rows
+            meta = dict(meta,
+                        segments=[[segment, meta['n_rows']]],
+                        next_segment=segment + 1,
+                        replaced_segments=segments)
+            self._set_meta(segments=meta['segments'],
+                           next_segment=meta['next_segment'],
+                           replaced_segments=meta['replaced_segments'])
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._remove_unused_segments(meta)
+        return len(segments)
+
+    def _scores(self, rows, n_rows):
+        return np.stack([
+            _read_array(self._path(k), np.float32, n_rows)[rows]
+            for k in range(len(self._seqclass_names))], axis=1).reshape(
+                len(rows), len(self._seqclass_names))
+
+    def _rows_by_score(self, k, segments, min_abs_score=None, top_k=None):
+        # the rows at either end of the scores of each segment, merged in
+        # the (score, row) order of one sorted array of all of the rows, so
+        # the rows and their order do not depend on the segments
+        low_ends, high_ends = [], []
+        n_low = n_high = 0
+        for segment in segments:
+            sorted_scores, order = self._sorted_scores(k, segment)
+            n_rows = len(order)
+            if min_abs_score is None:
+                # the split of all of the rows is made after the merge
+                low, high = n_rows, 0
+            else:
+                low = np.searchsorted(sorted_scores, -min_abs_score,
+                                      side='right')
+                # at 0, the rows that score 0 are only in the low end
+                high = np.searchsorted(
+                    sorted_scores, min_abs_score,
+                    side='right' if min_abs_score == 0 else 'left')
+                n_low += low
+                n_high += n_rows - high
+            if top_k is not None:
+                low, high = min(top_k, low), max(high, n_rows - top_k)
+            low_ends.append((sorted_scores[:low], order[:low]))
+            high_ends.append((sorted_scores[high:], order[high:]))
+        if min_abs_score is None:
+            n_rows = sum(segment[1] for segment in segments)
+            n_low, n_high = n_rows // 2, n_rows - n_rows // 2
+        if top_k is not None:
+            n_low, n_high = min(top_k, n_low), min(top_k, n_high)
+        low_rows = _merge_sorted_rows(low_ends)[:n_low]
+        high_rows = _merge_sorted_rows(high_ends)
+        return np.concatenate(
+            [low_rows, high_rows[len(high_rows) - n_high:]])
+
+    def query(self,
+              name=None,
+              chrom=None,
+              start=None,
+              end=None,
+              seqclass=None,
+              min_abs_score=None,
+              top_k=None):
+        """
+        Get the variants that match all of the given conditions.
+
+        Parameters
+        ----------
+        name : str or None, optional
+            The variant name (VCF ID column), e.g. an rsID.
+        chrom, start, end : str, int, int or None, optional
+            The variants at positions (as in the VCF) from `start` to
+            `end` - 1 on `chrom`. `start` and `end` may be omitted.
+        seqclass : int or str or None, optional
+            A sequence class (index, name or label such as 'PC1') for
+            `min_abs_score` and `top_k`.
+        min_abs_score : float or None, optional
+            Only the variants with |score| >= `min_abs_score` in `seqclass`.
+        top_k : int or None, optional
+            Only the `top_k` variants with the largest |score| in
+            `seqclass`.
+
+        Returns
+        -------
+        pandas.DataFrame
+            The run and row labels and the scores of every sequence class
+            of the matching variants, ordered by |score| in `seqclass` if
+            given, otherwise by row.
+        """
+        if self._seqclass_names is None:
+            raise ValueError("The results store is empty")
+        if (min_abs_score is not None or top_k is not None) and \
+                seqclass is None:
+            raise ValueError("`min_abs_score` and `top_k` require `seqclass`")
+        if top_k is not None and top_k < 1:
+            raise ValueError("`top_k` must be a positive integer")
+        if min_abs_score is not None and min_abs_score < 0:
+            raise ValueError("`min_abs_score` must be non-negative")
+        meta = self._meta()
+        n_rows = meta.get('n_rows', 0)
+        conditions, values = [], []
+        if name is not None:
+            conditions.append("name = ?")
+            values.append(name)
+        if chrom is not None:
+            conditions.append("chrom = ?")
+            values.append(chrom)
+            if start is not None:
+                conditions.append("pos >= ?")
+                values.append(start)
+            if end is not None:
+                conditions.append("pos < ?")
+                values.append(end)
+
+        k = None if seqclass is None else self._class_index(seqclass)
+        if conditions:
+            rows = np.array([row for row, in self._db.execute(
+                "SELECT row FROM variants WHERE {0} AND row < ? "
+                "ORDER BY row".format(" AND ".join(conditions)),
+                values + [n_rows])], dtype=np.int64)
+            scores = self._scores(rows, n_rows)
+            if min_abs_score is not None:
+                keep = np.abs(scores[:, k]) >= min_abs_score
+                rows, scores = rows[keep], scores[keep]
+        elif k is not None:
+            rows = self._rows_by_score(
+                k, self._segments(meta)[0],
+                min_abs_score=min_abs_score, top_k=top_k)
+            scores = self._scores(rows, n_rows)
+        else:
+            raise ValueError("Specify a name, a locus or a sequence class")
+        if k is not None:
+            order = np.argsort(-np.abs(scores[:, k]), kind='stable')[:top_k]
+            rows, scores = rows[order], scores[order]
+
+        labels = {}
+        for batch_start in range(0, len(rows), 500):
+            batch = rows[batch_start:batch_start + 500].tolist()
+            for row in self._db.execute(
+                    "SELECT v.row, r.run, {0} FROM variants v JOIN runs r "
+                    "USING (run_id) WHERE v.row IN ({1})".format(
+                        ", ".join(_STORE_LABELS), ", ".join("?" * len(batch))),
+                    batch):
+                labels[row[0]] = row[1:]
+        results = pd.DataFrame([labels[row] for row in rows.tolist()],
+                               columns=['run'] + _STORE_LABELS)
+        for column in ['ref_match', 'contains_unk']:
+            results[column] = results[column].astype(bool)
+        return pd.concat([results, pd.DataFrame(
+            scores, columns=self._seqclass_names)], axis=1)
+
+    def close(self):
+        self._db.close()
+
+
+class Profiler(object):
+    """
+    Opt-in telemetry for the `--profile=<jsonl>` option of the `1_*` and
+    `2_*` scripts. Records the latency of named stages and the number of
+    sequences processed, and appends JSON lines to `output_path`:
+
+    * `start` when it is created, with the script arguments.
+    * `progress` at most every `interval` seconds while sequences are
+      counted, with the sequences/s since the previous `progress` event.
+    * `summary` on `close` (called at exit if not before), with the count,
+      total, mean and p50/p90/p99 latency of each stage, the sequences/s
+      over the run and the peak RSS and GPU memory. It is not written if
+      nothing was recorded.
+
+    Every event has the fields `event`, `time` (Unix seconds),
+    `elapsed_s`, `pid`, `host` and `script`, plus those set with
+    `set_context`. Several processes (e.g. `--workers`) can append to the
+    same file; each line is written with a single call.
+
+    Parameters
+    ----------
+    output_path : str
+        The JSON-lines file to append to.
+    interval : float, optional
+        Default is 10. The minimum number of seconds between `progress`
+        events.
+    """
+
+    def __init__(self, output_path, interval=10.):
+        self._file_handle = open(output_path, 'a', buffering=1)
+        self._interval = interval
+        self._context = {'host': os.uname().nodename,
+                         'script': os.path.basename(sys.argv[0])}
+        self.reset()
+        self.emit('start', argv=sys.argv[1:])
+        atexit.register(self.close)
+
+    def reset(self):
+        """Clear the recorded stages and sequences, e.g. after a fork."""
+        self._stages = {}
+        # per thread, as the stages of a pipeline run concurrently
+        self._running = threading.local()
+        self._n_sequences = 0
+        self._start = time.perf_counter()
+        self._last_progress = (self._start, 0)
+        self._closed = False
+
+    def set_context(self, **fields):
+        """Add `fields` to every event from now on."""
+        self._context.update(fields)
+
+    def emit(self, event, **fields):
+        record = {'event': event,
+                  'time': time.time(),
+                  'elapsed_s': time.perf_counter() - self._start,
+                  'pid': os.getpid()}
+        record.update(self._context)
+        record.update(fields)
+        self._file_handle.write(json.dumps(record) + "\n")
+
+    def record(self, name, seconds):
+        """Add one latency sample to stage `name`."""
+        self._stages.setdefault(name, []).append(seconds)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time the body of a `with` statement as a sample of `name`. A stage
+        entered again while it is running in the same thread (e.g. a
+        wrapped method calling another) is only timed once.
+        """
+        running = self._running.__dict__.setdefault('stages', set())
+        if name in running:
+            yield
+            return
+        running.add(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+            running.discard(name)
+
+    def wrap(self, name, function):
+        """`function`, with each call timed as a sample of `name`."""
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            with self.stage(name):
+                return function(*args, **kwargs)
+        return timed
+
+    def count(self, n_sequences):
+        """Add `n_sequences` processed sequences (or rows)."""
+        self._n_sequences += n_sequences
+        now = time.perf_counter()
+        last_time, last_n_sequences = self._last_progress
+        if now - last_time >= self._interval:
+            self.emit('progress',
+                      sequences=self._n_sequences,
+                      sequences_per_s=(self._n_sequences - last_n_sequences) /
+                      (now - last_time),
+                      rss_mb=self._peak_rss_mb())
+            self._last_progress = (now, self._n_sequences)
+
+    def _peak_rss_mb(self):
+        # kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def _peak_gpu_mb(self):
+        torch = sys.modules.get('torch')
+        if torch is None or not torch.cuda.is_available() or \
+                not torch.cuda.is_initialized():
+            return None
+        return torch.cuda.max_memory_allocated() / 2**20
+
+    def summary(self):
+        """The fields of the `summary` event."""
+        elapsed = time.perf_counter() - self._start
+        stages = {}
+        for name, samples in sorted(self._stages.items()):
+            samples = np.asarray(samples)
+            p50, p90, p99 = np.percentile(samples, [50, 90, 99])
+            stages[name] = {'count': len(samples),
+                            'total_s': float(samples.sum()),
+                            'mean_s': float(samples.mean()),
+                            'p50_s': float(p50),
+                            'p90_s': float(p90),
+                            'p99_s': float(p99)}
+        return {'sequences': self._n_sequences,
+                'sequences_per_s': self._n_sequences / elapsed,
+                'stages': stages,
+                'peak_rss_mb': self._peak_rss_mb(),
+                'peak_gpu_mb': self._peak_gpu_mb()}
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._stages or self._n_sequences:
+            self.emit('summary', **self.summary())
+        self._file_handle.flush()
+
+
+def profile_stage(profiler, name):
+    """`profiler.stage(name)`, or a no-op if `profiler` is None."""
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(name)
+
+
+def profile_iter(profiler, name, iterable):
+    """
+    Iterate over `iterable` (e.g. `get_data_blocks`), timing the fetch of
+    each item as a sample of `name` if `profiler` is not None.
+    """
+    iterator = iter(iterable)
+    while True:
+        with profile_stage(profiler, name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
@@ -0,0 +1,134 @@
+"""
+Description:
+    Checks that `Sei.fuse_for_inference` leaves the predictions unchanged
+    up to floating point rounding. Builds a randomly initialized Sei model,
+    fuses a copy of it and reports the maximum absolute deviation of the
+    fused predictions from the original ones on random one-hot sequences,
+    on their reverse complements and on sequences whose only known bases
+    lie within the ends that `FusedLinearConv1d` recomputes with the
+    original convolutions. Each `FusedLinearConv1d` is also compared to
+    the convolutions it merges on inputs of lengths around the shortest
+    that it fuses. Reports the forward pass time of both models, and exits
+    with status 1 if any deviation is above --tolerance.
+
+Usage:
+    validate_fuse.py [--n-features=<n>] [--batch-size=<n>] [--threads=<n>]
+                     [--repeats=<n>] [--tolerance=<f>] [--seed=<seed>]
+    validate_fuse.py -h | --help
+
+Options:
+    -h --help               Show this screen.
+    --n-features=<n>        Number of chromatin profiles, i.e. the outputs of
+                            the model. [default: 200]
+    --batch-size=<n>        Number of sequences of each input. [default: 4]
+    --threads=<n>           PyTorch thread count. Defaults to the PyTorch
+                            default.
+    --repeats=<n>           Number of timed forward passes of each model,
+                            after one warm-up pass. [default: 3]
+    --tolerance=<f>         The largest maximum absolute deviation that
+                            passes. [default: 1e-5]
+    --seed=<seed>           Random seed of the weights and sequences.
+                            [default: 0]
+
+"""
+import copy
+import time
+
+from docopt import docopt
+import numpy as np
+import torch
+
+from model.sei import FusedLinearConv1d, Sei
+
+
+SEQUENCE_LENGTH = 4096
+# the outputs of `lconv3`, at 1/16 resolution, recomputed at either end
+EDGE_BAND = 16 * 4
+
+
+def _one_hot(bases):
+    encoding = np.eye(4, dtype=np.float32)[bases]
+    return torch.from_numpy(encoding.transpose(0, 2, 1).copy())
+
+
+def _inputs(rng, batch_size):
+    """
+    The random one-hot sequences, their reverse complements and sequences
+    with known bases only within `EDGE_BAND` of either end (the rest are
+    unknown, encoded as 0.25).
+    """
+    x = _one_hot(rng.integers(0, 4, size=(batch_size, SEQUENCE_LENGTH)))
+    edges = x.clone()
+    edges[:, :, EDGE_BAND:-EDGE_BAND] = 0.25
+    return {'random': x,
+            'reverse_complement': torch.flip(x, dims=[1, 2]),
+            'edge_band': edges}
+
+
+def _max_abs_dev(a, b):
+    return float((a - b).abs().max())
+
+
+def _median_time(model, x, repeats):
+    times = []
+    with torch.no_grad():
+        model(x)
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model(x)
+            times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+if __name__ == "__main__":
+    arguments = docopt(
+        __doc__,
+        version='1.0.0')
+
+    seed = int(arguments["--seed"])
+    batch_size = int(arguments["--batch-size"])
+    tolerance = float(arguments["--tolerance"])
+    if arguments["--threads"] is not None:
+        torch.set_num_threads(int(arguments["--threads"]))
+    torch.manual_seed(seed)
+    rng = np.random.default_rng(seed)
+
+    model = Sei(sequence_length=SEQUENCE_LENGTH,
+                n_genomic_features=int(arguments["--n-features"])).eval()
+    fused = copy.deepcopy(model).fuse_for_inference()
+
+    inputs = _inputs(rng, batch_size)
+    deviations = {}
+    for name, x in inputs.items():
+        with torch.no_grad():
+            deviations[name] = _max_abs_dev(fused(x), model(x))
+
+    for name, module in fused.named_modules():
+        if not isinstance(module, FusedLinearConv1d):
+            continue
+        in_channels = module.conv.in_channels
+        # the lengths around the shortest input the merged convolution runs on
+        for length in [1, 2 * module._edge_input_len,
+                       2 * module._edge_input_len + 1, 256]:
+            x = torch.randn(2, in_channels, length)
+            with torch.no_grad():
+                deviations['{0}[length={1}]'.format(name, length)] = \
+                    _max_abs_dev(module(x), module.edge(x))
+
+    failed = []
+    for name, deviation in deviations.items():
+        status = 'ok'
+        if deviation > tolerance:
+            status = 'FAILED'
+            failed.append(name)
+        print("{0}\tmax abs dev: {1:.3e}\t{2}".format(name, deviation, status))
+    repeats = int(arguments["--repeats"])
+    original_s = _median_time(model, inputs['random'], repeats)
+    fused_s = _median_time(fused, inputs['random'], repeats)
+    print("forward\toriginal: {0:.3f} s\tfused: {1:.3f} s\t{2:.2f}x".format(
+        original_s, fused_s, original_s / fused_s))
+
+    if failed:
+        print("{0} check(s) above the tolerance {1}: {2}".format(
+            len(failed), tolerance, ', '.join(failed)))
+        raise SystemExit(1)
@@ -0,0 +1,135 @@
+"""
+Description:
+    Checks that `predict_utils.IncrementalSei` leaves the predictions
+    unchanged up to floating point rounding. Builds a randomly initialized
+    Sei model and, for each case, predicts a batch of random one-hot ref
+    sequences through `IncrementalSei`, then the alt sequences, which are
+    computed from the cached ref activations, and reports the maximum
+    absolute deviation of the alt predictions from the full forward pass
+    of the model. The cases are SNVs and multi-base substitutions at the
+    start, the center and the end of the sequence, where the recomputed
+    window of each stage is clipped or not, the three mutants of a single
+    ref sequence (as in `1_in_silico_mutagenesis.py --incremental`) and a
+    centered deletion, which shifts the rest of the sequence and must fall
+    back to the full forward pass. Reports the MAC and time saving per
+    variant, and exits with status 1 if any deviation is above the
+    tolerance or a case does not run in the expected mode.
+
+Usage:
+    validate_incremental.py [--n-features=<n>] [--batch-size=<n>]
+                            [--threads=<n>] [--tolerance=<f>] [--seed=<seed>]
+    validate_incremental.py -h | --help
+
+Options:
+    -h --help               Show this screen.
+    --n-features=<n>        Number of chromatin profiles, i.e. the outputs of
+                            the model. [default: 200]
+    --batch-size=<n>        Number of sequences of each input. [default: 4]
+    --threads=<n>           PyTorch thread count. Defaults to the PyTorch
+                            default.
+    --tolerance=<f>         The largest maximum absolute deviation that
+                            passes. [default: 1e-6]
+    --seed=<seed>           Random seed of the weights and sequences.
+                            [default: 0]
+
+"""
+from docopt import docopt
+import numpy as np
+import torch
+
+from model.sei import Sei
+from predict_utils import IncrementalSei
+
+
+SEQUENCE_LENGTH = 4096
+CENTER = SEQUENCE_LENGTH // 2
+
+
+def _one_hot(bases):
+    encoding = np.eye(4, dtype=np.float32)[bases]
+    return torch.from_numpy(encoding.transpose(0, 2, 1).copy())
+
+
+def _substitute(bases, start, length):
+    """The sequences with a different base at `length` positions."""
+    alt = bases.copy()
+    alt[:, start:start + length] = (alt[:, start:start + length] + 1 +
+                                    np.arange(len(alt))[:, None] % 3) % 4
+    return alt
+
+
+def _cases(rng, batch_size):
+    """The (ref, alt, expected mode) of each case, as one-hot sequences."""
+    bases = rng.integers(0, 4, size=(batch_size, SEQUENCE_LENGTH))
+    cases = {}
+    for name, start, length in [('snv_start', 0, 1),
+                                ('snv_start+1', 1, 1),
+                                ('snv_center', CENTER, 1),
+                                ('snv_end-1', SEQUENCE_LENGTH - 2, 1),
+                                ('snv_end', SEQUENCE_LENGTH - 1, 1),
+                                ('mnv_start', 0, 16),
+                                ('mnv_center', CENTER - 8, 16),
+                                ('mnv_end', SEQUENCE_LENGTH - 16, 16)]:
+        cases[name] = (_one_hot(bases), _one_hot(
+            _substitute(bases, start, length)), 'incremental')
+    for name, position in [('ism_start', 0),
+                           ('ism_center', CENTER),
+                           ('ism_end', SEQUENCE_LENGTH - 1)]:
+        ref = bases[:1]
+        mutants = np.repeat(ref, 3, axis=0)
+        mutants[:, position] = (ref[0, position] + np.arange(1, 4)) % 4
+        cases[name] = (_one_hot(ref), _one_hot(mutants), 'incremental')
+    deletion = np.concatenate(
+        [bases[:, :CENTER], bases[:, CENTER + 1:],
+         rng.integers(0, 4, size=(batch_size, 1))], axis=1)
+    cases['deletion_center'] = (_one_hot(bases), _one_hot(deletion), 'full')
+    return cases
+
+
+def _max_abs_dev(a, b):
+    return float((a - b).abs().max())
+
+
+if __name__ == "__main__":
+    arguments = docopt(
+        __doc__,
+        version='1.0.0')
+
+    seed = int(arguments["--seed"])
+    tolerance = float(arguments["--tolerance"])
+    if arguments["--threads"] is not None:
+        torch.set_num_threads(int(arguments["--threads"]))
+    torch.manual_seed(seed)
+    rng = np.random.default_rng(seed)
+
+    model = Sei(sequence_length=SEQUENCE_LENGTH,
+                n_genomic_features=int(arguments["--n-features"])).eval()
+    incremental = IncrementalSei(model)
+
+    failed = []
+    for name, (ref, alt, expected_mode) in _cases(
+            rng, int(arguments["--batch-size"])).items():
+        incremental.clear_cache()
+        with torch.no_grad():
+            incremental(ref)
+            n_incremental = incremental.report()['incremental_sequences']
+            predict = incremental(alt)
+            expected = model(alt)
+        mode = 'full'
+        if incremental.report()['incremental_sequences'] > n_incremental:
+            mode = 'incremental'
+        deviation = _max_abs_dev(predict, expected)
+        status = 'ok'
+        if deviation > tolerance or mode != expected_mode:
+            status = 'FAILED'
+            failed.append(name)
+        print("{0}\t{1}\tmax abs dev: {2:.3e}\t{3}".format(
+            name, mode, deviation, status))
+    report = incremental.report()
+    print("variant\tMAC saving: {0:.1%}\ttime saving: {1:.1%}".format(
+        report['variant_mac_saving'], report['variant_time_saving']))
+
+    if failed:
+        print("{0} check(s) failed with tolerance {1}: {2}".format(
+            len(failed), tolerance, ', '.join(failed)))
+        raise SystemExit(1)
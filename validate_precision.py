@@ -0,0 +1,97 @@
+"""
+Description:
+    Runs `1_variant_effect_prediction.py` on a VCF file at fp32 and at each
+    reduced precision, and reports the maximum and mean absolute deviation
+    of the chromatin profile predictions, the chromatin profile diffs
+    (alt - ref) and the sequence class variant effect scores from the fp32
+    results. The report is printed and written to
+    `<output-dir>/precision_report.json`.
+
+Usage:
+    validate_precision.py <vcf> <output-dir> [--genome=<hg>] [--cuda]
+                          [--precision=<p>]...
+    validate_precision.py -h | --help
+
+Options:
+    -h --help               Show this screen.
+    <vcf>                   Input VCF file (e.g. test.vcf)
+    <output-dir>            Output directory. The predictions for each
+                            precision are written to a subdirectory named
+                            after the precision.
+    --genome=<hg>           hg38 or hg19 [default: hg19]
+    --cuda                  Run prediction on a CUDA-enabled GPU
+    --precision=<p>         Precision(s) to compare against fp32. Defaults to
+                            bf16 and int8 (int8 is skipped with --cuda).
+
+"""
+import json
+import os
+import subprocess
+import sys
+
+from docopt import docopt
+import numpy as np
+
+from utils import get_data, get_projection, sc_hnorm_varianteffect_fused
+
+
+def _deviation(values, fp32_values):
+    abs_dev = np.abs(values - fp32_values)
+    return {'max_abs_dev': float(abs_dev.max()) if abs_dev.size else 0.,
+            'mean_abs_dev': float(abs_dev.mean()) if abs_dev.size else 0.}
+
+
+if __name__ == "__main__":
+    arguments = docopt(
+        __doc__,
+        version='0.0.0')
+
+    use_dir = os.path.dirname(os.path.abspath(__file__))
+    vcf = arguments["<vcf>"]
+    output_dir = arguments["<output-dir>"]
+    os.makedirs(output_dir, exist_ok=True)
+
+    precisions = arguments["--precision"]
+    if not precisions:
+        precisions = ['bf16'] if arguments["--cuda"] else ['bf16', 'int8']
+
+    prefix = '.'.join(os.path.basename(vcf).split('.')[:-1])
+    projection = get_projection(os.path.join(use_dir, "model"))
+
+    results = {}
+    for precision in ['fp32'] + precisions:
+        precision_dir = os.path.join(output_dir, precision)
+        command = [sys.executable,
+                   os.path.join(use_dir, '1_variant_effect_prediction.py'),
+                   vcf, precision_dir,
+                   '--genome={0}'.format(arguments["--genome"]),
+                   '--precision={0}'.format(precision)]
+        if arguments["--cuda"]:
+            command.append('--cuda')
+        print("Running {0} predictions".format(precision))
+        subprocess.run(command, check=True)
+
+        hdf5_dir = os.path.join(precision_dir, "chromatin-profiles-hdf5")
+        ref = get_data(os.path.join(
+            hdf5_dir, "{0}.ref_predictions.h5".format(prefix)))
+        alt = get_data(os.path.join(
+            hdf5_dir, "{0}.alt_predictions.h5".format(prefix)))
+        results[precision] = {
+            'predictions': np.concatenate([ref, alt]),
+            'diffs': alt - ref,
+            'sequence_class_scores': sc_hnorm_varianteffect_fused(
+                ref, alt, projection['hnorm_projvec']),
+        }
+
+    report = {}
+    for precision in precisions:
+        report[precision] = {
+            name: _deviation(values, results['fp32'][name])
+            for name, values in results[precision].items()}
+        for name, deviation in report[precision].items():
+            print("{0}\t{1}\tmax abs dev: {2:.3e}\tmean abs dev: {3:.3e}".format(
+                precision, name,
+                deviation['max_abs_dev'], deviation['mean_abs_dev']))
+
+    with open(os.path.join(output_dir, "precision_report.json"), 'w') as file_handle:
+        json.dump(report, file_handle, indent=2)
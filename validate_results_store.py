@@ -0,0 +1,142 @@
+"""
+Description:
+    Checks the score queries of `utils.ResultsStore` against a scan of all
+    of the scores. Ingests several runs of synthetic scores rounded to
+    integers, so that many variants tie and many score exactly 0, and
+    runs |score| threshold (including 0), top-k, combined and region
+    queries, first on the store of one segment per run and then after
+    `compact`. Each query must return each variant at most once, in order
+    of decreasing |score|, with the same |scores| as the scan and, without
+    top-k (which may break ties differently), the same variants. Exits
+    with status 1 if any query does not.
+
+Usage:
+    validate_results_store.py [--n-runs=<n>] [--n-variants=<n>]
+                              [--n-classes=<n>] [--seed=<seed>]
+    validate_results_store.py -h | --help
+
+Options:
+    -h --help               Show this screen.
+    --n-runs=<n>            Number of ingested runs. [default: 5]
+    --n-variants=<n>        Number of variants of each run. [default: 200]
+    --n-classes=<n>         Number of sequence classes. [default: 8]
+    --seed=<seed>           Random seed of the scores. [default: 0]
+
+"""
+import os
+import tempfile
+
+from docopt import docopt
+import numpy as np
+import pandas as pd
+
+from utils import ResultsStore
+
+
+def _write_run(directory, run, scores):
+    scores_file = os.path.join(directory, '{0}.npy'.format(run))
+    labels_file = os.path.join(directory, '{0}_row_labels.txt'.format(run))
+    np.save(scores_file, scores)
+    positions = np.arange(1, len(scores) + 1)
+    pd.DataFrame({'chrom': 'chr1',
+                  'pos': positions,
+                  'name': ['{0}_{1}'.format(run, i) for i in positions - 1],
+                  'ref': 'A',
+                  'alt': 'G',
+                  'strand': '+',
+                  'ref_match': True,
+                  'contains_unk': False}).to_csv(
+                      labels_file, sep='\t', index=False)
+    return scores_file, labels_file
+
+
+def _expected(names, scores, k, min_abs_score=None, top_k=None, mask=None):
+    """The names of the matching variants in order of decreasing |score|."""
+    abs_scores = np.abs(scores[:, k])
+    keep = np.ones(len(names), dtype=bool) if mask is None else mask.copy()
+    if min_abs_score is not None:
+        keep &= abs_scores >= min_abs_score
+    rows = np.flatnonzero(keep)
+    rows = rows[np.argsort(-abs_scores[rows], kind='stable')][:top_k]
+    return names[rows], abs_scores[rows]
+
+
+def _check(store, names, positions, scores, query):
+    """A description of how the results of `query` are wrong, or None."""
+    results = store.query(**query)
+    result_names = results['name'].to_numpy()
+    if len(set(result_names)) != len(result_names):
+        return "{0} duplicate variants".format(
+            len(result_names) - len(set(result_names)))
+    k = query['seqclass']
+    mask = None
+    if 'chrom' in query:
+        mask = (positions >= query['start']) & (positions < query['end'])
+    expected_names, expected_scores = _expected(
+        names, scores, k, min_abs_score=query.get('min_abs_score'),
+        top_k=query.get('top_k'), mask=mask)
+    if len(result_names) != len(expected_names):
+        return "{0} variants, expected {1}".format(
+            len(result_names), len(expected_names))
+    result_scores = np.abs(results[store.seqclass_names[k]].to_numpy())
+    if not np.array_equal(result_scores, expected_scores):
+        return "the |scores| differ from the scan"
+    # ties may be in any order for top-k, but not across the cutoff
+    if query.get('top_k') is None and \
+            set(result_names) != set(expected_names):
+        return "the variants differ from the scan"
+    return None
+
+
+if __name__ == "__main__":
+    arguments = docopt(
+        __doc__,
+        version='1.0.0')
+
+    n_runs = int(arguments["--n-runs"])
+    n_variants = int(arguments["--n-variants"])
+    n_classes = int(arguments["--n-classes"])
+    rng = np.random.default_rng(int(arguments["--seed"]))
+
+    failed = []
+    with tempfile.TemporaryDirectory() as directory:
+        store = ResultsStore(os.path.join(directory, 'store'),
+                             ['C{0}'.format(k) for k in range(n_classes)])
+        names, scores = [], []
+        for run in range(n_runs):
+            run_scores = (2 * rng.standard_normal(
+                (n_variants, n_classes))).round().astype(np.float32)
+            store.ingest(*_write_run(directory, 'run{0}'.format(run),
+                                     run_scores),
+                         run='run{0}'.format(run))
+            names += ['run{0}_{1}'.format(run, i) for i in range(n_variants)]
+            scores.append(run_scores)
+        names, scores = np.array(names), np.concatenate(scores)
+        positions = np.tile(np.arange(1, n_variants + 1), n_runs)
+
+        queries = []
+        for k in range(min(n_classes, 3)):
+            queries += [
+                dict(seqclass=k, min_abs_score=0.),
+                dict(seqclass=k, min_abs_score=1.),
+                dict(seqclass=k, min_abs_score=2.5),
+                dict(seqclass=k, top_k=1),
+                dict(seqclass=k, top_k=n_variants),
+                dict(seqclass=k, top_k=10 * n_runs * n_variants),
+                dict(seqclass=k, min_abs_score=0., top_k=n_variants),
+                dict(seqclass=k, min_abs_score=2., top_k=n_variants // 2),
+                dict(seqclass=k, chrom='chr1', start=1,
+                     end=n_variants // 2, min_abs_score=0.)]
+        for stage in ['segments', 'compacted']:
+            if stage == 'compacted':
+                store.compact()
+            for query in queries:
+                error = _check(store, names, positions, scores, query)
+                print("{0}\t{1}\t{2}".format(stage, query, error or 'ok'))
+                if error is not None:
+                    failed.append((stage, query))
+        store.close()
+
+    if failed:
+        print("{0} query(s) did not match the scan".format(len(failed)))
+        raise SystemExit(1)